@@ -0,0 +1,192 @@
+"""Admission control: shed load before it piles up in the workers.
+
+Every request is sorted into a route class:
+
+- `feed`  -- the timeline-style pages (home, profiles, tags, likes, ...)
+- `write` -- any other POST: posting, liking, following, ...
+- `read`  -- every other page
+- `login` -- POSTs that run bcrypt (login, signup, profile edits)
+
+Workers are synchronous (see wsgi.py), so a worker only ever has one
+request in flight; when the site is overloaded, requests pile up in the
+listen queue in front of the workers instead. How long a request sat
+there is the load signal: the proxy stamps each request with
+X-Request-Start (nginx: `proxy_set_header X-Request-Start "t=${msec}"`)
+and the worker subtracts that from the time it picks the request up.
+Without the header nothing is shed.
+
+Each class has a wait budget (ADMISSION_MAX_WAIT). A request that has
+already queued past its class's budget gets a 503 with Retry-After
+straight away, since its answer would come too late to be useful, and
+turning it away is cheap, so the queue drains faster.
+
+The worker also keeps a moving average of every request's queue wait.
+While that average is above a class's budget, every request of that
+class is shed, however long it waited itself. Budgets are ranked by
+PRIORITY, so as the queue grows logins and cheap reads back off first
+and the feed keeps going longest. Shed requests still feed the average,
+so shedding stops once the queue has drained.
+
+The hook runs before every other before-request function (including the
+one that loads g.user), so a shed request never touches the database.
+"""
+
+import threading
+import time
+
+from flask import current_app, request
+from werkzeug.exceptions import ServiceUnavailable
+
+# highest priority first
+PRIORITY = ('feed', 'write', 'read', 'login')
+
+FEED_ENDPOINTS = {
+    'warbler.homepage', 'warbler.users_show', 'warbler.user_likes',
+    'warbler.user_mentions', 'warbler.messages_tagged',
+    'warbler.messages_trending',
+}
+
+LOGIN_ENDPOINTS = {'warbler.login', 'warbler.signup', 'warbler.profile'}
+
+# never limited
+EXEMPT_ENDPOINTS = {'static'}
+
+
+def route_class(method, endpoint):
+    """Which route class a request belongs to (None if exempt)."""
+
+    if endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if method not in ('GET', 'HEAD'):
+        return 'login' if endpoint in LOGIN_ENDPOINTS else 'write'
+    return 'feed' if endpoint in FEED_ENDPOINTS else 'read'
+
+
+def queued_for(header, now=None):
+    """Seconds since the proxy's X-Request-Start stamp (0 if absent).
+
+    Accepts "t=<seconds>" (nginx's $msec) and bare seconds, milliseconds
+    or microseconds since the epoch.
+    """
+
+    if not header:
+        return 0.0
+
+    try:
+        stamp = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return 0.0
+
+    if stamp > 1e14:
+        stamp /= 1e6
+    elif stamp > 1e11:
+        stamp /= 1e3
+
+    now = time.time() if now is None else now
+    return max(0.0, now - stamp)
+
+
+class _RouteClass:
+    """Wait budget and counters for one route class."""
+
+    def __init__(self, max_wait):
+        self.max_wait = max_wait
+        self.admitted = 0
+        self.shed = 0
+        # moving average of this class's queue wait, in seconds
+        self.avg_wait = 0.0
+
+    def stats(self):
+        return {'max_wait_ms': round(self.max_wait * 1000, 1),
+                'admitted': self.admitted, 'shed': self.shed,
+                'avg_wait_ms': round(self.avg_wait * 1000, 1)}
+
+
+class AdmissionControl:
+    """Per-route-class load shedding on time spent queued."""
+
+    # weight of each new request in the moving averages
+    SMOOTHING = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._classes = {}
+        # moving average of every request's queue wait, in seconds
+        self.avg_wait = 0.0
+        # requests that carried an X-Request-Start stamp
+        self.stamped = 0
+
+    def init_app(self, app):
+        """Register defaults and the request hook on the Flask app.
+
+        Call before registering the blueprint, so the admission check
+        runs ahead of the blueprint's before-request functions.
+        """
+
+        app.config.setdefault('ADMISSION_ENABLED', True)
+        # seconds a request may queue in front of the workers, per class
+        app.config.setdefault('ADMISSION_MAX_WAIT',
+                              {'feed': 2.0, 'write': 1.0, 'read': 0.5,
+                               'login': 0.1})
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 2)
+
+        self.configure(app.config['ADMISSION_MAX_WAIT'])
+
+        app.before_request(self._before_request)
+        app.extensions['admission'] = self
+
+    def configure(self, max_wait):
+        with self._lock:
+            self._classes = {name: _RouteClass(max_wait[name])
+                             for name in PRIORITY}
+            self.avg_wait = 0.0
+            self.stamped = 0
+
+    def admit(self, name, waited):
+        """Record a request of class `name` that queued `waited` seconds.
+
+        False if it should be shed.
+        """
+
+        route = self._classes[name]
+
+        with self._lock:
+            self.avg_wait += (waited - self.avg_wait) * self.SMOOTHING
+            route.avg_wait += (waited - route.avg_wait) * self.SMOOTHING
+
+            if waited >= route.max_wait or self.avg_wait > route.max_wait:
+                route.shed += 1
+                return False
+
+            route.admitted += 1
+            return True
+
+    def stats(self):
+        """Queue wait and {class: counters} for this worker."""
+
+        with self._lock:
+            return {'avg_wait_ms': round(self.avg_wait * 1000, 1),
+                    'stamped': self.stamped,
+                    'classes': {name: route.stats()
+                                for name, route in self._classes.items()}}
+
+    def _before_request(self):
+        if not current_app.config['ADMISSION_ENABLED']:
+            return
+
+        name = route_class(request.method, request.endpoint)
+        if name is None:
+            return
+
+        header = request.headers.get('X-Request-Start')
+        if header:
+            with self._lock:
+                self.stamped += 1
+
+        if not self.admit(name, queued_for(header)):
+            raise ServiceUnavailable(
+                "Warbler is busy right now; please try again shortly.",
+                retry_after=current_app.config['ADMISSION_RETRY_AFTER'])
+
+
+admission = AdmissionControl()
@@ -1,41 +1,148 @@
+import math
 import os
+from datetime import datetime, timedelta
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from flask import (Blueprint, Flask, Response, render_template, request,
+                   flash, redirect, session, g, abort, current_app)
+from sqlalchemy import select, text, true, tuple_, union_all
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import TooManyRequests
 
+from admission import admission
+from cache import Permalink, permalinks, user_summaries
+from compression import compress_response, init_compression
+from config import PROFILES
+
+from deletion import deactivate_user, purge_user, pending_deletions
+from export import FORMATS as EXPORT_FORMATS, export_user
+from feeds import firehose, recent_messages
+from follow_graph import follow_graph
 from forms import UserAddForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message, Likes
+from importer import PARSERS as IMPORT_FORMATS, import_stream
+from memprofile import memory_profiler
+from mentions import index_messages, linkify, reindex_messages
+from models import (db, connect_db, User, Message, Likes, Follows, Mention,
+                    MessageTag)
+from notifications import (inbox, inbox_messages, mark_all_seen, notify_like,
+                           notify_mentions)
+from partitions import message_router, ensure_partitions, archive_before
+from ratelimit import rate_limits
+from readmodels import MessageView, MESSAGE_VIEW_COLUMNS
+from rollups import rollups
+from rendering import init_template_cache, stream_template, streamed
+from sharding import shard_router, active_user_ids, drop_deactivated
+from tasks import tasks
+from tracing import tracer
+from trending import trending, WINDOWS
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# cli_group=None keeps commands at the top level: `flask purge-accounts`
+bp = Blueprint('warbler', __name__, cli_group=None)
+bp.add_app_template_filter(linkify)
+bp.add_app_template_global(user_summaries, 'user_summaries')
+
+
+def create_app(config=None):
+    """Build the Warbler app.
+
+    `config` is a profile name from config.PROFILES, a config class, or
+    None to use the WARBLER_CONFIG environment variable (default 'dev').
+    """
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'dev')
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    if not app.config['SQLALCHEMY_DATABASE_URI']:
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+            'DATABASE_URL', app.config['DEFAULT_DATABASE_URL'])
+
+    if app.config['DEBUG_TOOLBAR']:
+        # imported here so production never loads it
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    # first, so shed requests are traced too
+    tracer.init_app(app)
+    # next, so its hook runs before anything that touches the database
+    admission.init_app(app)
+    # after admission, so shed requests don't wait for a profiling turn
+    memory_profiler.init_app(app)
+    tasks.init_app(app)
+    follow_graph.init_app(app)
+    trending.init_app(app)
+    rollups.init_app(app)
+    user_summaries.init_app(app)
+    permalinks.init_app(app)
+    rate_limits.init_app(app)
+    shard_router.init_app(app)
+    firehose.init_app(app)
+    recent_messages.init_app(app)
+    init_template_cache(app)
+    init_compression(app)
+
+    app.register_blueprint(bp)
+
+    if app.config['WARM_UP']:
+        warm_up(app)
+
+    return app
+
+
+def warm_up(app):
+    """Get a fresh worker ready before it accepts traffic.
+
+    Compiles every template (loading bytecode from the on-disk cache when
+    it's there) and opens a pooled database connection.
+    """
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+def __getattr__(name):
+    """Build `app` on first use, so importing this module has no side effects.
 
-connect_db(app)
+    `from app import app` (flask run, the tests) gets an app made by
+    create_app() with the WARBLER_CONFIG profile.
+    """
+
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
         g.user = User.query.get(session[CURR_USER_KEY])
 
+        # a deleted account is logged out everywhere straight away
+        if g.user and g.user.is_deactivated:
+            g.user = None
+
     else:
         g.user = None
 
@@ -53,7 +160,38 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def get_active_user_or_404(user_id):
+    """Get user by id, treating deleted accounts as missing."""
+
+    return (User
+            .query
+            .filter_by(id=user_id, deactivated_at=None)
+            .first_or_404())
+
+
+RATE_LIMITED_ACTIONS = {
+    'message': "posting warbles",
+    'like': "liking warbles",
+    'follow': "following and unfollowing people",
+}
+
+
+def enforce_rate_limit(action):
+    """Take a token from the logged-in user's `action` quota, or 429."""
+
+    if not current_app.config['RATE_LIMITS_ENABLED']:
+        return
+
+    decision = rate_limits.hit(action, g.user.id)
+    if not decision.allowed:
+        wait = math.ceil(decision.retry_after)
+        raise TooManyRequests(
+            f"You're {RATE_LIMITED_ACTIONS[action]} too quickly. "
+            f"Please wait {wait} seconds and try again.",
+            retry_after=wait)
+
+
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -89,7 +227,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -109,7 +247,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -120,7 +258,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -129,32 +267,122 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    query = select(User.id).where(User.deactivated_at.is_(None))
+
+    if search:
+        query = query.where(User.username.like(f"%{search}%"))
+
+    users = summaries_in_order(db.session.execute(query).scalars().all())
+
+    return render_template('users/index.html', users=users,
+                           followed_ids=followed_ids([u.id for u in users]))
+
+
+def summaries_in_order(user_ids):
+    """UserSummaries for `user_ids`, in the same order."""
+
+    found = user_summaries.get_many(user_ids)
+    return [found[user_id] for user_id in user_ids if user_id in found]
+
+
+def followed_ids(user_ids):
+    """Which of `user_ids` the logged-in user follows, off the follows key.
+
+    Lets user cards show Follow / Unfollow without loading everyone
+    `g.user` follows.
+    """
+
+    if not g.user or not user_ids:
+        return set()
+
+    return set(shard_router.scalars_for(g.user.id,
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == g.user.id,
+               Follows.user_being_followed_id.in_(user_ids))))
+
+
+def paginate_recent(query, timestamp_col, id_col, per_page=60, shards=None):
+    """Newest-first page of `query`'s rows, plus the cursor for the next.
+
+    Orders by (`timestamp_col`, `id_col`), both of which `query` must
+    select (`timestamp_col` may be a label, as selected); the `before`
+    query-string param is the cursor of the last row already shown
+    ("<iso timestamp>_<id>"). Cursor is None on the last page.
+
+    With `shards`, `query` runs on each of those shards instead of the
+    main database and their pages are merged.
+    """
+
+    # filter and sort on the column itself, read the row by its label
+    stamp_expr = getattr(timestamp_col, 'element', timestamp_col)
+
+    before = request.args.get('before')
+    if before:
+        try:
+            stamp, key = before.rsplit('_', 1)
+            position = (datetime.fromisoformat(stamp), int(key))
+        except ValueError:
+            abort(400)
+        query = query.where(tuple_(stamp_expr, id_col) < position)
+
+    query = (query.order_by(stamp_expr.desc(), id_col.desc())
+             .limit(per_page + 1))
+    if shards is None:
+        rows = db.session.execute(query).all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        rows = shard_router.newest(
+            query, per_page + 1, shards=shards,
+            key=lambda row: (row._mapping[timestamp_col],
+                             row._mapping[id_col]))
 
-    return render_template('users/index.html', users=users)
+    if len(rows) > per_page:
+        last = rows[per_page - 1]._mapping
+        return (rows[:per_page],
+                f"{last[timestamp_col].isoformat()}_{last[id_col]}")
 
+    return rows, None
 
-@app.route('/users/<int:user_id>')
+
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
 
-    user = User.query.get_or_404(user_id)
+    The first page comes from the recent-messages cache; older pages
+    (?before=) go to the database.
+    """
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    user = get_active_user_or_404(user_id)
+    per_page = recent_messages.per_user
 
+    def load_page():
+        if shard_router.enabled:
+            # sharded messages are never archived
+            return shard_router.user_messages(
+                user_id, request.args.get('before', type=int), per_page)
 
-@app.route('/users/<int:user_id>/following')
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages, next_cursor = paginate_messages(
+            Message.query.filter(Message.user_id == user_id), per_page)
+
+        if next_cursor is None:
+            # out of recent messages: carry on into archived months
+            messages, next_cursor = message_router.continue_into_archive(
+                user, messages, request.args.get('before', type=int),
+                per_page)
+
+        return messages, next_cursor
+
+    if request.args.get('before') is None:
+        messages, next_cursor = recent_messages.get(user_id, load_page)
+    else:
+        messages, next_cursor = load_page()
+
+    return stream_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
+
+
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -162,11 +390,34 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = get_active_user_or_404(user_id)
+
+    if shard_router.enabled:
+        # their follows are on their shard; the users in the main database
+        rows, next_cursor = paginate_recent(
+            select(Follows.user_being_followed_id, Follows.timestamp)
+            .where(Follows.user_following_id == user_id),
+            Follows.timestamp, Follows.user_being_followed_id,
+            shards=[shard_router.shard_for(user_id)])
+        active = active_user_ids(followed_id for followed_id, _ in rows)
+        rows = [row for row in rows if row[0] in active]
+    else:
+        rows, next_cursor = paginate_recent(
+            select(Follows.user_being_followed_id, Follows.timestamp)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id,
+                   User.deactivated_at.is_(None)),
+            Follows.timestamp, Follows.user_being_followed_id)
+
+    following = summaries_in_order([followed_id for followed_id, _ in rows])
+
+    return render_template('users/following.html', user=user,
+                           following=following, next_cursor=next_cursor,
+                           followed_ids=followed_ids(
+                               [u.id for u in following]))
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -174,11 +425,34 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = get_active_user_or_404(user_id)
+
+    if shard_router.enabled:
+        # each follow is on its follower's shard, so ask them all
+        rows, next_cursor = paginate_recent(
+            select(Follows.user_following_id, Follows.timestamp)
+            .where(Follows.user_being_followed_id == user_id),
+            Follows.timestamp, Follows.user_following_id,
+            shards=shard_router.names)
+        active = active_user_ids(follower_id for follower_id, _ in rows)
+        rows = [row for row in rows if row[0] in active]
+    else:
+        rows, next_cursor = paginate_recent(
+            select(Follows.user_following_id, Follows.timestamp)
+            .join(User, User.id == Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id,
+                   User.deactivated_at.is_(None)),
+            Follows.timestamp, Follows.user_following_id)
+
+    followers = summaries_in_order([follower_id for follower_id, _ in rows])
+
+    return render_template('users/followers.html', user=user,
+                           followers=followers, next_cursor=next_cursor,
+                           followed_ids=followed_ids(
+                               [u.id for u in followers]))
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -186,14 +460,23 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    enforce_rate_limit('follow')
+
+    followed_user = get_active_user_or_404(follow_id)
+    if shard_router.enabled:
+        shard_router.follow(g.user.id, followed_user.id)
+    else:
+        g.user.following.append(followed_user)
+        db.session.commit()
+
+    follow_graph.add_edge(g.user.id, followed_user.id)
+    compact_follow_graph()
+    refresh_rollups()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -201,14 +484,30 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    enforce_rate_limit('follow')
+
+    if shard_router.enabled:
+        shard_router.unfollow(g.user.id, follow_id)
+    else:
+        followed_user = User.query.get(follow_id)
+        g.user.following.remove(followed_user)
+        db.session.commit()
+
+    follow_graph.remove_edge(g.user.id, follow_id)
+    compact_follow_graph()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+def compact_follow_graph():
+    """Fold recent follows into the graph's arrays once enough pile up."""
+
+    threshold = current_app.config['FOLLOW_GRAPH_COMPACT_AFTER']
+    if follow_graph.needs_compaction(threshold):
+        tasks.enqueue(follow_graph.compact)
+
+
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -229,13 +528,14 @@ def profile():
         user.header_image_url = form.header_image_url.data
         user.bio = form.bio.data
         db.session.commit()
+        user_summaries.invalidate(user.id)
         flash(f'{user.username} edited', 'success')
         return redirect(f'/users/{user.id}')
     
         
     return render_template('users/edit.html', user=user, form=form)
 
-@app.route('/users/<int:user_id>/likes', methods=['GET'])
+@bp.route('/users/<int:user_id>/likes', methods=['GET'])
 def user_likes(user_id):
     """ show user likes """
 
@@ -243,14 +543,266 @@ def user_likes(user_id):
         flash("Please log in first!", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=user.likes)
+    user = get_active_user_or_404(user_id)
+
+    # just what the message cards show, newest like first
+    liked_at = Likes.timestamp.label('liked_at')
+
+    if shard_router.enabled:
+        # their likes are on their shard, the messages on their authors'
+        rows, next_cursor = paginate_recent(
+            select(Likes.message_id, liked_at)
+            .where(Likes.user_id == user_id),
+            liked_at, Likes.message_id,
+            shards=[shard_router.shard_for(user_id)])
+        found = shard_router.find_messages(
+            message_id for message_id, _ in rows)
+        likes = drop_deactivated([found[message_id]
+                                  for message_id, _ in rows
+                                  if message_id in found])
+    else:
+        rows, next_cursor = paginate_recent(
+            select(*MESSAGE_VIEW_COLUMNS, liked_at)
+            .join(Likes, Likes.message_id == Message.id)
+            .join(User, User.id == Message.user_id)
+            .where(Likes.user_id == user_id, User.deactivated_at.is_(None)),
+            liked_at, Message.id)
+
+        likes = [MessageView(*row[:-1]) for row in rows]
+
+    return stream_template('users/likes.html', user=user, likes=likes,
+                           next_cursor=next_cursor)
+
+
+
+@bp.route('/@<username>')
+def users_by_name(username):
+    """Profile by username: where @mention links point."""
+
+    user = User.query.filter_by(username=username,
+                                deactivated_at=None).first_or_404()
+    return redirect(f"/users/{user.id}")
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def user_mentions(user_id):
+    """Messages that @mention this user, newest first."""
+
+    user = get_active_user_or_404(user_id)
+
+    if shard_router.enabled:
+        # indexed on the authors' shards
+        messages, next_cursor = shard_router.messages_page(
+            select(*MESSAGE_VIEW_COLUMNS)
+            .join(Mention, Mention.message_id == Message.id)
+            .where(Mention.user_id == user_id),
+            request.args.get('before', type=int))
+    else:
+        messages, next_cursor = paginate_messages(
+            Message.query
+            .join(Mention, Mention.message_id == Message.id)
+            .join(User, Message.user_id == User.id)
+            .filter(Mention.user_id == user_id,
+                    User.deactivated_at.is_(None)))
+
+    return stream_template('users/mentions.html', user=user,
+                           messages=messages, next_cursor=next_cursor)
+
+
+@bp.route('/notifications')
+def notifications():
+    """Show the current user's notifications and mark them all seen."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    notes = inbox(g.user, limit=current_app.config['NOTIFICATIONS_KEEP'])
+
+    # render before committing, so the page still shows which were new
+    mark_all_seen(g.user)
+    html = render_template('users/notifications.html', notifications=notes,
+                           messages=inbox_messages(notes))
+    db.session.commit()
+
+    return html
+
+
+@bp.route('/users/<int:user_id>/export.<fmt>')
+def export_account(user_id, fmt):
+    """Download all of the current user's data as NDJSON or CSV.
+
+    Streamed straight from server-side cursors; nothing is buffered.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+
+    response = Response(streamed(export_user(user_id, fmt)),
+                        mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename="warbler-{g.user.username}.{fmt}"')
+
+    return response
+
+
+@bp.cli.command('export-user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)),
+              default='ndjson', show_default=True)
+@click.option('--output', type=click.File('w'), default='-',
+              help="File to write to (default: stdout).")
+def export_user_command(user_id, fmt, output):
+    """Export a user's messages, likes and follows."""
+
+    for chunk in export_user(user_id, fmt):
+        output.write(chunk)
+
+
+@bp.route('/admin/import', methods=["POST"])
+def import_data():
+    """Bulk-import users, messages, follows and likes (admins only).
+
+    The request body is an NDJSON or CSV stream in the export format
+    (`?format=csv` for CSV); it's read line by line as it arrives.
+    Returns a JSON report of what was imported and which rows failed.
+    """
+
+    if not g.user or not g.user.is_admin:
+        abort(403)
+
+    # the importer writes to the main database only
+    if shard_router.enabled:
+        abort(501)
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in IMPORT_FORMATS:
+        abort(400)
+
+    lines = (line.decode('utf-8') for line in request.stream)
+    report = import_stream(lines, fmt,
+                           batch_size=current_app.config['IMPORT_BATCH_SIZE'])
+
+    # the in-memory follow graph doesn't know about the imported follows,
+    # cached summaries may predate imported profile changes, and the feeds
+    # and permalinks are missing imported messages or show edited ones
+    # with their old text
+    follow_graph.reset()
+    user_summaries.clear()
+    firehose.reset()
+    recent_messages.clear()
+    permalinks.clear()
+
+    return report.to_dict()
+
+
+@bp.cli.command('import-data')
+@click.argument('source', type=click.File('r'))
+@click.option('--format', 'fmt', type=click.Choice(list(IMPORT_FORMATS)),
+              default='ndjson', show_default=True)
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+def import_data_command(source, fmt, batch_size):
+    """Import users, messages, follows and likes from SOURCE ('-' = stdin)."""
+
+    if shard_router.enabled:
+        raise click.ClickException("import-data doesn't support SHARDS yet")
+
+    report = import_stream(source, fmt, batch_size=batch_size)
+
+    for kind, count in report.imported.items():
+        print(f"{kind}: {count} imported")
+    for err in report.errors:
+        print(f"line {err['line']}: {err['error']}")
+    print(f"{report.error_count} errors, {report.rows} rows in "
+          f"{report.elapsed:.2f}s ({report.rows_per_second:,.0f} rows/s)")
+
+
+def refresh_rollups():
+    """Schedule a re-roll of today's activity stats if one is due."""
+
+    if rollups.claim_refresh(current_app.config['ROLLUP_REFRESH_SECONDS']):
+        tasks.enqueue(rollups.refresh)
+
+
+def recent_stats():
+    """The last ?days= days of rollups (default 30, at most 366)."""
+
+    if not g.user or not g.user.is_admin:
+        abort(403)
+
+    days = request.args.get('days', 30, type=int)
+    if not 1 <= days <= 366:
+        abort(400)
+
+    return rollups.recent(days)
+
+
+@bp.route('/admin/stats')
+def admin_stats():
+    """Daily activity and top posters (admins only), from the rollups."""
+
+    return render_template('admin/stats.html', stats=recent_stats())
+
+
+@bp.route('/admin/stats.json')
+def admin_stats_json():
+    """The same daily stats as JSON (admins only)."""
+
+    return {'days': [
+        {**day._asdict(),
+         'day': day.day.isoformat(),
+         'top_posters': [{'user_id': user_id, 'messages': count}
+                         for user_id, count in day.top_posters]}
+        for day in recent_stats()]}
+
+
+@bp.cli.command('rollup-backfill')
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']),
+              help="First day (default: the oldest activity).")
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']),
+              help="Last day (default: today).")
+def rollup_backfill_command(since, until):
+    """Roll up daily activity stats for past days, a day at a time."""
 
+    days = rollups.backfill(since and since.date(), until and until.date())
+    print(f"{days} days rolled up")
 
 
-@app.route('/users/delete', methods=["GET","POST"])
+@bp.route('/admin/admission.json')
+def admin_admission_json():
+    """This worker's queue wait and shed counts (admins only)."""
+
+    if not g.user or not g.user.is_admin:
+        abort(403)
+
+    return admission.stats()
+
+
+@bp.route('/admin/memory.json')
+def admin_memory_json():
+    """Per-route memory profile (admins only; see memprofile.py)."""
+
+    if not g.user or not g.user.is_admin:
+        abort(403)
+
+    if not memory_profiler.enabled:
+        abort(404)
+
+    return {'threshold': memory_profiler.threshold,
+            'routes': memory_profiler.stats()}
+
+
+@bp.route('/users/delete', methods=["GET","POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is hidden right away; its rows are purged in the
+    background in small batches (see deletion.py).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -258,16 +810,66 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    deactivate_user(g.user)
     db.session.commit()
+    firehose.drop_users([g.user.id])
+    recent_messages.invalidate(g.user.id)
+    permalinks.invalidate_user(g.user.id)
+
+    tasks.enqueue(purge_user, g.user.id)
 
     return redirect("/signup")
 
 
+@bp.cli.command('purge-accounts')
+def purge_accounts():
+    """Finish purging every deleted account (e.g. after a restart)."""
+
+    for user_id in pending_deletions():
+        job = purge_user(user_id)
+        print(f"user #{user_id}: {job.rows_deleted} rows deleted")
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+def paginate_messages(query, per_page=100):
+    """Newest-first page of `query`'s messages, plus the cursor for the next.
+
+    Message ids are time-ordered (see ids.py), so this sorts and pages on
+    the primary key: the `before` query-string param is the id of the
+    last message already shown. Cursor is None on the last page.
+
+    Only the card's columns are loaded; messages come back as
+    `MessageView`s, not model instances.
+    """
+
+    before = request.args.get('before', type=int)
+    if before is not None:
+        query = query.filter(Message.id < before)
+
+    return message_page(query
+                        .with_entities(*MESSAGE_VIEW_COLUMNS)
+                        .order_by(Message.id.desc())
+                        .limit(per_page + 1), per_page)
+
+
+def message_page(rows, per_page):
+    """Page of `per_page` MessageViews, plus the cursor for the next.
+
+    `rows` are MESSAGE_VIEW_COLUMNS rows, newest first, fetched with a
+    limit of `per_page + 1`: the extra row only says there's a next page.
+    """
+
+    messages = [MessageView(*row) for row in rows]
+
+    if len(messages) > per_page:
+        return messages[:per_page], messages[per_page - 1].id
+
+    return messages, None
+
+
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -281,24 +883,115 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        enforce_rate_limit('message')
+
+        if shard_router.enabled:
+            msg, mentioned = shard_router.add_message(g.user.id,
+                                                      form.text.data)
+        else:
+            msg = Message(text=form.text.data)
+            g.user.messages.append(msg)
+            db.session.flush()
+            mentioned = index_messages([(msg.id, msg.text)])
+            db.session.commit()
+        firehose.push(msg)
+        recent_messages.add(msg)
+        refresh_rollups()
+
+        if mentioned:
+            config = current_app.config
+            tasks.enqueue(notify_mentions, msg.id,
+                          keep=config['NOTIFICATIONS_KEEP'],
+                          max_mentions=config['NOTIFY_MAX_MENTIONS'])
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/tags/<tag>')
+def messages_tagged(tag):
+    """Messages with #tag, newest first."""
+
+    tag = tag.lower()
+
+    if shard_router.enabled:
+        messages, next_cursor = shard_router.messages_page(
+            select(*MESSAGE_VIEW_COLUMNS)
+            .join(MessageTag, MessageTag.message_id == Message.id)
+            .where(MessageTag.tag == tag),
+            request.args.get('before', type=int))
+    else:
+        messages, next_cursor = paginate_messages(
+            Message.query
+            .join(MessageTag, MessageTag.message_id == Message.id)
+            .join(User, Message.user_id == User.id)
+            .filter(MessageTag.tag == tag, User.deactivated_at.is_(None)))
+
+    return stream_template('messages/tag.html', tag=tag, messages=messages,
+                           next_cursor=next_cursor)
+
+
+@bp.cli.command('index-messages')
+def index_messages_command():
+    """Rebuild the @mention and #hashtag index from every message."""
+
+    if shard_router.enabled:
+        for shard in shard_router.names:
+            with shard_router.session(shard) as session:
+                print(f"{shard}: {reindex_messages(session=session)} "
+                      f"messages indexed")
+    else:
+        print(f"{reindex_messages()} messages indexed")
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message.
+
+    Served from the permalink cache, so a viral message costs one load
+    every few seconds however many people are viewing it.
+    """
+
+    msg = permalinks.get(message_id, lambda: load_permalink(message_id))
+
+    if msg is None:
+        abort(404)
 
-    msg = Message.query.get(message_id)
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+def load_permalink(message_id):
+    """Permalink for a hot or archived message, or None if it's not shown."""
+
+    if shard_router.enabled:
+        row = shard_router.find_message(message_id)
+        if row is not None and not active_user_ids([row.user_id]):
+            row = None
+    else:
+        row = db.session.execute(
+            select(Message.id, Message.text, Message.timestamp,
+                   Message.user_id, Message.like_count)
+            .join(User, User.id == Message.user_id)
+            .where(Message.id == message_id,
+                   User.deactivated_at.is_(None))).first()
+
+    if row is not None:
+        return Permalink(*row, archived=False)
+
+    msg = message_router.find_archived(message_id)
+    if msg is None:
+        return None
+
+    author = User.query.get(msg.user_id)
+    if author is None or author.is_deactivated:
+        return None
+
+    return Permalink(msg.id, msg.text, msg.timestamp, msg.user_id,
+                     msg.like_count, archived=True)
+
+
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -306,18 +999,75 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    
-    if msg.user_id != g.user.id:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+    if shard_router.enabled:
+        # only the author's own shard can hold a message they may delete
+        if not shard_router.delete_message(g.user.id, message_id):
+            abort(404)
 
-    db.session.delete(msg)
-    db.session.commit()
+    else:
+        msg = Message.query.get_or_404(message_id)
+
+        if msg.user_id != g.user.id:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        db.session.delete(msg)
+        db.session.commit()
+
+    permalinks.invalidate(message_id)
+    firehose.remove(message_id)
+    recent_messages.remove(g.user.id, message_id)
 
     return redirect(f"/users/{g.user.id}")
 
-@app.route('/users/add_like/<int:message_id>', methods=['POST'])
+@bp.cli.command('ensure-partitions')
+@click.option('--months-ahead', default=3, show_default=True)
+def ensure_partitions_command(months_ahead):
+    """Create upcoming monthly partitions of messages (PostgreSQL)."""
+
+    with db.engine.begin() as connection:
+        ensure_partitions(connection, months_ahead=months_ahead)
+
+
+@bp.cli.command('archive-messages')
+@click.option('--older-than-days', default=90, show_default=True)
+def archive_messages_command(older_than_days):
+    """Move whole months of old messages into the compressed archive."""
+
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    for record in archive_before(cutoff):
+        print(f"{record.name}: {record.row_count} messages archived")
+
+
+@bp.cli.command('shard-create')
+def shard_create_command():
+    """Create the sharded tables on every configured shard."""
+
+    shard_router.create_all()
+    print(f"shards ready: {', '.join(shard_router.names)}")
+
+
+@bp.cli.command('shard-pin-users')
+def shard_pin_users_command():
+    """Record every user's current shard (run before adding shards)."""
+
+    print(f"{shard_router.pin_users()} users pinned")
+
+
+@bp.cli.command('shard-move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+def shard_move_user_command(user_id, shard):
+    """Move one user's messages, likes and follows to SHARD."""
+
+    if shard not in shard_router.names:
+        raise click.BadParameter(f"unknown shard {shard!r}")
+
+    rows = shard_router.move_user(user_id, shard)
+    print(f"user #{user_id}: {rows} rows moved to {shard}")
+
+
+@bp.route('/users/add_like/<int:message_id>', methods=['POST'])
 def like_message(message_id):
     """ Like a message """
 
@@ -325,27 +1075,91 @@ def like_message(message_id):
         flash("Please log in first!", 'danger')
         return redirect('/')
 
-    msg = Message.query.get_or_404(message_id)
-    user = User.query.get(g.user.id)
-    if msg.user.id == user.id:
+    enforce_rate_limit('like')
+
+    if shard_router.enabled:
+        msg = shard_router.find_message(message_id)
+        if msg is None:
+            abort(404)
+    else:
+        msg = Message.query.get_or_404(message_id)
+
+    if msg.user_id == g.user.id:
         flash("You can't like your own message, silly!", 'warning')
         return redirect(f'/')
 
-    likes = g.user.likes
-
-    if msg in likes:
-        g.user.likes = [like for like in likes if like != msg]
+    if shard_router.enabled:
+        delta, liked_at = shard_router.toggle_like(g.user.id, msg)
 
-    # list comprehension here is building list of all messages that are NOT current message
-    # ie, creating new list of likes without current msg (unliking message)
     else:
-        like = Likes(user_id=g.user.id, message_id=msg.id)
-        db.session.add(like)
+        like = Likes.query.get((g.user.id, msg.id))
+
+        if like is not None:
+            # take it off the bucket the like was counted in
+            delta, liked_at = -1, like.timestamp
+            db.session.delete(like)
+        else:
+            delta, liked_at = +1, None
+            db.session.add(Likes(user_id=g.user.id, message_id=msg.id))
+
+        Message.adjust_like_counts([msg.id], delta)
         db.session.commit()
 
+    recent_messages.adjust_like_count(msg.user_id, msg.id, delta)
+    firehose.adjust_like_count(msg.id, delta)
+    trending.record(msg.id, delta, when=liked_at)
+
+    if delta > 0:
+        tasks.enqueue(notify_like, msg.id, g.user.id,
+                      keep=current_app.config['NOTIFICATIONS_KEEP'])
+
+    refresh_trending()
+    refresh_rollups()
+
     return redirect(f'/')
 
-# @app.route('/messages/<int:message_id>/unlike', methods='POST')
+
+def refresh_trending():
+    """Schedule a compaction of the trending counters if one is due."""
+
+    interval = current_app.config['TRENDING_COMPACT_INTERVAL']
+    if trending.claim_compaction(interval):
+        tasks.enqueue(trending.compact)
+
+
+@bp.route('/messages/trending')
+def messages_trending():
+    """Most-liked messages over the last hour, day or week.
+
+    Reads the precomputed top-N list from memory; the only query is
+    fetching those messages by primary key.
+    """
+
+    window = request.args.get('window', '24h')
+    if window not in WINDOWS:
+        abort(404)
+
+    refresh_trending()
+
+    ranked = trending.top(window)
+    ids = [message_id for message_id, _ in ranked]
+    if shard_router.enabled:
+        found = {msg.id: msg for msg in drop_deactivated(
+            shard_router.find_messages(ids).values())}
+    else:
+        found = {row.id: MessageView(*row) for row in db.session.execute(
+            select(*MESSAGE_VIEW_COLUMNS)
+            .join(User, User.id == Message.user_id)
+            .where(Message.id.in_(ids), User.deactivated_at.is_(None)))
+        } if ids else {}
+
+    messages = [(found[message_id], count)
+                for message_id, count in ranked if message_id in found]
+
+    return stream_template('messages/trending.html', messages=messages,
+                           window=window, windows=list(WINDOWS))
+
+# @bp.route('/messages/<int:message_id>/unlike', methods='POST')
 # def unlike_message(message_id):
 #     """ Remove a like """
 
@@ -365,32 +1179,131 @@ def like_message(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
-def homepage():
-    """Show homepage:
+def who_to_follow(user, limit=5):
+    """Friend-of-friend follow suggestions for `user`.
 
-    - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    Served from the in-memory follow graph; returns nothing until the
+    graph has finished its first load.
     """
 
-    if g.user:
+    follow_graph.ensure_loaded(tasks)
+    if not follow_graph.loaded:
+        return []
+
+    # ask for extra in case some have since deleted their accounts
+    ids = follow_graph.suggest(
+        user.id,
+        limit=limit * 2,
+        max_fanout=current_app.config['FOLLOW_GRAPH_MAX_FANOUT'])
+
+    if not ids:
+        return []
+
+    active = set(db.session.execute(
+        select(User.id)
+        .where(User.id.in_(ids), User.deactivated_at.is_(None))).scalars())
+
+    return summaries_in_order([uid for uid in ids if uid in active][:limit])
+
+
+FEEDS = ('following', 'global')
+
+
+def following_feed(user, per_page=100):
+    """Page of messages by `user` and the people they follow.
+
+    One query, driven from `follows` (ix_follows_following_timestamp):
+    for each followed user a LATERAL subquery reads just their newest
+    `per_page + 1` messages off ix_messages_user_id_id, and the user's
+    own are read the same way. So each page view merges at most
+    (follows + 1) * (per_page + 1) rows, however long the histories.
+    Pages by id like `paginate_messages()`.
+    """
+
+    before = request.args.get('before', type=int)
+
+    def newest(*criteria):
+        query = (select(*MESSAGE_VIEW_COLUMNS)
+                 .where(*criteria)
+                 .order_by(Message.id.desc())
+                 .limit(per_page + 1))
+        if before is not None:
+            query = query.where(Message.id < before)
+        return query
+
+    latest = newest(
+        Message.user_id == Follows.user_being_followed_id).lateral()
+    followed = (select(latest)
+                .select_from(Follows)
+                .join(User, User.id == Follows.user_being_followed_id)
+                .join(latest, true())
+                .where(Follows.user_following_id == user.id,
+                       Follows.user_being_followed_id != user.id,
+                       User.deactivated_at.is_(None)))
+    own = newest(Message.user_id == user.id).subquery()
+
+    feed = union_all(followed, select(own)).subquery()
 
-        if g.user:
-            following_ids = [f.id for f in g.user.following] + [g.user.id]
+    return message_page(db.session.execute(
+        select(feed).order_by(feed.c.id.desc()).limit(per_page + 1)),
+        per_page)
 
 
-    # List comprehension is saying pull out id for each user (f) that user (g.user) is following
-    # concatenated with id of user themselves. This is used by the '.in_' method in the filter
-    # method below to iterate through and grab all messages with those user ids.
+def global_feed():
+    """Page of everyone's messages, served from the firehose buffer."""
 
-        messages = (Message
-                    .query
-                    # .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+    if firehose.claim_refresh(current_app.config['FIREHOSE_REFRESH_SECONDS']):
+        tasks.enqueue(firehose.refresh)
 
-        return render_template('home.html', messages=messages, likes=g.user.likes)
+    page = firehose.page(request.args.get('before', type=int))
+    if page is not None:
+        return page
+
+    if shard_router.enabled:
+        return shard_router.messages_page(
+            select(*MESSAGE_VIEW_COLUMNS),
+            request.args.get('before', type=int))
+
+    return paginate_messages(
+        Message
+        .query
+        .join(Message.user)
+        .filter(User.deactivated_at.is_(None)))
+
+
+@bp.route('/')
+def homepage():
+    """Show homepage:
+
+    - anon users: no messages
+    - logged in: 100 most recent messages of followed users and their
+      own (?feed=following, the default), or of everyone (?feed=global)
+    """
+
+    if g.user:
+
+        feed = request.args.get('feed', 'following')
+        if feed not in FEEDS:
+            abort(404)
+
+        if feed == 'global':
+            messages, next_cursor = global_feed()
+        elif shard_router.enabled:
+            messages, next_cursor = shard_router.following_feed(
+                g.user.id, before=request.args.get('before', type=int))
+        else:
+            messages, next_cursor = following_feed(g.user)
+
+        # which of this page's messages the user has liked, off the likes key
+        liked_ids = set(shard_router.scalars_for(g.user.id,
+            select(Likes.message_id)
+            .where(Likes.user_id == g.user.id,
+                   Likes.message_id.in_([msg.id for msg in messages]))))
+
+        return stream_template('home.html', feed=feed, messages=messages,
+                               liked_ids=liked_ids,
+                               suggestions=who_to_follow(g.user),
+                               next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
@@ -403,12 +1316,27 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Also compresses the response (see compression.py) and, for whole
+    (non-streamed) pages, tags it with an ETag so a browser revalidating
+    an unchanged page gets a 304 instead of the body. The ETag is taken
+    after compression, so each encoding gets its own.
+    """
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
+
+    compress_response(req, current_app.config)
+
+    if (request.method in ('GET', 'HEAD') and req.status_code == 200
+            and not req.is_streamed):
+        if req.get_etag()[0] is None:
+            req.add_etag()
+        req.make_conditional(request)
+
     return req
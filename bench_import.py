@@ -0,0 +1,100 @@
+"""Measure bulk import throughput (see importer.py).
+
+Generates a synthetic NDJSON or CSV stream of users, messages, follows
+and likes in memory and imports it into an empty database. Run like:
+
+    python bench_import.py [--rows 500000] [--format csv] [--batch-size 5000]
+
+Uses an in-memory SQLite database unless DATABASE_URL is set; point it
+at a scratch PostgreSQL database to measure the production path.
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import create_app
+from export import CSV_FIELDS, to_ndjson
+from flask_bcrypt import generate_password_hash
+from importer import import_stream
+from models import db
+
+
+def synthetic_records(rows, seed=0):
+    """About `rows` records: 1% users, 40% messages, 20% follows, 39% likes."""
+
+    rand = random.Random(seed)
+    password = generate_password_hash('password').decode('UTF-8')
+    start = datetime(2024, 1, 1)
+
+    n_users = max(rows // 100, 2)
+    n_messages = rows * 40 // 100
+    n_follows = rows * 20 // 100
+    n_likes = rows - n_users - n_messages - n_follows
+
+    for user_id in range(1, n_users + 1):
+        yield {'type': 'user', 'id': user_id, 'username': f"user{user_id}",
+               'email': f"user{user_id}@example.com", 'password': password}
+
+    for message_id in range(1, n_messages + 1):
+        yield {'type': 'message', 'id': message_id,
+               'user_id': rand.randint(1, n_users),
+               'text': f"message number {message_id}",
+               'timestamp': (start + timedelta(seconds=message_id)).isoformat()}
+
+    follows = set()
+    while len(follows) < n_follows:
+        follows.add((rand.randint(1, n_users), rand.randint(1, n_users)))
+    for user_id, followed_id in follows:
+        if user_id != followed_id:
+            yield {'type': 'follow', 'user_id': user_id,
+                   'followed_id': followed_id}
+
+    likes = set()
+    while len(likes) < n_likes:
+        likes.add((rand.randint(1, n_users), rand.randint(1, n_messages)))
+    for user_id, message_id in likes:
+        yield {'type': 'like', 'user_id': user_id, 'message_id': message_id,
+               'timestamp': (start + timedelta(days=30)).isoformat()}
+
+
+def to_csv(records):
+    """Like export.to_csv(), plus the password column user rows need."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS + ['password'], restval='')
+    writer.writeheader()
+    writer.writerows(records)
+    return [buffer.getvalue()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=500_000)
+    parser.add_argument('--format', choices=['ndjson', 'csv'],
+                        default='ndjson')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    serialise = to_ndjson if args.format == 'ndjson' else to_csv
+    lines = ''.join(serialise(synthetic_records(args.rows))).splitlines(True)
+
+    app = create_app('test')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        report = import_stream(lines, args.format, batch_size=args.batch_size)
+
+    print(json.dumps(report.to_dict() | {'errors': report.errors[:5]},
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
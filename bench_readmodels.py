@@ -0,0 +1,117 @@
+"""Measure what read models save per page (see readmodels.py).
+
+Loads one 100-item page of messages and of users both ways -- as model
+instances and as the column-only namedtuples the list routes use -- and
+reports time per page and the memory the page holds on to. Run like:
+
+    python bench_readmodels.py [--pages 200] [--per-page 100]
+
+Uses an in-memory SQLite database unless DATABASE_URL is set.
+"""
+
+import argparse
+import os
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import select
+
+from app import create_app
+from models import db, User, Message
+from readmodels import (MessageView, MESSAGE_VIEW_COLUMNS, UserSummary,
+                        USER_SUMMARY_COLUMNS)
+
+
+def seed(per_page):
+    start = datetime(2024, 1, 1)
+    db.session.add_all([
+        User(id=n, username=f"user{n}", email=f"user{n}@example.com",
+             password="x", bio="a short bio " * 5)
+        for n in range(1, per_page + 1)])
+    db.session.add_all([
+        Message(id=n, user_id=n % per_page + 1, text="w" * 100,
+                timestamp=start + timedelta(seconds=n))
+        for n in range(1, per_page * 2 + 1)])
+    db.session.commit()
+
+
+def message_models(n):
+    return Message.query.order_by(Message.id.desc()).limit(n).all()
+
+
+def message_views(n):
+    rows = db.session.execute(
+        select(*MESSAGE_VIEW_COLUMNS).order_by(Message.id.desc()).limit(n))
+    return [MessageView(*row) for row in rows]
+
+
+def user_models(n):
+    return User.query.order_by(User.id).limit(n).all()
+
+
+def user_summaries(n):
+    rows = db.session.execute(
+        select(*USER_SUMMARY_COLUMNS).order_by(User.id).limit(n))
+    return [UserSummary(*row) for row in rows]
+
+
+LOADERS = {
+    'messages': {'models': message_models, 'read models': message_views},
+    'users': {'models': user_models, 'read models': user_summaries},
+}
+
+
+def measure(load, per_page, pages):
+    """(median ms per page, bytes held by one loaded page)."""
+
+    times = []
+    for _ in range(pages):
+        # a fresh session per page, as each request gets
+        db.session.remove()
+        started = time.perf_counter()
+        load(per_page)
+        times.append((time.perf_counter() - started) * 1000)
+
+    db.session.remove()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    page = load(per_page)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    held = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del page
+    return statistics.median(times), held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--per-page', type=int, default=100)
+    args = parser.parse_args()
+
+    app = create_app('test')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(args.per_page)
+
+        print(f"{args.per_page} items per page, median of {args.pages} pages")
+        for kind, loaders in LOADERS.items():
+            results = {name: measure(load, args.per_page, args.pages)
+                       for name, load in loaders.items()}
+            for name, (ms, held) in results.items():
+                print(f"  {kind:<9} {name:<12} {ms:7.2f} ms "
+                      f"{held / 1024:8.1f} KiB held")
+
+            (model_ms, model_held), (view_ms, view_held) = results.values()
+            print(f"  {kind:<9} {'saved':<12} {model_ms - view_ms:7.2f} ms "
+                  f"{(model_held - view_held) / 1024:8.1f} KiB")
+
+
+if __name__ == '__main__':
+    main()
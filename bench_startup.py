@@ -0,0 +1,59 @@
+"""Measure Warbler's cold start: import -> create_app -> first response.
+
+Each run is a fresh interpreter, so imports and template compilation are
+really cold (apart from the on-disk Jinja bytecode cache, which is the
+point of having it). Run like:
+
+    python bench_startup.py [--profile prod] [--runs 10]
+
+Uses an in-memory SQLite database unless DATABASE_URL is set.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = r'''
+import json, sys, time
+t0 = time.perf_counter()
+from app import create_app
+t1 = time.perf_counter()
+app = create_app(sys.argv[1])
+t2 = time.perf_counter()
+resp = app.test_client().get('/login')
+resp.get_data()
+t3 = time.perf_counter()
+assert resp.status_code == 200, resp.status_code
+print(json.dumps({'import': t1 - t0, 'create_app': t2 - t1,
+                  'first_response': t3 - t2, 'total': t3 - t0}))
+'''
+
+
+def run_once(profile):
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite://')
+    out = subprocess.run([sys.executable, '-c', CHILD, profile],
+                         env=env, check=True, capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profile', default='prod')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_once(args.profile) for _ in range(args.runs)]
+
+    print(f"profile={args.profile} runs={args.runs} (median / max, ms)")
+    for phase in ('import', 'create_app', 'first_response', 'total'):
+        times = [run[phase] * 1000 for run in runs]
+        print(f"  {phase:<15} {statistics.median(times):8.1f} {max(times):8.1f}")
+
+
+if __name__ == '__main__':
+    main()
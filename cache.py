@@ -0,0 +1,412 @@
+"""Caching for Warbler.
+
+- `LRUCache` is a small thread-safe in-process LRU with per-entry expiry.
+
+- `LocalSharedCache` stands in for an out-of-process cache such as
+  memcached. It has the same get_many / set_many / delete_many API as
+  pymemcache's client and stores bytes, so the code using it doesn't
+  change when a real server takes its place.
+
+- `user_summaries` serves the small bundle of user fields every message
+  list and user card shows (see readmodels.py). Lookups go to the
+  in-process LRU, then the shared tier (if configured), then the
+  database, with one query for all the misses. `profile()` invalidates
+  a user's entry; other processes' LRUs catch up within USER_CACHE_TTL.
+
+- `permalinks` holds snapshots of messages for their permalink pages. It
+  is a `SingleFlightCache`: when a hot key is missing, only one request
+  loads it while the others wait for that result, and once an entry goes
+  stale it is still served while a single background task refreshes it.
+  `messages_destroy()` invalidates the deleted message's entry, and
+  deactivating or purging an account drops every entry of that user's.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import select
+
+from models import db, User
+from readmodels import UserSummary, USER_SUMMARY_COLUMNS
+from tasks import tasks
+from tracing import tracer
+
+
+class LRUCache:
+    """In-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=10000, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, keys):
+        """{key: value} for the keys present and not yet expired."""
+
+        now = self.clock()
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires <= now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                found[key] = value
+
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+
+        expires = self.clock() + ttl
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (expires, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LocalSharedCache:
+    """In-memory stand-in for a memcached-style shared cache.
+
+    Values must be bytes; `expire` is in seconds (0 = never).
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = self.clock()
+        with self._lock:
+            return {key: entry[1] for key in keys
+                    if (entry := self._data.get(key))
+                    and (entry[0] is None or entry[0] > now)}
+
+    def set_many(self, values, expire=0):
+        expires = self.clock() + expire if expire else None
+        with self._lock:
+            for key, value in values.items():
+                if not isinstance(value, bytes):
+                    raise TypeError("shared cache values must be bytes")
+                self._data[key] = (expires, value)
+        return []
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+        return True
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+class UserSummaryCache:
+    """Two-tier cache of `UserSummary`s keyed by user id."""
+
+    key_prefix = 'user-summary:'
+
+    def __init__(self):
+        self.local = LRUCache()
+        self.shared = None
+        self.shared_ttl = 0
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        # in-process tier; also bounds how stale other processes can be
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        # None, 'local' (the in-memory stand-in), or a client with
+        # pymemcache's get_many / set_many / delete_many
+        app.config.setdefault('USER_CACHE_SHARED', None)
+        app.config.setdefault('USER_CACHE_SHARED_TTL', 600)
+
+        self.local = LRUCache(app.config['USER_CACHE_SIZE'],
+                              app.config['USER_CACHE_TTL'])
+
+        shared = app.config['USER_CACHE_SHARED']
+        self.shared = LocalSharedCache() if shared == 'local' else shared
+        self.shared_ttl = app.config['USER_CACHE_SHARED_TTL']
+
+        app.extensions['user_summaries'] = self
+
+    def _key(self, user_id):
+        return f"{self.key_prefix}{user_id}"
+
+    def get_many(self, user_ids):
+        """{user id: UserSummary} for the given ids (unknown ids left out)."""
+
+        user_ids = set(user_ids)
+        with tracer.span('cache user_summaries',
+                         **{'cache.keys': len(user_ids)}) as span:
+            return self._lookup(user_ids, span)
+
+    def _lookup(self, user_ids, span):
+        found = self.local.get_many(user_ids)
+        missing = user_ids - found.keys()
+
+        if missing and self.shared is not None:
+            hits = self.shared.get_many([self._key(uid) for uid in missing])
+            from_shared = {}
+            for key, value in hits.items():
+                summary = UserSummary(*json.loads(value))
+                from_shared[summary.id] = summary
+            self.local.set_many(from_shared)
+            found.update(from_shared)
+            missing -= from_shared.keys()
+
+        if missing:
+            if span is not None:
+                span.set_attribute('cache.db_lookups', len(missing))
+            from_db = {row.id: UserSummary(*row) for row in db.session.execute(
+                select(*USER_SUMMARY_COLUMNS)
+                .where(User.id.in_(missing)))}
+            self.local.set_many(from_db)
+            if self.shared is not None and from_db:
+                self.shared.set_many(
+                    {self._key(uid): json.dumps(summary).encode()
+                     for uid, summary in from_db.items()},
+                    expire=self.shared_ttl)
+            found.update(from_db)
+
+        return found
+
+    def get(self, user_id):
+        """The UserSummary for `user_id`, or None."""
+
+        return self.get_many([user_id]).get(user_id)
+
+    def invalidate(self, user_id):
+        """Forget a user's summary (call after their profile changes)."""
+
+        self.local.delete(user_id)
+        if self.shared is not None:
+            self.shared.delete_many([self._key(user_id)])
+
+    def clear(self):
+        """Forget every summary held in this process."""
+
+        self.local.clear()
+
+
+user_summaries = UserSummaryCache()
+
+
+class _Flight:
+    """One in-progress load that other callers can wait on."""
+
+    __slots__ = ('done', 'value', 'error', 'cancelled')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.cancelled = False
+
+
+def _note(span, result):
+    """Record how a traced lookup was answered."""
+
+    if span is not None:
+        span.set_attribute('cache.result', result)
+
+
+class SingleFlightCache:
+    """Read-through cache with request coalescing and stale-while-revalidate.
+
+    An entry is fresh for `ttl` seconds, then stale for `stale_ttl` more.
+    Stale entries are returned straight away while one refresh runs via
+    `spawn(fn)`. A missing (or too old) key is loaded by the first caller;
+    concurrent callers for the same key wait for its result instead of
+    running their own load. Loader exceptions reach every waiting caller
+    and nothing is cached.
+    """
+
+    # names its lookups in traces
+    name = 'single_flight'
+
+    def __init__(self, maxsize=10000, ttl=5, stale_ttl=60, spawn=None,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.spawn = spawn or self._spawn_thread
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _spawn_thread(fn):
+        threading.Thread(target=fn, daemon=True).start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, loader):
+        """The cached value for `key`, calling `loader()` on a miss."""
+
+        with tracer.span(f'cache {self.name}') as span:
+            return self._get(key, loader, span)
+
+    def _get(self, key, loader, span):
+        refresh = None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fresh_until, stale_until = entry
+                now = self.clock()
+
+                if now < fresh_until:
+                    self._entries.move_to_end(key)
+                    _note(span, 'hit')
+                    return value
+
+                if now < stale_until:
+                    if key not in self._flights:
+                        refresh = self._flights[key] = _Flight()
+                    entry_value = value
+                else:
+                    entry = None
+
+            if entry is None:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+
+        if entry is not None:
+            if refresh is not None:
+                self.spawn(lambda: self._load(key, loader, refresh))
+            _note(span, 'stale')
+            return entry_value
+
+        if leader:
+            _note(span, 'miss')
+            self._load(key, loader, flight)
+        else:
+            _note(span, 'coalesced')
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key, loader, flight):
+        try:
+            flight.value = loader()
+        except Exception as exc:
+            flight.error = exc
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if flight.error is None and not flight.cancelled:
+                    self._store(key, flight.value)
+            flight.done.set()
+
+    def _store(self, key, value):
+        if self.ttl + self.stale_ttl <= 0 or self.maxsize <= 0:
+            return
+
+        now = self.clock()
+        self._entries[key] = (value, now + self.ttl,
+                              now + self.ttl + self.stale_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop `key`; a load already running for it won't be cached."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+            flight = self._flights.pop(key, None)
+            if flight is not None:
+                flight.cancelled = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for flight in self._flights.values():
+                flight.cancelled = True
+            self._flights.clear()
+
+
+# what a message's permalink page shows
+Permalink = namedtuple(
+    'Permalink', 'id text timestamp user_id like_count archived')
+
+
+class PermalinkCache(SingleFlightCache):
+    """Coalescing cache of `Permalink`s (or None) keyed by message id."""
+
+    name = 'permalinks'
+
+    def init_app(self, app):
+        app.config.setdefault('PERMALINK_CACHE_SIZE', 10000)
+        app.config.setdefault('PERMALINK_CACHE_TTL', 5)
+        app.config.setdefault('PERMALINK_CACHE_STALE_TTL', 60)
+
+        self.maxsize = app.config['PERMALINK_CACHE_SIZE']
+        self.ttl = app.config['PERMALINK_CACHE_TTL']
+        self.stale_ttl = app.config['PERMALINK_CACHE_STALE_TTL']
+        # refreshes need the database, so they run as background tasks
+        self.spawn = tasks.enqueue
+
+        app.extensions['permalinks'] = self
+
+    def invalidate_user(self, user_id):
+        """Drop every cached message by `user_id`.
+
+        Loads still running are for messages whose author isn't known
+        yet, so none of those are cached either.
+        """
+
+        with self._lock:
+            for key, (value, _, _) in list(self._entries.items()):
+                if value is not None and value.user_id == user_id:
+                    del self._entries[key]
+            for flight in self._flights.values():
+                flight.cancelled = True
+            self._flights.clear()
+
+
+permalinks = PermalinkCache()
@@ -0,0 +1,139 @@
+"""Response compression: gzip, plus brotli when the `brotli` package is
+installed.
+
+`add_header()` calls `compress_response()` for every response. The
+encoding is negotiated from Accept-Encoding (brotli preferred on a tie),
+and only text-like types in COMPRESS_MIMETYPES are touched, so images
+and other already-compressed files go out as they are.
+
+- Whole responses under COMPRESS_MIN_SIZE bytes aren't worth it and are
+  left alone.
+- Streamed responses (see rendering.py) are compressed chunk by chunk,
+  flushing after each one so the page still arrives as it renders.
+- A response that already carries an ETag gets the encoding appended to
+  it, since the compressed body is a different representation.
+"""
+
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson',
+    'image/svg+xml',
+}
+
+
+def init_compression(app):
+    """Register compression defaults on `app`."""
+
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    # 4-5 is brotli's sweet spot for pages compressed on every request
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+    app.config.setdefault('COMPRESS_MIMETYPES', COMPRESSIBLE_MIMETYPES)
+
+
+class _Gzip:
+    def __init__(self, level):
+        # wbits=31: gzip container rather than a bare zlib stream
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self, quality):
+        self._b = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._b.process(data)
+
+    def flush(self):
+        return self._b.flush()
+
+    def finish(self):
+        return self._b.finish()
+
+
+def _compressor(encoding, config):
+    if encoding == 'br':
+        return _Brotli(config['COMPRESS_BROTLI_QUALITY'])
+    return _Gzip(config['COMPRESS_GZIP_LEVEL'])
+
+
+def _stream(chunks, compressor):
+    """Compress an iterable of chunks, flushing after each one."""
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def negotiate():
+    """The encoding to use for this request: 'br', 'gzip' or None."""
+
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress_response(response, config):
+    """Compress `response` in place if the client and content allow it."""
+
+    if (response.mimetype not in config['COMPRESS_MIMETYPES']
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    # a cache must keep each encoding separately
+    response.vary.add('Accept-Encoding')
+
+    if response.status_code != 200:
+        return response
+
+    encoding = negotiate()
+    if encoding is None:
+        return response
+
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = _stream(response.response,
+                                    _compressor(encoding, config))
+        response.headers.pop('Content-Length', None)
+    else:
+        # e.g. static files from send_file()
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+
+        compressor = _compressor(encoding, config)
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+
+    return response
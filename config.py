@@ -0,0 +1,75 @@
+"""Configuration profiles for Warbler.
+
+Pick one with `create_app('dev' | 'test' | 'prod')`, or set WARBLER_CONFIG
+for the lazily-built `app.app` (used by `flask run` and the tests).
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    # filled from DATABASE_URL when the app is created, so the tests can
+    # point it at their own database before importing the app
+    SQLALCHEMY_DATABASE_URI = None
+    DEFAULT_DATABASE_URL = 'postgresql:///warbler'
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # only the dev profile loads Flask-DebugToolbar
+    DEBUG_TOOLBAR = False
+
+    TASKS_EAGER = False
+
+    # notifications kept per user, and users one message can notify
+    NOTIFICATIONS_KEEP = 100
+    NOTIFY_MAX_MENTIONS = 20
+
+    # rows per transaction for /admin/import
+    IMPORT_BATCH_SIZE = 5000
+
+    # compile every template and open a DB connection in create_app(),
+    # before the worker starts taking requests
+    WARM_UP = False
+
+
+class DevConfig(Config):
+    """Local development: debugger and debug toolbar."""
+
+    DEBUG = True
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+
+class TestConfig(Config):
+    """Unit tests: no CSRF, background tasks run inline."""
+
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    TASKS_EAGER = True
+    # the test client doesn't close streamed bodies before following a
+    # redirect, which pops request contexts out of order
+    STREAM_RESPONSES = False
+    # tests recreate users and messages with the same ids, so don't hold
+    # on to them
+    USER_CACHE_TTL = 0
+    PERMALINK_CACHE_TTL = 0
+    PERMALINK_CACHE_STALE_TTL = 0
+    RECENT_MESSAGES_TTL = 0
+
+
+class ProdConfig(Config):
+    """Production: nothing debug-only, warmed before serving."""
+
+    WARM_UP = True
+
+
+PROFILES = {
+    'dev': DevConfig,
+    'test': TestConfig,
+    'prod': ProdConfig,
+}
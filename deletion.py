@@ -0,0 +1,217 @@
+"""Account deletion for Warbler.
+
+Deleting an account happens in two steps:
+
+1. `deactivate_user()` runs inside the request. It only stamps
+   `users.deactivated_at` and records an `AccountDeletion` job, so the
+   account disappears from the site right away.
+
+2. `purge_user()` runs in the background. It removes the account's likes,
+   follows and messages in bounded batches, committing after each batch
+   and recording progress on the job, and finally deletes the user row.
+   No single transaction ever holds locks on more than `batch_size` rows.
+
+Under sharding the stages in `SHARDED_STAGES` run on the shards instead:
+the user's own messages (with their mentions and tags), likes and
+follows on their shard, and other users' likes of, follows to and
+mentions of them on every shard.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import delete, select, tuple_
+
+from cache import permalinks
+from models import (db, User, Message, Follows, Likes, AccountDeletion,
+                    MessageArchive, Mention, MessageTag, Notification)
+from sharding import shard_router
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def deactivate_user(user):
+    """Hide `user` immediately and queue the purge job.
+
+    Caller is responsible for committing.
+    """
+
+    user.deactivated_at = datetime.utcnow()
+
+    job = AccountDeletion.query.get(user.id)
+    if job is None:
+        job = AccountDeletion(user_id=user.id)
+        db.session.add(job)
+
+    return job
+
+
+def _purge_stages(user_id):
+    """(stage name, table, key columns, where-clause) in deletion order."""
+
+    own_messages = select(Message.id).where(Message.user_id == user_id)
+
+    return [
+        ('likes', Likes.__table__, [Likes.user_id, Likes.message_id],
+         Likes.user_id == user_id),
+        ('likes-received', Likes.__table__, [Likes.user_id, Likes.message_id],
+         Likes.message_id.in_(own_messages)),
+        ('notifications', Notification.__table__, [Notification.id],
+         Notification.user_id == user_id),
+        ('notifications-sent', Notification.__table__, [Notification.id],
+         Notification.actor_id == user_id),
+        ('mentions', Mention.__table__,
+         [Mention.user_id, Mention.message_id],
+         Mention.user_id == user_id),
+        ('mentions-made', Mention.__table__,
+         [Mention.user_id, Mention.message_id],
+         Mention.message_id.in_(own_messages)),
+        ('tags', MessageTag.__table__,
+         [MessageTag.tag, MessageTag.message_id],
+         MessageTag.message_id.in_(own_messages)),
+        ('following', Follows.__table__,
+         [Follows.user_being_followed_id, Follows.user_following_id],
+         Follows.user_following_id == user_id),
+        ('followers', Follows.__table__,
+         [Follows.user_being_followed_id, Follows.user_following_id],
+         Follows.user_being_followed_id == user_id),
+        ('messages', Message.__table__, [Message.id],
+         Message.user_id == user_id),
+        ('archive', MessageArchive.__table__,
+         [MessageArchive.user_id, MessageArchive.max_id],
+         MessageArchive.user_id == user_id),
+    ]
+
+
+def _uncount_likes(keys):
+    # the messages lose one like each (a user likes a message only once)
+    message_ids = [message_id for _, message_id in keys]
+    if shard_router.enabled:
+        shard_router.adjust_like_counts(message_ids, -1)
+    else:
+        Message.adjust_like_counts(message_ids, -1)
+
+
+# run on each batch of keys, in the same transaction as its delete
+BEFORE_DELETE = {
+    'likes': _uncount_likes,
+}
+
+
+def _delete_in_batches(job, table, key_cols, where, batch_size,
+                       before_delete=None, session=None):
+    """Delete rows matching `where` at most `batch_size` at a time.
+
+    On the main database, or through `session` on a shard.
+    """
+
+    session = session or db.session
+
+    while True:
+        keys = session.execute(
+            select(*key_cols).where(where).limit(batch_size)).all()
+
+        if not keys:
+            return
+
+        if len(key_cols) == 1:
+            match = key_cols[0].in_([key for (key,) in keys])
+        else:
+            match = tuple_(*key_cols).in_(keys)
+
+        if before_delete is not None:
+            before_delete(keys)
+
+        session.execute(delete(table).where(match))
+        if session is not db.session:
+            session.commit()
+        job.rows_deleted += len(keys)
+        db.session.commit()
+
+
+def _on_own_shard(job, user_id, table, key_cols, where, batch_size,
+                  before_delete):
+    with shard_router.session_for(user_id) as session:
+        _delete_in_batches(job, table, key_cols, where, batch_size,
+                           before_delete, session)
+
+
+def _on_every_shard(job, user_id, table, key_cols, where, batch_size,
+                    before_delete):
+    for shard in shard_router.names:
+        with shard_router.session(shard) as session:
+            _delete_in_batches(job, table, key_cols, where, batch_size,
+                               before_delete, session)
+
+
+def _likes_received(job, user_id, table, key_cols, where, batch_size,
+                    before_delete):
+    # `where` picks out the user's messages with a subquery only their own
+    # shard can answer, so page through their ids there instead and clear
+    # each page's likes off every shard
+    last_id = 0
+    while True:
+        with shard_router.session_for(user_id) as session:
+            message_ids = session.execute(
+                select(Message.id)
+                .where(Message.user_id == user_id, Message.id > last_id)
+                .order_by(Message.id)
+                .limit(batch_size)).scalars().all()
+
+        if not message_ids:
+            return
+
+        _on_every_shard(job, user_id, table, key_cols,
+                        Likes.message_id.in_(message_ids), batch_size,
+                        before_delete)
+        last_id = message_ids[-1]
+
+
+# where a stage's rows are when shards are configured
+SHARDED_STAGES = {
+    'likes': _on_own_shard,
+    'likes-received': _likes_received,
+    'mentions': _on_every_shard,
+    'mentions-made': _on_own_shard,
+    'tags': _on_own_shard,
+    'following': _on_own_shard,
+    'followers': _on_every_shard,
+    'messages': _on_own_shard,
+}
+
+
+def purge_user(user_id, batch_size=DEFAULT_BATCH_SIZE):
+    """Remove every row belonging to deactivated user `user_id`.
+
+    Safe to re-run: a purge interrupted part-way picks up where it left
+    off, since each stage just deletes whatever rows are still there.
+    """
+
+    job = AccountDeletion.query.get(user_id)
+    if job is None or job.finished_at is not None:
+        return job
+
+    for stage, table, key_cols, where in _purge_stages(user_id):
+        job.stage = stage
+        db.session.commit()
+        if shard_router.enabled and stage in SHARDED_STAGES:
+            SHARDED_STAGES[stage](job, user_id, table, key_cols, where,
+                                  batch_size, BEFORE_DELETE.get(stage))
+        else:
+            _delete_in_batches(job, table, key_cols, where, batch_size,
+                               BEFORE_DELETE.get(stage))
+
+    User.query.filter_by(id=user_id).delete()
+    job.stage = 'done'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    permalinks.invalidate_user(user_id)
+
+    return job
+
+
+def pending_deletions():
+    """User ids whose purge hasn't finished yet."""
+
+    return [job.user_id for job in
+            AccountDeletion.query.filter_by(finished_at=None)]
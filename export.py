@@ -0,0 +1,135 @@
+"""Streaming export of a user's data as NDJSON or CSV.
+
+`iter_records()` yields one dict per row: the user's profile, then their
+messages (archived months first, then the hot table), likes, following
+and followers. Every query is run with `stream_results` (a server-side
+cursor on PostgreSQL) and read `chunk_size` rows at a time, and the
+serialisers are generators too, so memory stays flat no matter how many
+rows an account has. Under sharding the user's own rows come from their
+shard and their followers from every shard in turn (see sharding.py).
+
+The record format is the one `importer.py` reads, except that user
+records leave out the password hash: an export is something users
+download, so it isn't a way to copy an account as-is. To re-import one,
+add a `password` (a bcrypt hash) to its user row first; the message,
+like and follow rows go in unchanged.
+"""
+
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from models import db, User, Message, Likes, Follows
+from partitions import message_router
+from sharding import shard_router
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# CSV columns: the union of every record type's fields
+CSV_FIELDS = ['type', 'id', 'user_id', 'message_id', 'followed_id',
+              'username', 'email', 'image_url', 'header_image_url', 'bio',
+              'location', 'text', 'timestamp']
+
+# no password: see above
+USER_FIELDS = ['id', 'username', 'email', 'image_url', 'header_image_url',
+               'bio', 'location']
+
+
+def _stream(statement, chunk_size, shards=None):
+    """Rows of `statement`, fetched `chunk_size` at a time.
+
+    Run on the main database, or on each of `shards` in turn.
+    """
+
+    if shards is None:
+        yield from db.session.execute(
+            statement, execution_options={'stream_results': True}
+        ).yield_per(chunk_size)
+        return
+
+    for shard in shards:
+        with shard_router.session(shard) as session:
+            yield from session.execute(
+                statement, execution_options={'stream_results': True}
+            ).yield_per(chunk_size)
+
+
+def _iso(when):
+    return when.isoformat() if when is not None else None
+
+
+def iter_records(user_id, chunk_size=1000):
+    """Yield the export records for `user_id`, one dict at a time."""
+
+    user = db.session.execute(
+        select(*[getattr(User, field) for field in USER_FIELDS])
+        .where(User.id == user_id)).one()
+    yield {'type': 'user', **user._asdict()}
+
+    if shard_router.enabled:
+        own, every = [shard_router.shard_for(user_id)], shard_router.names
+    else:
+        own = every = None
+
+    for msg in message_router.iter_archived_user_messages(user_id):
+        yield {'type': 'message', 'id': msg.id, 'user_id': user_id,
+               'text': msg.text, 'timestamp': _iso(msg.timestamp)}
+
+    for msg_id, text, timestamp in _stream(
+            select(Message.id, Message.text, Message.timestamp)
+            .where(Message.user_id == user_id)
+            .order_by(Message.id), chunk_size, own):
+        yield {'type': 'message', 'id': msg_id, 'user_id': user_id,
+               'text': text, 'timestamp': _iso(timestamp)}
+
+    for message_id, timestamp in _stream(
+            select(Likes.message_id, Likes.timestamp)
+            .where(Likes.user_id == user_id), chunk_size, own):
+        yield {'type': 'like', 'user_id': user_id, 'message_id': message_id,
+               'timestamp': _iso(timestamp)}
+
+    for (followed_id,) in _stream(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id), chunk_size, own):
+        yield {'type': 'follow', 'user_id': user_id,
+               'followed_id': followed_id}
+
+    for (follower_id,) in _stream(
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id), chunk_size,
+            every):
+        yield {'type': 'follow', 'user_id': follower_id,
+               'followed_id': user_id}
+
+
+def to_ndjson(records):
+    """One JSON object per line."""
+
+    for record in records:
+        yield json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def to_csv(records):
+    """CSV with a header row; fields a record type lacks are left blank."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS, restval='')
+
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_user(user_id, fmt='ndjson', chunk_size=1000):
+    """Generator of text chunks exporting `user_id` in format `fmt`."""
+
+    serialise = to_ndjson if fmt == 'ndjson' else to_csv
+    return serialise(iter_records(user_id, chunk_size))
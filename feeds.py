@@ -0,0 +1,433 @@
+"""In-memory feeds of recent messages.
+
+- `firehose` is the global feed: a ring buffer of the newest FIREHOSE_SIZE
+  messages from active users, kept in id order. `messages_add()` pushes
+  each new message into it and `messages_destroy()` takes deleted ones
+  out, so the global homepage is served without touching the database.
+
+  The buffer is filled from the database on first use. After that, every
+  FIREHOSE_REFRESH_SECONDS a background task pulls in messages posted by
+  other workers and drops the messages of users who have deactivated
+  since the last refresh. A message deleted in another worker stays
+  until it ages out of the buffer; its permalink already 404s. Like
+  counts are kept current by `like_message()` the same way, except for
+  likes made in other workers, which show up once the message is
+  reloaded.
+
+  Pages that run past the oldest buffered message fall back to the
+  database (`page()` returns None), so paging never dead-ends.
+
+- `recent_messages` holds the first page of users' profiles. Posting,
+  deleting and liking update a cached page in place; users are evicted
+  least recently viewed first once the pages' estimated size passes
+  RECENT_MESSAGES_MAX_BYTES. Entries expire after RECENT_MESSAGES_TTL
+  seconds, which bounds how long changes made in other workers take to
+  show up.
+"""
+
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import select
+
+from ids import TIMESTAMP_SHIFT
+from models import db, User, Message
+from readmodels import MessageView, MESSAGE_VIEW_COLUMNS, message_view
+from sharding import shard_router, drop_deactivated
+from tracing import tracer
+
+
+class Firehose:
+    """Ring buffer of the newest messages, for the global feed."""
+
+    def __init__(self, size=1000, overlap=10):
+        self.size = size
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        app.config.setdefault('FIREHOSE_SIZE', self.size)
+        app.config.setdefault('FIREHOSE_REFRESH_SECONDS', 5)
+        app.config.setdefault('FIREHOSE_REFRESH_OVERLAP_SECONDS', self.overlap)
+        self.size = app.config['FIREHOSE_SIZE']
+        self.overlap = app.config['FIREHOSE_REFRESH_OVERLAP_SECONDS']
+        app.extensions['firehose'] = self
+
+    def reset(self):
+        """Forget every message; the next refresh reloads from scratch."""
+
+        with self._lock:
+            # parallel lists, ascending by id
+            self._ids = []
+            self._items = []
+            self._loaded = False
+            # newest id read from the database; push() doesn't move it
+            self._watermark = None
+            # True while the buffer holds every message there is
+            self._complete = False
+            self._refreshed_at = None
+            self._claimed_at = None
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    ##########################################################################
+    # Updates
+
+    def _insert(self, item):
+        pos = bisect_left(self._ids, item.id)
+        if pos < len(self._ids) and self._ids[pos] == item.id:
+            return
+        self._ids.insert(pos, item.id)
+        self._items.insert(pos, item)
+
+    def _trim(self):
+        excess = len(self._items) - self.size
+        if excess > 0:
+            del self._ids[:excess]
+            del self._items[:excess]
+            self._complete = False
+
+    def push(self, msg):
+        """Add a just-posted message (anything with MessageView's fields).
+
+        Ignored until the buffer has loaded, since loading reads the
+        message back from the database anyway.
+        """
+
+        item = message_view(msg)
+
+        with self._lock:
+            if not self._loaded:
+                return
+            self._insert(item)
+            self._trim()
+
+    def remove(self, message_id):
+        """Take a deleted message out of the feed."""
+
+        with self._lock:
+            pos = bisect_left(self._ids, message_id)
+            if pos < len(self._ids) and self._ids[pos] == message_id:
+                del self._ids[pos]
+                del self._items[pos]
+
+    def adjust_like_count(self, message_id, delta):
+        """Add `delta` to a buffered message's like count."""
+
+        with self._lock:
+            pos = bisect_left(self._ids, message_id)
+            if pos < len(self._ids) and self._ids[pos] == message_id:
+                item = self._items[pos]
+                self._items[pos] = item._replace(
+                    like_count=item.like_count + delta)
+
+    def drop_users(self, user_ids):
+        """Take every message by `user_ids` out of the feed."""
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+
+        with self._lock:
+            keep = [item for item in self._items
+                    if item.user_id not in user_ids]
+            self._items = keep
+            self._ids = [item.id for item in keep]
+
+    def claim_refresh(self, interval):
+        """True at most once per `interval` seconds: time to refresh."""
+
+        with self._lock:
+            now = time.monotonic()
+            if (self._claimed_at is not None
+                    and now - self._claimed_at < interval):
+                return False
+
+            self._claimed_at = now
+            return True
+
+    def refresh(self):
+        """Load the buffer, or catch up with other workers' changes.
+
+        Fetches (at most a buffer's worth of) messages from the last
+        FIREHOSE_REFRESH_OVERLAP_SECONDS before the newest id the previous
+        refresh read, and drops the messages of users deactivated since
+        then. Ids come from each worker's clock and a message commits a
+        little after its id is made, so another worker's message can land
+        below ids already seen; the overlap picks those up, and messages
+        already held are skipped. Under sharding every shard's newest are
+        merged.
+        """
+
+        started = datetime.utcnow()
+
+        with self._lock:
+            loaded = self._loaded
+            watermark = self._watermark
+            since = self._refreshed_at
+
+        query = (select(*MESSAGE_VIEW_COLUMNS)
+                 .order_by(Message.id.desc())
+                 .limit(self.size))
+        if loaded and watermark is not None:
+            overlap = int(self.overlap * 1000) << TIMESTAMP_SHIFT
+            query = query.where(Message.id > watermark - overlap)
+
+        if shard_router.enabled:
+            rows = drop_deactivated([MessageView(*row) for row in
+                                     shard_router.newest(query, self.size)])
+        else:
+            rows = [MessageView(*row) for row in db.session.execute(
+                query.join(User, User.id == Message.user_id)
+                .where(User.deactivated_at.is_(None)))]
+
+        gone = []
+        if loaded and since is not None:
+            gone = db.session.execute(
+                select(User.id).where(User.deactivated_at >= since)).scalars()
+
+        self.drop_users(gone)
+
+        with self._lock:
+            for item in rows:
+                self._insert(item)
+            if rows:
+                self._watermark = max(self._watermark or 0, rows[0].id)
+            if not loaded:
+                self._complete = len(rows) < self.size
+                self._loaded = True
+            self._trim()
+            self._refreshed_at = started
+
+    ##########################################################################
+    # Reads
+
+    def page(self, before=None, per_page=100):
+        """Newest-first page of messages older than `before`, plus cursor.
+
+        Same cursor as `paginate_messages()`. Returns None when the
+        buffer can't answer (not loaded yet, or the page reaches past
+        its oldest message), so the caller can ask the database instead.
+        """
+
+        with self._lock:
+            if not self._loaded:
+                return None
+
+            end = (len(self._ids) if before is None
+                   else bisect_left(self._ids, before))
+            start = max(0, end - per_page)
+            items = self._items[start:end][::-1]
+            more_in_buffer = start > 0
+            complete = self._complete
+
+        if len(items) < per_page and not complete:
+            return None
+
+        more = more_in_buffer or not complete
+        next_cursor = items[-1].id if items and more else None
+
+        return items, next_cursor
+
+
+firehose = Firehose()
+
+
+def _size_of(item):
+    """Rough bytes held by one cached message."""
+
+    return (sys.getsizeof(item) + sys.getsizeof(item.text)
+            + sys.getsizeof(item.timestamp) + sys.getsizeof(item.id))
+
+
+class _Page:
+    """One user's cached profile page, newest first."""
+
+    __slots__ = ('items', 'more', 'expires', 'nbytes')
+
+    def __init__(self, items, more, expires):
+        self.items = items
+        # are there older messages than the last one held?
+        self.more = more
+        self.expires = expires
+        self.nbytes = sum(map(_size_of, items))
+
+
+class RecentMessages:
+    """LRU cache of each user's newest messages, capped by memory."""
+
+    def __init__(self, per_user=100, max_bytes=64 * 1024 * 1024, ttl=30,
+                 clock=time.monotonic):
+        self.per_user = per_user
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._pages = OrderedDict()
+        self._bytes = 0
+        # bumped by every update, so a load that raced one isn't cached
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        # messages per profile page
+        app.config.setdefault('RECENT_MESSAGES_PER_USER', self.per_user)
+        app.config.setdefault('RECENT_MESSAGES_MAX_BYTES', self.max_bytes)
+        app.config.setdefault('RECENT_MESSAGES_TTL', self.ttl)
+        self.per_user = app.config['RECENT_MESSAGES_PER_USER']
+        self.max_bytes = app.config['RECENT_MESSAGES_MAX_BYTES']
+        self.ttl = app.config['RECENT_MESSAGES_TTL']
+        app.extensions['recent_messages'] = self
+
+    def __len__(self):
+        return len(self._pages)
+
+    @property
+    def nbytes(self):
+        """Estimated size of every cached page."""
+
+        return self._bytes
+
+    def get(self, user_id, loader):
+        """(messages, next cursor) for the first page of a user's profile.
+
+        On a miss `loader()` returns the same (as `paginate_messages()`
+        does) and the result is cached.
+        """
+
+        with tracer.span('cache recent_messages') as span:
+            return self._get(user_id, loader, span)
+
+    def _get(self, user_id, loader, span):
+        with self._lock:
+            page = self._pages.get(user_id)
+            if page is not None:
+                if page.expires > self.clock():
+                    self._pages.move_to_end(user_id)
+                    if span is not None:
+                        span.set_attribute('cache.result', 'hit')
+                    return self._result(page)
+                self._drop(user_id)
+            version = self._version
+
+        if span is not None:
+            span.set_attribute('cache.result', 'miss')
+        messages, next_cursor = loader()
+        items = [message_view(msg) for msg in messages]
+        page = _Page(items, next_cursor is not None, self.clock() + self.ttl)
+
+        with self._lock:
+            if (version == self._version and self.ttl > 0
+                    and page.nbytes <= self.max_bytes):
+                self._drop(user_id)
+                self._pages[user_id] = page
+                self._bytes += page.nbytes
+                self._evict()
+
+        return self._result(page)
+
+    @staticmethod
+    def _result(page):
+        items = list(page.items)
+        next_cursor = items[-1].id if items and page.more else None
+        return items, next_cursor
+
+    def _drop(self, user_id):
+        page = self._pages.pop(user_id, None)
+        if page is not None:
+            self._bytes -= page.nbytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._pages:
+            _, page = self._pages.popitem(last=False)
+            self._bytes -= page.nbytes
+
+    ##########################################################################
+    # Updates
+
+    def add(self, msg):
+        """Put a just-posted message at the top of its author's page."""
+
+        item = message_view(msg)
+
+        with self._lock:
+            self._version += 1
+            page = self._pages.get(msg.user_id)
+            if page is None:
+                return
+
+            page.items.insert(0, item)
+            page.nbytes += _size_of(item)
+            self._bytes += _size_of(item)
+
+            if len(page.items) > self.per_user:
+                gone = page.items.pop()
+                page.nbytes -= _size_of(gone)
+                self._bytes -= _size_of(gone)
+                page.more = True
+
+            self._evict()
+
+    def remove(self, user_id, message_id):
+        """Take a deleted message off its author's page."""
+
+        with self._lock:
+            self._version += 1
+            page = self._pages.get(user_id)
+            if page is None:
+                return
+
+            for pos, item in enumerate(page.items):
+                if item.id == message_id:
+                    del page.items[pos]
+                    page.nbytes -= _size_of(item)
+                    self._bytes -= _size_of(item)
+                    break
+
+            # the next older message isn't held, so reload next time
+            if page.more and len(page.items) < self.per_user:
+                self._drop(user_id)
+
+    def adjust_like_count(self, user_id, message_id, delta):
+        """Add `delta` to a cached message's like count."""
+
+        with self._lock:
+            self._version += 1
+            page = self._pages.get(user_id)
+            if page is None:
+                return
+
+            for pos, item in enumerate(page.items):
+                if item.id == message_id:
+                    page.items[pos] = item._replace(
+                        like_count=item.like_count + delta)
+                    break
+
+    def invalidate(self, user_id):
+        """Forget a user's page."""
+
+        with self._lock:
+            self._version += 1
+            self._drop(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._pages.clear()
+            self._bytes = 0
+
+
+recent_messages = RecentMessages()
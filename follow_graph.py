@@ -0,0 +1,292 @@
+"""In-memory follow graph for "who to follow" suggestions.
+
+The `follows` table is held in compressed sparse row (CSR) form: two flat
+integer arrays, where `targets[offsets[u]:offsets[u + 1]]` are the ids of
+the users that user `u` follows. At 4 bytes per edge this keeps hundreds
+of millions of follows in a few GB with no per-edge Python objects.
+
+Follows and unfollows made after the graph was loaded are kept in a small
+overlay of per-user sets (updated by `add_follow` / `stop_following`) and
+folded into the arrays by `compact()` once the overlay grows large.
+Compaction rebuilds the arrays outside the lock: it sets the overlay
+aside (still read, as a second layer) and starts a fresh one for new
+edits, so request threads never wait on the rebuild.
+
+Suggestions are friends-of-friends ranked by how many of the people you
+follow also follow them. The walk is capped at FOLLOW_GRAPH_MAX_FANOUT
+neighbours per hop, so each lookup is bounded regardless of graph size.
+"""
+
+import heapq
+import threading
+from array import array
+from collections import Counter, defaultdict
+from itertools import islice
+
+from sqlalchemy import select, tuple_
+
+from models import db, Follows
+from sharding import shard_router
+
+# 'i' is a C int: 4 bytes, the same range as the users.id Integer column
+ID_TYPECODE = 'i'
+
+
+class FollowGraph:
+    """CSR adjacency of follower -> followed user ids, plus a write overlay."""
+
+    def __init__(self, app=None):
+        self._lock = threading.RLock()
+        self._loading = False
+        self._compacting = False
+        # bumped whenever the arrays are replaced wholesale
+        self._generation = 0
+        self.reset()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        app.config.setdefault('FOLLOW_GRAPH_LOAD_CHUNK', 50000)
+        app.config.setdefault('FOLLOW_GRAPH_MAX_FANOUT', 200)
+        app.config.setdefault('FOLLOW_GRAPH_COMPACT_AFTER', 10000)
+        app.extensions['follow_graph'] = self
+
+    def reset(self):
+        """Drop everything; the graph will be reloaded on next use."""
+
+        with self._lock:
+            self._offsets = array(ID_TYPECODE, [0])
+            self._targets = array(ID_TYPECODE)
+            self._added = defaultdict(set)
+            self._removed = defaultdict(set)
+            # (added, removed) overlay that compact() is folding in
+            self._folding = ({}, {})
+            self._overlay_size = 0
+            self._loaded = False
+            self._generation += 1
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def __len__(self):
+        """Number of edges held in the CSR arrays (overlay excluded)."""
+
+        return len(self._targets)
+
+    ##########################################################################
+    # Loading
+
+    def load(self, chunk_size=50000):
+        """(Re)build the CSR arrays from the `follows` table.
+
+        Rows are read in primary-key order, `chunk_size` at a time, using
+        keyset pagination so no single query or result set is large.
+        Under sharding each shard is read that way and the streams are
+        merged; a user's follows are all on their shard, so the merged
+        rows stay grouped by follower.
+        """
+
+        offsets = array(ID_TYPECODE)
+        targets = array(ID_TYPECODE)
+
+        if shard_router.enabled:
+            edges = heapq.merge(*[self._shard_edges(shard, chunk_size)
+                                  for shard in shard_router.names])
+        else:
+            edges = self._edges(db.session, chunk_size)
+
+        for src, dst in edges:
+            while len(offsets) <= src:
+                offsets.append(len(targets))
+            targets.append(dst)
+
+        offsets.append(len(targets))
+
+        with self._lock:
+            self._offsets = offsets
+            self._targets = targets
+            self._loaded = True
+            self._generation += 1
+
+    @staticmethod
+    def _edges(session, chunk_size):
+        """(follower, followed) pairs in key order, a chunk at a time."""
+
+        src_col = Follows.user_following_id
+        dst_col = Follows.user_being_followed_id
+        last = None
+
+        while True:
+            query = select(src_col, dst_col).order_by(src_col, dst_col)
+            if last is not None:
+                query = query.where(tuple_(src_col, dst_col) > last)
+
+            rows = session.execute(query.limit(chunk_size)).all()
+            if not rows:
+                return
+
+            yield from (tuple(row) for row in rows)
+            last = tuple(rows[-1])
+
+    def _shard_edges(self, shard, chunk_size):
+        with shard_router.session(shard) as session:
+            yield from self._edges(session, chunk_size)
+
+    def ensure_loaded(self, tasks):
+        """Kick off a background load if the graph hasn't been built yet."""
+
+        with self._lock:
+            if self._loaded or self._loading:
+                return
+            self._loading = True
+
+        tasks.enqueue(self._load_from_config)
+
+    def _load_from_config(self):
+        from flask import current_app
+
+        try:
+            self.load(current_app.config['FOLLOW_GRAPH_LOAD_CHUNK'])
+        finally:
+            self._loading = False
+
+    ##########################################################################
+    # Updates
+
+    def add_edge(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        with self._lock:
+            self._removed[follower_id].discard(followed_id)
+            self._added[follower_id].add(followed_id)
+            self._overlay_size += 1
+
+    def remove_edge(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        with self._lock:
+            self._added[follower_id].discard(followed_id)
+            self._removed[follower_id].add(followed_id)
+            self._overlay_size += 1
+
+    def needs_compaction(self, threshold):
+        return self._overlay_size >= threshold
+
+    def compact(self):
+        """Fold the overlay into fresh CSR arrays.
+
+        Only holds the lock to set the overlay aside and to swap the new
+        arrays in. Does nothing before the graph has loaded, or while
+        another compaction is running.
+        """
+
+        with self._lock:
+            if not self._loaded or self._compacting:
+                return
+            self._compacting = True
+            offsets, targets = self._offsets, self._targets
+            folding = self._folding = (self._added, self._removed)
+            self._added = defaultdict(set)
+            self._removed = defaultdict(set)
+            self._overlay_size = 0
+            generation = self._generation
+
+        built = False
+        try:
+            new_offsets = array(ID_TYPECODE)
+            new_targets = array(ID_TYPECODE)
+            added, removed = folding
+            top = max([len(offsets) - 1, *added]) + 1
+
+            for user_id in range(top):
+                new_offsets.append(len(new_targets))
+                new_targets.extend(sorted(_apply(
+                    _row(offsets, targets, user_id),
+                    added.get(user_id), removed.get(user_id))))
+
+            new_offsets.append(len(new_targets))
+            built = True
+
+        finally:
+            with self._lock:
+                if built and generation == self._generation:
+                    self._offsets = new_offsets
+                    self._targets = new_targets
+                else:
+                    # the arrays were reloaded meanwhile (or the build
+                    # failed): keep the edits, under any made since
+                    self._restore_overlay(folding)
+                self._folding = ({}, {})
+                self._compacting = False
+
+    def _restore_overlay(self, folding):
+        added, removed = folding
+        for user_id, ids in added.items():
+            for uid in ids:
+                if uid not in self._removed.get(user_id, ()):
+                    self._added[user_id].add(uid)
+                    self._overlay_size += 1
+        for user_id, ids in removed.items():
+            for uid in ids:
+                if uid not in self._added.get(user_id, ()):
+                    self._removed[user_id].add(uid)
+                    self._overlay_size += 1
+
+    ##########################################################################
+    # Reads
+
+    def following(self, user_id):
+        """Ids of the users `user_id` follows, overlay applied."""
+
+        result = _row(self._offsets, self._targets, user_id)
+
+        for added, removed in (self._folding, (self._added, self._removed)):
+            result = _apply(result, added.get(user_id), removed.get(user_id))
+
+        return result
+
+    def suggest(self, user_id, limit=5, max_fanout=200):
+        """Up to `limit` friend-of-friend ids, most shared connections first."""
+
+        following = self.following(user_id)
+        exclude = set(following)
+        exclude.add(user_id)
+
+        counts = Counter()
+        for friend in islice(following, max_fanout):
+            for candidate in islice(self.following(friend), max_fanout):
+                if candidate not in exclude:
+                    counts[candidate] += 1
+
+        best = heapq.nlargest(
+            limit, counts.items(), key=lambda item: (item[1], -item[0]))
+        return [candidate for candidate, _ in best]
+
+
+def _row(offsets, targets, user_id):
+    """The ids `user_id` follows in CSR arrays."""
+
+    if user_id + 1 < len(offsets):
+        return targets[offsets[user_id]:offsets[user_id + 1]]
+    return ()
+
+
+def _apply(base, added, removed):
+    """`base` ids with one overlay layer's additions and removals applied."""
+
+    if not removed and not added:
+        return base
+
+    result = [uid for uid in base if not removed or uid not in removed]
+    if added:
+        present = set(base)
+        result.extend(uid for uid in added if uid not in present)
+
+    return result
+
+
+follow_graph = FollowGraph()
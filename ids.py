@@ -0,0 +1,122 @@
+"""Time-ordered 64-bit ids ("snowflakes") for Warbler messages.
+
+Layout, most significant bit first:
+
+    1 bit   unused (keeps ids positive in a signed BIGINT)
+    41 bits milliseconds since EPOCH_MS (good for ~69 years)
+    10 bits worker id (0-1023)
+    12 bits per-millisecond sequence (4096 ids/ms/worker)
+
+Since the timestamp is in the high bits, ordering by id is ordering by
+creation time, so feeds can sort and paginate on the primary key index
+alone. Each process needs a distinct worker id: set WARBLER_WORKER_ID,
+otherwise one is derived from the process id.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# 2023-01-01T00:00:00Z
+EPOCH_MS = 1672531200000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+def default_worker_id():
+    """Worker id from WARBLER_WORKER_ID, else from the process id."""
+
+    worker_id = os.environ.get('WARBLER_WORKER_ID')
+    if worker_id is not None:
+        return int(worker_id)
+
+    return os.getpid() & MAX_WORKER_ID
+
+
+class SnowflakeGenerator:
+    """Thread-safe generator of k-sortable 64-bit ids."""
+
+    def __init__(self, worker_id=None, epoch_ms=EPOCH_MS):
+        self.epoch_ms = epoch_ms
+        self._explicit_worker = worker_id is not None
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+        self.worker_id = (worker_id if self._explicit_worker
+                          else default_worker_id())
+
+        if not 0 <= self.worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be 0-{MAX_WORKER_ID}")
+
+    def _after_fork(self):
+        # forked workers must not share the parent's derived worker id
+        self._lock = threading.Lock()
+        if not self._explicit_worker:
+            self.worker_id = default_worker_id()
+
+    def _now_ms(self):
+        return time.time_ns() // 1_000_000 - self.epoch_ms
+
+    def next_id(self):
+        """Return a new id, greater than any this generator returned before."""
+
+        with self._lock:
+            now = self._now_ms()
+
+            # clock went backwards (NTP step etc.): keep counting from the
+            # last timestamp handed out rather than risk a duplicate
+            if now < self._last_ms:
+                now = self._last_ms
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # used up this millisecond; wait for the next one
+                    while now <= self._last_ms:
+                        time.sleep(0.0001)
+                        now = self._now_ms()
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+
+            return ((now << TIMESTAMP_SHIFT)
+                    | (self.worker_id << SEQUENCE_BITS)
+                    | self._sequence)
+
+    __call__ = next_id
+
+
+def id_to_datetime(snowflake, epoch_ms=EPOCH_MS):
+    """Naive UTC datetime an id was generated at."""
+
+    ms = (snowflake >> TIMESTAMP_SHIFT) + epoch_ms
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+
+def min_id_for(when, epoch_ms=EPOCH_MS):
+    """Smallest id that could be generated at or after naive UTC `when`.
+
+    Handy as a range bound: `Message.id >= min_id_for(day)`.
+    """
+
+    ms = int(when.replace(tzinfo=timezone.utc).timestamp() * 1000) - epoch_ms
+    return max(ms, 0) << TIMESTAMP_SHIFT
+
+
+# Ids below this are serial ids from before snowflakes (migration 003).
+# They all decode to the epoch's first day, which no snowflake id is
+# ever given, so ranges of real snowflake ids start here.
+LEGACY_ID_LIMIT = (24 * 60 * 60 * 1000) << TIMESTAMP_SHIFT
+
+
+message_ids = SnowflakeGenerator()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=message_ids._after_fork)
@@ -0,0 +1,527 @@
+"""Incremental bulk import of users, messages, follows and likes.
+
+Reads the same NDJSON/CSV records `export.py` writes (one `type` per row:
+user, message, follow or like), validates each row and upserts them in
+batched transactions:
+
+- users are matched on username and updated in place
+- messages are matched on id. A row without one gets an id made from
+  its timestamp, author and text, so importing the same file again
+  updates those messages instead of duplicating them
+- follows and likes that already exist are left alone
+
+Rows are buffered per type and flushed `batch_size` at a time, users
+first so later rows can refer to users from the same batch. On PostgreSQL
+a batch is COPYed into a temporary staging table and upserted from there
+with a single INSERT ... SELECT instead of executemany's one INSERT per
+row; elsewhere it goes in with executemany. A batch that fails (e.g. a
+message for a user that doesn't exist) is retried row by row to pin down
+the bad rows; everything else in it still goes in. Bad rows are reported in the `ImportReport` and never abort the run. Like
+counts of the liked messages are recomputed once, at the end.
+
+Imported messages have their @mentions and #hashtags indexed (see
+mentions.py) like posted ones, but nobody is notified: imports are
+mostly of old messages. The in-memory feeds and caches are the caller's
+to reset.
+
+User rows must carry an already-hashed `password`: hashing with bcrypt
+on the way in would cap the import at a few hundred rows a second.
+Exports leave it out, so their user rows need one added first.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import column, delete, select, table, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+
+from ids import LEGACY_ID_LIMIT, TIMESTAMP_SHIFT, id_to_datetime, min_id_for
+from mentions import index_messages
+from models import db, User, Message, Follows, Likes, Mention, MessageTag
+
+# how many row errors to keep details for (all of them are counted)
+MAX_REPORTED_ERRORS = 1000
+
+# flush order: referenced rows before the rows that refer to them
+TYPES = ('user', 'message', 'follow', 'like')
+
+# earliest time an imported message can get an id for
+FIRST_SNOWFLAKE_TIME = id_to_datetime(LEGACY_ID_LIMIT)
+
+
+class RowError(ValueError):
+    """A row that can't be imported."""
+
+
+class ImportReport:
+    """Counts and row-level errors from one import run."""
+
+    def __init__(self):
+        self.imported = dict.fromkeys(TYPES, 0)
+        self.error_count = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    @property
+    def rows(self):
+        return sum(self.imported.values()) + self.error_count
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'seconds': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows_per_second),
+        }
+
+
+##############################################################################
+# Parsing
+
+
+def parse_ndjson(lines):
+    """(line number, record) for each non-blank line."""
+
+    for line_no, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield line_no, RowError(f"invalid JSON: {exc}")
+            continue
+        if not isinstance(record, dict):
+            yield line_no, RowError("expected a JSON object")
+            continue
+        yield line_no, record
+
+
+def parse_csv(lines):
+    """(line number, record) per CSV row; blank fields become None."""
+
+    reader = csv.DictReader(lines)
+    for record in reader:
+        yield reader.line_num, {key: (value if value != '' else None)
+                                for key, value in record.items()}
+
+
+PARSERS = {
+    'ndjson': parse_ndjson,
+    'csv': parse_csv,
+}
+
+
+##############################################################################
+# Validation
+
+
+def _int(record, field, required=True):
+    value = record.get(field)
+    if value is None:
+        if required:
+            raise RowError(f"{field} is required")
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RowError(f"{field} must be an integer")
+
+
+def _text(record, field, required=True, max_length=None):
+    value = record.get(field)
+    if value is None or value == '':
+        if required:
+            raise RowError(f"{field} is required")
+        return None
+    value = str(value)
+    if max_length and len(value) > max_length:
+        raise RowError(f"{field} is longer than {max_length} characters")
+    return value
+
+
+def _timestamp(record, field='timestamp'):
+    value = record.get(field)
+    if value is None:
+        return datetime.utcnow()
+    try:
+        when = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise RowError(f"{field} must be an ISO 8601 timestamp")
+
+    # stored as naive UTC
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def clean_user(record):
+    email = _text(record, 'email')
+    if '@' not in email:
+        raise RowError("email is not a valid address")
+
+    password = _text(record, 'password')
+    if not password.startswith('$2'):
+        raise RowError("password must be a bcrypt hash")
+
+    row = {
+        'username': _text(record, 'username'),
+        'email': email,
+        'password': password,
+        'image_url': (_text(record, 'image_url', required=False)
+                      or User.image_url.default.arg),
+        'header_image_url': (_text(record, 'header_image_url', required=False)
+                             or User.header_image_url.default.arg),
+        'bio': _text(record, 'bio', required=False),
+        'location': _text(record, 'location', required=False),
+    }
+
+    user_id = _int(record, 'id', required=False)
+    if user_id is not None:
+        row['id'] = user_id
+
+    return row
+
+
+def _message_id(user_id, timestamp, text):
+    """Snowflake id for an imported message that doesn't carry one.
+
+    Ids are time-ordered (see ids.py), so the id's timestamp part is the
+    message's own time; feeds, partitions and rollups all go by it. The
+    rest is a hash of the message rather than a worker and sequence
+    number, so the same row always gets the same id.
+    """
+
+    digest = hashlib.blake2b(
+        f"{user_id}\0{timestamp.isoformat()}\0{text}".encode('utf-8'),
+        digest_size=8).digest()
+    low_bits = int.from_bytes(digest, 'big') & ((1 << TIMESTAMP_SHIFT) - 1)
+    return min_id_for(timestamp) | low_bits
+
+
+def clean_message(record):
+    message_id = _int(record, 'id', required=False)
+    row = {
+        'user_id': _int(record, 'user_id'),
+        'text': _text(record, 'text', max_length=140),
+        'timestamp': _timestamp(record),
+    }
+
+    if message_id is None:
+        # the epoch's first day holds legacy serial ids, so there's no
+        # id to make for a message from before then
+        if (record.get('timestamp') is None
+                or row['timestamp'] < FIRST_SNOWFLAKE_TIME):
+            raise RowError("messages without an id need a timestamp from "
+                           f"{FIRST_SNOWFLAKE_TIME:%Y-%m-%d} on")
+        message_id = _message_id(row['user_id'], row['timestamp'],
+                                 row['text'])
+
+    return {'id': message_id, **row}
+
+
+def clean_follow(record):
+    row = {
+        'user_following_id': _int(record, 'user_id'),
+        'user_being_followed_id': _int(record, 'followed_id'),
+    }
+    if row['user_following_id'] == row['user_being_followed_id']:
+        raise RowError("users can't follow themselves")
+    return row
+
+
+def clean_like(record):
+    return {
+        'user_id': _int(record, 'user_id'),
+        'message_id': _int(record, 'message_id'),
+        'timestamp': _timestamp(record),
+    }
+
+
+CLEANERS = {
+    'user': clean_user,
+    'message': clean_message,
+    'follow': clean_follow,
+    'like': clean_like,
+}
+
+
+##############################################################################
+# Upserts
+
+
+def _insert(table):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    if dialect == 'sqlite':
+        return sqlite.insert(table)
+    raise NotImplementedError(f"bulk import doesn't support {dialect}")
+
+
+def _user_upsert(stmt):
+    updated = ['email', 'password', 'image_url', 'header_image_url', 'bio',
+               'location']
+    return stmt.on_conflict_do_update(
+        index_elements=['username'],
+        set_={col: stmt.excluded[col] for col in updated})
+
+
+def _bump_user_id_sequence():
+    """Move users' id sequence past ids imported explicitly; caller commits.
+
+    Otherwise the next signup would be handed an id that's already taken.
+    SQLite picks max(id) + 1 by itself.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text(
+            "SELECT setval(pg_get_serial_sequence('users', 'id'), "
+            "GREATEST((SELECT max(id) FROM users), 1))"))
+
+
+def _message_upsert(stmt):
+    return stmt.on_conflict_do_update(
+        index_elements=['id'],
+        set_={'text': stmt.excluded.text,
+              'timestamp': stmt.excluded.timestamp})
+
+
+def _ignore_existing(stmt):
+    return stmt.on_conflict_do_nothing()
+
+
+TABLES = {
+    'user': User.__table__,
+    'message': Message.__table__,
+    'follow': Follows.__table__,
+    'like': Likes.__table__,
+}
+
+ON_CONFLICT = {
+    'user': _user_upsert,
+    'message': _message_upsert,
+    'follow': _ignore_existing,
+    'like': _ignore_existing,
+}
+
+# what upserted rows are matched on: ON CONFLICT DO UPDATE can't touch a
+# row twice in one statement, so only the last of a batch's repeats goes in
+UPSERT_KEYS = {
+    'user': 'username',
+    'message': 'id',
+}
+
+
+def _statement(kind):
+    """INSERT ... VALUES for `kind`, for executemany."""
+
+    return ON_CONFLICT[kind](_insert(TABLES[kind]))
+
+
+def _copy_value(value):
+    if value is None:
+        # an unquoted empty field is NULL to COPY's csv format
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _copy_upsert(kind, rows):
+    """Upsert `rows` on PostgreSQL via COPY and a staging table.
+
+    All `rows` have the same keys. Caller commits, which drops the
+    staging table.
+    """
+
+    if kind in UPSERT_KEYS:
+        key = UPSERT_KEYS[kind]
+        rows = list({row[key]: row for row in rows}.values())
+
+    target = TABLES[kind]
+    columns = list(rows[0])
+    quote = db.engine.dialect.identifier_preparer.quote
+    column_list = ', '.join(quote(name) for name in columns)
+
+    # CREATE TABLE AS leaves out the target's NOT NULLs and defaults, so
+    # columns a batch doesn't carry (e.g. user ids) can stay empty here
+    db.session.execute(text(
+        f"CREATE TEMP TABLE import_staging ON COMMIT DROP AS "
+        f"SELECT {column_list} FROM {quote(target.name)} WITH NO DATA"))
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [_copy_value(row[name]) for name in columns] for row in rows)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY import_staging ({column_list}) FROM STDIN WITH (FORMAT csv)",
+            buffer)
+    finally:
+        cursor.close()
+
+    staging = table('import_staging', *map(column, columns))
+    db.session.execute(ON_CONFLICT[kind](
+        _insert(target).from_select(columns, select(*staging.c))))
+
+
+def _index_messages(rows):
+    """Index the @mentions and #hashtags of upserted messages; caller commits.
+
+    An upsert can change a message's text, so its old index rows go first.
+    """
+
+    texts = {row['id']: row['text'] for row in rows}
+    db.session.execute(
+        delete(Mention).where(Mention.message_id.in_(texts)))
+    db.session.execute(
+        delete(MessageTag).where(MessageTag.message_id.in_(texts)))
+    index_messages(texts.items())
+
+
+class Importer:
+    """Validates records and upserts them in batches."""
+
+    def __init__(self, batch_size=5000):
+        self.batch_size = batch_size
+        self.report = ImportReport()
+        self._pending = {kind: [] for kind in TYPES}
+        self._pending_count = 0
+        # messages whose like counts need recomputing at the end
+        self._liked = set()
+
+    def add(self, line_no, record):
+        """Validate one parsed record and queue it for the next batch."""
+
+        if isinstance(record, RowError):
+            self.report.error(line_no, str(record))
+            return
+
+        kind = record.get('type')
+        cleaner = CLEANERS.get(kind)
+        if cleaner is None:
+            self.report.error(line_no, f"unknown record type {kind!r}")
+            return
+
+        try:
+            row = cleaner(record)
+        except RowError as exc:
+            self.report.error(line_no, str(exc))
+            return
+
+        self._pending[kind].append((line_no, row))
+        self._pending_count += 1
+
+        if self._pending_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write every queued row, one transaction per record type."""
+
+        for kind in TYPES:
+            rows = self._pending[kind]
+            if rows:
+                self._write(kind, rows)
+                rows.clear()
+
+        self._pending_count = 0
+
+    def _write(self, kind, rows):
+        copy = db.engine.dialect.name == 'postgresql'
+
+        if kind == 'user':
+            # executemany needs the same keys on every row and user ids
+            # are optional, so write users with and without one separately
+            groups = [[item for item in rows if 'id' in item[1]],
+                      [item for item in rows if 'id' not in item[1]]]
+        else:
+            groups = [rows]
+
+        for group in filter(None, groups):
+            values = [row for _, row in group]
+            try:
+                if copy:
+                    _copy_upsert(kind, values)
+                else:
+                    db.session.execute(_statement(kind), values)
+                if kind == 'message':
+                    _index_messages(values)
+                db.session.commit()
+                self.report.imported[kind] += len(values)
+            except DBAPIError:
+                db.session.rollback()
+                self._write_one_by_one(kind, group)
+
+        if kind == 'user' and groups[0]:
+            _bump_user_id_sequence()
+            db.session.commit()
+
+        if kind == 'like':
+            self._liked.update(row['message_id'] for _, row in rows)
+
+    def _write_one_by_one(self, kind, rows):
+        """Retry a failed batch row by row to find the bad ones."""
+
+        statement = _statement(kind)
+        written = []
+        for line_no, row in rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(statement, [row])
+                written.append(row)
+            except DBAPIError as exc:
+                self.report.error(line_no, str(exc.orig).splitlines()[0])
+
+        if kind == 'message' and written:
+            _index_messages(written)
+        db.session.commit()
+        self.report.imported[kind] += len(written)
+
+    def _recount_likes(self):
+        """Recompute like counts of every message liked in this import.
+
+        Likes that already existed were skipped, so counts can't simply
+        be bumped by what was read.
+        """
+
+        liked = sorted(self._liked)
+        for start in range(0, len(liked), self.batch_size):
+            Message.recount_likes(liked[start:start + self.batch_size])
+            db.session.commit()
+
+        self._liked.clear()
+
+    def run(self, records):
+        """Import every (line number, record) pair and return the report."""
+
+        for line_no, record in records:
+            self.add(line_no, record)
+
+        self.flush()
+        self._recount_likes()
+        self.report.elapsed = time.perf_counter() - self.report.started
+        return self.report
+
+
+def import_stream(lines, fmt='ndjson', batch_size=5000):
+    """Import an iterable of text lines in `fmt`; returns an ImportReport."""
+
+    return Importer(batch_size).run(PARSERS[fmt](lines))
@@ -0,0 +1,204 @@
+"""Per-route memory profiling with tracemalloc (opt-in).
+
+With MEMORY_PROFILING on, every request records, per route:
+
+- peak: the most memory allocated at once while it ran, above what was
+  allocated when it started;
+- retained: what was still allocated when it finished (before the
+  database session is cleared), e.g. rows the session still holds.
+
+A route whose peak passes MEMORY_PROFILE_THRESHOLD bytes is flagged and
+logged. Its later requests are profiled with tracemalloc snapshots too
+(at most once every MEMORY_PROFILE_SNAPSHOT_INTERVAL seconds), and the
+lines that allocated the most memory still live at the end are kept as
+its top allocation sites. `/admin/memory.json` lists every route, worst
+peak first.
+
+tracemalloc's counters are process-wide, so profiled requests take turns
+(one at a time per worker) to keep their numbers apart, and tracing
+itself makes allocation slower. Use it in staging or on a single canary
+worker rather than across production.
+"""
+
+import logging
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+# "path/to/file.py:123", bytes still allocated there, allocation count
+AllocationSite = namedtuple('AllocationSite', 'location size count')
+
+# leave the profiler's own bookkeeping out of the snapshots
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+class RouteMemory:
+    """Memory numbers collected for one route."""
+
+    __slots__ = ('requests', 'max_peak', 'total_peak', 'total_retained',
+                 'flagged', 'sites', 'sites_at')
+
+    def __init__(self):
+        self.requests = 0
+        self.max_peak = 0
+        self.total_peak = 0
+        self.total_retained = 0
+        self.flagged = False
+        self.sites = []
+        self.sites_at = None
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'max_peak': self.max_peak,
+            'mean_peak': self.total_peak // max(self.requests, 1),
+            'mean_retained': self.total_retained // max(self.requests, 1),
+            'flagged': self.flagged,
+            'top_sites': [site._asdict() for site in self.sites],
+        }
+
+
+class MemoryProfiler:
+    """Records tracemalloc peak and retained memory per route."""
+
+    def __init__(self, threshold=20 * 1024 * 1024, top_n=10):
+        self.enabled = False
+        self.threshold = threshold
+        self.top_n = top_n
+        self.frames = 1
+        self.snapshot_interval = 60
+        self.clock = time.monotonic
+        self._routes = {}
+        self._stats_lock = threading.Lock()
+        # held for the whole of a profiled request
+        self._turn = threading.Lock()
+
+    def init_app(self, app):
+        """Register defaults on the Flask app, and hooks if enabled."""
+
+        app.config.setdefault('MEMORY_PROFILING', False)
+        # per-request peak (bytes) that flags a route
+        app.config.setdefault('MEMORY_PROFILE_THRESHOLD', self.threshold)
+        app.config.setdefault('MEMORY_PROFILE_TOP_SITES', self.top_n)
+        # stack frames kept per allocation; more is slower but says who
+        # called the line that allocated
+        app.config.setdefault('MEMORY_PROFILE_FRAMES', self.frames)
+        app.config.setdefault('MEMORY_PROFILE_SNAPSHOT_INTERVAL',
+                              self.snapshot_interval)
+
+        app.extensions['memory_profiler'] = self
+
+        if not app.config['MEMORY_PROFILING']:
+            return
+
+        self.enabled = True
+        self.threshold = app.config['MEMORY_PROFILE_THRESHOLD']
+        self.top_n = app.config['MEMORY_PROFILE_TOP_SITES']
+        self.frames = app.config['MEMORY_PROFILE_FRAMES']
+        self.snapshot_interval = app.config['MEMORY_PROFILE_SNAPSHOT_INTERVAL']
+
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+
+    def reset(self):
+        """Forget every route's numbers."""
+
+        with self._stats_lock:
+            self._routes.clear()
+
+    def stats(self):
+        """{route: numbers}, worst peak first."""
+
+        with self._stats_lock:
+            ranked = sorted(self._routes.items(),
+                            key=lambda item: item[1].max_peak, reverse=True)
+            return {route: memory.to_dict() for route, memory in ranked}
+
+    def _wants_sites(self, route):
+        with self._stats_lock:
+            memory = self._routes.get(route)
+            return (memory is not None and memory.flagged
+                    and (memory.sites_at is None
+                         or self.clock() - memory.sites_at
+                         >= self.snapshot_interval))
+
+    ##########################################################################
+    # Requests
+
+    def _start_request(self):
+        if request.endpoint in (None, 'static'):
+            return
+
+        self._turn.acquire()
+        g.memory_route = f"{request.method} {request.url_rule.rule}"
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+        g.memory_before = (tracemalloc.take_snapshot()
+                           if self._wants_sites(g.memory_route) else None)
+        tracemalloc.reset_peak()
+        g.memory_start = tracemalloc.get_traced_memory()[0]
+
+    def _end_request(self, exc):
+        route = g.pop('memory_route', None)
+        if route is None:
+            return
+
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            start = g.pop('memory_start')
+            before = g.pop('memory_before')
+            sites = (self._top_sites(before)
+                     if before is not None else None)
+            self._record(route, peak - start, max(current - start, 0), sites)
+        finally:
+            self._turn.release()
+
+    def _top_sites(self, before):
+        after = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        before = before.filter_traces(_SNAPSHOT_FILTERS)
+
+        sites = []
+        for diff in after.compare_to(before, 'lineno')[:self.top_n]:
+            if diff.size_diff <= 0:
+                break
+            frame = diff.traceback[0]
+            sites.append(AllocationSite(f"{frame.filename}:{frame.lineno}",
+                                        diff.size_diff, diff.count_diff))
+        return sites
+
+    def _record(self, route, peak, retained, sites):
+        with self._stats_lock:
+            memory = self._routes.get(route)
+            if memory is None:
+                memory = self._routes[route] = RouteMemory()
+
+            memory.requests += 1
+            memory.max_peak = max(memory.max_peak, peak)
+            memory.total_peak += peak
+            memory.total_retained += retained
+
+            if sites is not None:
+                memory.sites = sites
+                memory.sites_at = self.clock()
+
+            newly_flagged = peak > self.threshold and not memory.flagged
+            if newly_flagged:
+                memory.flagged = True
+
+        if newly_flagged:
+            logger.warning("%s peaked at %d KiB in one request "
+                           "(threshold %d KiB)", route, peak // 1024,
+                           self.threshold // 1024)
+
+
+memory_profiler = MemoryProfiler()
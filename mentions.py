@@ -0,0 +1,127 @@
+"""@mentions and #hashtags.
+
+A message's mentions and hashtags are parsed once, when it's posted
+(`index_messages()` from `messages_add()`), and stored in `mentions` and
+`message_tags`. The mentions and tag pages read those tables by primary
+key instead of scanning message text with LIKE.
+
+Only mentions of existing, active users are indexed. Hashtags are
+lowercased, so #Flask and #flask are the same tag. Rows go away with
+their message (ON DELETE CASCADE), so archived months drop off the tag
+and mentions pages. Under sharding the rows are kept on the message's
+shard, next to it (see sharding.py).
+
+`linkify()` is the template filter that renders both as links.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import select
+
+from models import db, User, Message, Mention, MessageTag
+
+# an @ or # that isn't part of a word (so not the @ in an email address)
+TOKEN_RE = re.compile(r'(?<![\w@#])([@#])(\w+)')
+
+
+def parse(text):
+    """(usernames mentioned, lowercased hashtags) in message `text`."""
+
+    usernames = set()
+    tags = set()
+    for sigil, word in TOKEN_RE.findall(text):
+        if sigil == '@':
+            usernames.add(word)
+        else:
+            tags.add(word.lower())
+
+    return usernames, tags
+
+
+def index_messages(messages, session=None):
+    """Store the mentions and hashtags of `messages` ((id, text) pairs).
+
+    One query to look up every mentioned user; caller commits. The rows
+    go in through `session` (a shard's) or the main database's. Returns
+    the number of mentions stored.
+    """
+
+    session = session or db.session
+
+    parsed = [(msg_id, *parse(text)) for msg_id, text in messages]
+
+    usernames = set().union(*(names for _, names, _ in parsed))
+    user_ids = {}
+    if usernames:
+        user_ids = dict(db.session.execute(
+            select(User.username, User.id)
+            .where(User.username.in_(usernames),
+                   User.deactivated_at.is_(None))).all())
+
+    mentions = [{'user_id': user_ids[name], 'message_id': msg_id}
+                for msg_id, names, _ in parsed
+                for name in names if name in user_ids]
+    tags = [{'tag': tag, 'message_id': msg_id}
+            for msg_id, _, msg_tags in parsed
+            for tag in msg_tags]
+
+    if mentions:
+        session.execute(Mention.__table__.insert(), mentions)
+    if tags:
+        session.execute(MessageTag.__table__.insert(), tags)
+
+    return len(mentions)
+
+
+def reindex_messages(batch_size=1000, session=None):
+    """(Re)build the index for every message, `batch_size` at a time.
+
+    For backfilling messages posted before the index existed. Covers the
+    main database, or a shard through its `session`. Returns the number
+    of messages indexed.
+    """
+
+    session = session or db.session
+
+    session.execute(Mention.__table__.delete())
+    session.execute(MessageTag.__table__.delete())
+    session.commit()
+
+    total = 0
+    last_id = None
+    while True:
+        query = select(Message.id, Message.text).order_by(Message.id)
+        if last_id is not None:
+            query = query.where(Message.id > last_id)
+
+        rows = session.execute(query.limit(batch_size)).all()
+        if not rows:
+            return total
+
+        index_messages(rows, session)
+        session.commit()
+
+        total += len(rows)
+        last_id = rows[-1].id
+
+
+def linkify(text):
+    """Template filter: message text as HTML, @mentions and #tags linked."""
+
+    # match on the raw text: escaped, ' becomes &#39; and looks like a tag
+    html = []
+    last = 0
+    for match in TOKEN_RE.finditer(text):
+        sigil, word = match.groups()
+        if sigil == '@':
+            href = f"/@{word}"
+        else:
+            href = f"/tags/{word.lower()}"
+
+        html.append(escape(text[last:match.start()]))
+        html.append(Markup('<a href="{}">{}</a>').format(href, sigil + word))
+        last = match.end()
+
+    html.append(escape(text[last:]))
+    return Markup('').join(html)
@@ -0,0 +1,12 @@
+-- Deactivate-then-purge account deletion (see deletion.py).
+
+ALTER TABLE users ADD COLUMN deactivated_at TIMESTAMP;
+CREATE INDEX ix_users_deactivated_at ON users (deactivated_at);
+
+CREATE TABLE account_deletions (
+    user_id INTEGER PRIMARY KEY,
+    requested_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP,
+    stage TEXT NOT NULL DEFAULT 'pending',
+    rows_deleted INTEGER NOT NULL DEFAULT 0
+);
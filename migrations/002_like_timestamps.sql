@@ -0,0 +1,6 @@
+-- When each like happened, for the trending counters (see trending.py).
+-- Existing likes get the migration time.
+
+ALTER TABLE likes ADD COLUMN timestamp TIMESTAMP NOT NULL DEFAULT now();
+ALTER TABLE likes ALTER COLUMN timestamp DROP DEFAULT;
+CREATE INDEX ix_likes_timestamp ON likes (timestamp);
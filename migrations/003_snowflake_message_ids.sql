@@ -0,0 +1,10 @@
+-- Messages get time-ordered 64-bit ids from the app (see ids.py), so the
+-- serial default goes away. Existing ids are far below any snowflake id
+-- and so keep sorting before every new message.
+
+ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT;
+ALTER TABLE messages ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE messages ALTER COLUMN id DROP DEFAULT;
+DROP SEQUENCE IF EXISTS messages_id_seq;
+
+CREATE INDEX ix_messages_user_id_id ON messages (user_id, id);
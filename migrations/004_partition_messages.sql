@@ -0,0 +1,54 @@
+-- Partition messages by monthly snowflake id ranges and add the cold
+-- archive (see partitions.py). The existing table is attached as-is as
+-- the partition for everything before the first monthly partition, so
+-- no rows are copied.
+--
+-- Run `flask ensure-partitions` straight afterwards (and then regularly,
+-- e.g. daily from cron) to create the current and upcoming months.
+-- Replace :first_partition_min_id with the min_id that
+-- partitions.partition_for(<start of the current month>) reports.
+
+BEGIN;
+
+ALTER TABLE likes DROP CONSTRAINT likes_message_id_fkey;
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER INDEX ix_messages_user_id_id RENAME TO ix_messages_legacy_user_id_id;
+
+CREATE TABLE messages (
+    id BIGINT NOT NULL,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    PRIMARY KEY (id)
+) PARTITION BY RANGE (id);
+
+CREATE INDEX ix_messages_user_id_id ON messages (user_id, id);
+
+ALTER TABLE messages ATTACH PARTITION messages_legacy
+    FOR VALUES FROM (MINVALUE) TO (:first_partition_min_id);
+
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey
+    FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE;
+
+CREATE TABLE archived_partitions (
+    name TEXT PRIMARY KEY,
+    min_id BIGINT NOT NULL,
+    max_id BIGINT NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    archived_at TIMESTAMP
+);
+
+CREATE TABLE message_archive (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    max_id BIGINT NOT NULL,
+    min_id BIGINT NOT NULL,
+    partition TEXT NOT NULL REFERENCES archived_partitions (name),
+    row_count INTEGER NOT NULL,
+    payload BYTEA NOT NULL,
+    PRIMARY KEY (user_id, max_id)
+);
+CREATE INDEX ix_message_archive_partition ON message_archive (partition);
+
+COMMIT;
@@ -0,0 +1,3 @@
+-- Admin flag for the admin-only endpoints (bulk import, see importer.py).
+
+ALTER TABLE users ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT false;
@@ -0,0 +1,16 @@
+-- @mention and #hashtag index, filled when a message is posted (see
+-- mentions.py). Backfill existing messages with `flask index-messages`.
+
+CREATE TABLE mentions (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id BIGINT NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    PRIMARY KEY (user_id, message_id)
+);
+CREATE INDEX ix_mentions_message_id ON mentions (message_id);
+
+CREATE TABLE message_tags (
+    tag VARCHAR(140) NOT NULL,
+    message_id BIGINT NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, message_id)
+);
+CREATE INDEX ix_message_tags_message_id ON message_tags (message_id);
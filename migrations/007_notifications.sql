@@ -0,0 +1,19 @@
+-- Notification inbox (see notifications.py) and the per-user unread count
+-- shown in the nav bar.
+
+ALTER TABLE users ADD COLUMN unread_notifications INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE notifications (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    kind VARCHAR(20) NOT NULL,
+    message_id BIGINT NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    actor_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    count INTEGER NOT NULL DEFAULT 1,
+    seen BOOLEAN NOT NULL DEFAULT false,
+    updated_at TIMESTAMP NOT NULL
+);
+CREATE INDEX ix_notifications_user_id_updated_at
+    ON notifications (user_id, updated_at);
+CREATE INDEX ix_notifications_user_id_message_id
+    ON notifications (user_id, message_id);
@@ -0,0 +1,12 @@
+-- When each follow happened, so the following / followers pages can list
+-- newest first and page by cursor. Existing follows get the migration time.
+
+ALTER TABLE follows ADD COLUMN timestamp TIMESTAMP NOT NULL DEFAULT now();
+ALTER TABLE follows ALTER COLUMN timestamp DROP DEFAULT;
+CREATE INDEX ix_follows_following_timestamp
+    ON follows (user_following_id, timestamp);
+CREATE INDEX ix_follows_followed_timestamp
+    ON follows (user_being_followed_id, timestamp);
+
+-- the likes page, newest first
+CREATE INDEX ix_likes_user_id_timestamp ON likes (user_id, timestamp);
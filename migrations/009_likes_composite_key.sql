@@ -0,0 +1,25 @@
+-- Likes are keyed by (user_id, message_id) instead of a surrogate id, and
+-- message_id is no longer unique, so any number of users can like a
+-- message. messages.like_count is maintained by the app from now on and
+-- filled here from the existing likes.
+
+BEGIN;
+
+ALTER TABLE likes DROP CONSTRAINT likes_message_id_key;
+ALTER TABLE likes DROP CONSTRAINT likes_pkey;
+ALTER TABLE likes DROP COLUMN id;
+DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL;
+ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id);
+
+CREATE INDEX ix_likes_message_id_user_id ON likes (message_id, user_id);
+DROP INDEX ix_likes_user_id_timestamp;
+CREATE INDEX ix_likes_user_id_timestamp
+    ON likes (user_id, timestamp, message_id);
+
+ALTER TABLE messages ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0;
+UPDATE messages
+   SET like_count = counts.n
+  FROM (SELECT message_id, count(*) AS n FROM likes GROUP BY message_id) counts
+ WHERE messages.id = counts.message_id;
+
+COMMIT;
@@ -0,0 +1,11 @@
+-- Directory of which shard holds each user's messages, likes and
+-- outbound follows (see sharding.py). Users without an entry live on
+-- the shard their id hashes to.
+
+CREATE TABLE shard_directory (
+    user_id INTEGER PRIMARY KEY,
+    shard TEXT NOT NULL,
+    assigned_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX ix_shard_directory_shard ON shard_directory (shard);
@@ -0,0 +1,22 @@
+-- Daily activity totals and top posters, kept by rollups.py so the admin
+-- stats page never aggregates over the big tables. Fill in past days
+-- with `flask rollup-backfill`.
+
+CREATE TABLE daily_stats (
+    day DATE PRIMARY KEY,
+    messages INTEGER NOT NULL,
+    likes INTEGER NOT NULL,
+    follows INTEGER NOT NULL,
+    active_users INTEGER NOT NULL,
+    computed_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE daily_top_posters (
+    day DATE NOT NULL,
+    user_id INTEGER NOT NULL,
+    messages INTEGER NOT NULL,
+    PRIMARY KEY (day, user_id)
+);
+
+-- a day's follows, by time
+CREATE INDEX ix_follows_timestamp ON follows (timestamp);
@@ -0,0 +1,5 @@
+-- Notifications can be about messages on a shard (see sharding.py), so
+-- their message_id no longer references the main messages table. Notes
+-- whose message has gone are left out of the inbox instead of cascading.
+
+ALTER TABLE notifications DROP CONSTRAINT notifications_message_id_fkey;
@@ -0,0 +1,12 @@
+-- Who is behind each notification, so a coalesced like notification
+-- counts distinct users rather than like events (see notifications.py).
+
+CREATE TABLE notification_actors (
+    notification_id INTEGER NOT NULL
+        REFERENCES notifications (id) ON DELETE CASCADE,
+    actor_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    PRIMARY KEY (notification_id, actor_id)
+);
+
+INSERT INTO notification_actors (notification_id, actor_id)
+SELECT id, actor_id FROM notifications;
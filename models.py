@@ -4,6 +4,10 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, select
+
+from ids import message_ids
+from tracing import tracer
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -26,26 +30,54 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        # following / followers pages, newest first
+        db.Index('ix_follows_following_timestamp', 'user_following_id',
+                 'timestamp'),
+        db.Index('ix_follows_followed_timestamp', 'user_being_followed_id',
+                 'timestamp'),
+        # daily rollups (see rollups.py)
+        db.Index('ix_follows_timestamp', 'timestamp'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
-
+    # primary key order: a user's likes
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    __table_args__ = (
+        # a message's likers
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+        # likes page, newest first, without touching the table
+        db.Index('ix_likes_user_id_timestamp', 'user_id', 'timestamp',
+                 'message_id'),
     )
 
 
@@ -94,7 +126,28 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # kept in step with `notifications` so every page can show it for free
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # may use the admin-only endpoints (bulk import)
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    # set when the account is deleted; the rows are purged later in batches
+    deactivated_at = db.Column(
+        db.DateTime,
+        index=True,
+    )
+
+    # oldest first: the partitioned table returns rows in partition order
+    messages = db.relationship('Message', order_by='Message.id')
 
     followers = db.relationship(
         "User",
@@ -118,17 +171,57 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def _count(self, column, where, owner_id):
+        # under sharding the rows are on `owner_id`'s shard, or on any
+        # shard when that's None (see sharding.py, which imports this)
+        from sharding import shard_router
+
+        return shard_router.count(select(func.count(column)).where(where),
+                                  owner_id)
+
+    @property
+    def message_count(self):
+        """Number of (non-archived) messages, counted in the database."""
+
+        return self._count(Message.id, Message.user_id == self.id, self.id)
+
+    @property
+    def following_count(self):
+        return self._count(Follows.user_being_followed_id,
+                           Follows.user_following_id == self.id, self.id)
+
+    @property
+    def followers_count(self):
+        return self._count(Follows.user_following_id,
+                           Follows.user_being_followed_id == self.id, None)
+
+    @property
+    def likes_count(self):
+        return self._count(Likes.message_id, Likes.user_id == self.id,
+                           self.id)
+
+    @property
+    def is_deactivated(self):
+        """Has this account been deleted (and is waiting to be purged)?"""
+
+        return self.deactivated_at is not None
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self._count(Follows.user_following_id,
+                           (Follows.user_following_id == other_user.id)
+                           & (Follows.user_being_followed_id == self.id),
+                           other_user.id) > 0
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        # by id, so `other_user` can be a UserSummary (see cache.py)
+        return self._count(Follows.user_being_followed_id,
+                           (Follows.user_following_id == self.id)
+                           & (Follows.user_being_followed_id == other_user.id),
+                           self.id) > 0
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +230,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with tracer.span('bcrypt.hash'):
+            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -160,10 +254,12 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username,
+                                   deactivated_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with tracer.span('bcrypt.check'):
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -175,9 +271,12 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # snowflake id (see ids.py): ordering by id is ordering by time
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=message_ids.next_id,
     )
 
     text = db.Column(
@@ -188,7 +287,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,8 +296,375 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # kept in step with `likes` by whoever adds or removes them
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
     user = db.relationship('User')
 
+    __table_args__ = (
+        # profile pages: a user's messages newest-first, straight off the index
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        # monthly id ranges on PostgreSQL (see partitions.py)
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
+
+    @classmethod
+    def adjust_like_counts(cls, message_ids, delta):
+        """Add `delta` to the like count of each message; caller commits."""
+
+        if message_ids:
+            cls.query.filter(cls.id.in_(message_ids)).update(
+                {cls.like_count: cls.like_count + delta},
+                synchronize_session=False)
+
+    @classmethod
+    def recount_likes(cls, message_ids):
+        """Recompute like counts from `likes`; caller commits."""
+
+        if message_ids:
+            cls.query.filter(cls.id.in_(message_ids)).update(
+                {cls.like_count: select(func.count(Likes.user_id))
+                 .where(Likes.message_id == cls.id)
+                 .scalar_subquery()},
+                synchronize_session=False)
+
+
+class Mention(db.Model):
+    """A user @mentioned in a message (see mentions.py)."""
+
+    __tablename__ = 'mentions'
+
+    # primary key order serves the mentions page: a user's newest first
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class MessageTag(db.Model):
+    """A #hashtag used in a message, lowercased (see mentions.py)."""
+
+    __tablename__ = 'message_tags'
+
+    # primary key order serves the tag page: a tag's newest first
+    tag = db.Column(
+        db.String(140),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Notification(db.Model):
+    """A like of, or @mention in, a warble (see notifications.py)."""
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # who gets told
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'mention' or 'like'
+    kind = db.Column(
+        db.String(20),
+        nullable=False,
+    )
+
+    # no foreign key: under sharding the message is on its author's shard
+    # (see sharding.py). The inbox skips notes whose message is gone.
+    message_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    # the most recent user to act; `count` says how many distinct users
+    # there were (see NotificationActor)
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    seen = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+    __table_args__ = (
+        # the inbox, newest first
+        db.Index('ix_notifications_user_id_updated_at', 'user_id',
+                 'updated_at'),
+        # finding an unseen notification to coalesce into
+        db.Index('ix_notifications_user_id_message_id', 'user_id',
+                 'message_id'),
+    )
+
+
+class NotificationActor(db.Model):
+    """One distinct user behind a (coalesced) notification."""
+
+    __tablename__ = 'notification_actors'
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class ArchivedPartition(db.Model):
+    """A month of messages moved out of `messages` into `message_archive`."""
+
+    __tablename__ = 'archived_partitions'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # message ids in [min_id, max_id) belong to this month
+    min_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    max_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    row_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # set once the copy into the archive is complete
+    archived_at = db.Column(
+        db.DateTime,
+    )
+
+
+class MessageArchive(db.Model):
+    """Compressed chunk of one user's messages from an archived month."""
+
+    __tablename__ = 'message_archive'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # newest message id in the chunk; chunks never overlap per user
+    max_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    min_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    partition = db.Column(
+        db.Text,
+        db.ForeignKey('archived_partitions.name'),
+        nullable=False,
+        index=True,
+    )
+
+    row_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # zlib-compressed JSON: [[id, text, iso timestamp, [liker ids]], ...]
+    payload = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+
+class AccountDeletion(db.Model):
+    """Progress of purging a deactivated account's rows."""
+
+    __tablename__ = 'account_deletions'
+
+    # no foreign key: the user row itself is the last thing removed
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending',
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    def __repr__(self):
+        return (f"<AccountDeletion user #{self.user_id}: {self.stage}, "
+                f"{self.rows_deleted} rows>")
+
+
+class ShardAssignment(db.Model):
+    """Directory entry: the shard holding a user's rows (see sharding.py)."""
+
+    __tablename__ = 'shard_directory'
+
+    # no foreign key: the entry outlives the user row until their shard
+    # rows are purged
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Text,
+        nullable=False,
+        index=True,
+    )
+
+    assigned_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<ShardAssignment user #{self.user_id}: {self.shard}>"
+
+
+class DailyStats(db.Model):
+    """One day's activity totals, rolled up by rollups.py."""
+
+    __tablename__ = 'daily_stats'
+
+    # UTC day
+    day = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    messages = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # distinct users who posted, liked or followed that day
+    active_users = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<DailyStats {self.day}: {self.messages} messages>"
+
+
+class DailyTopPoster(db.Model):
+    """A user among one day's busiest posters (see rollups.py)."""
+
+    __tablename__ = 'daily_top_posters'
+
+    day = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    # no foreign key: past days keep their numbers after a purge
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    messages = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,149 @@
+"""Notification inbox: likes of your warbles and @mentions of you.
+
+Notifications are written by background tasks queued from
+`messages_add()` and `like_message()`, so posting and liking don't wait
+on them.
+
+- Fan-out is bounded: one message notifies at most `max_mentions` users.
+- Bursts coalesce: a like of a warble that already has an unseen like
+  notification adds the liker to it ("5 people liked your warble")
+  instead of adding another. Likers are kept in `notification_actors`,
+  so someone un-liking and re-liking is only counted once.
+- Each user keeps only their newest `keep` notifications.
+
+`users.unread_notifications` is kept in step with the unseen rows, so
+the nav bar reads the count off `g.user` without a query.
+
+Notifications live in the main database, but their messages (and the
+mention index) may be on a shard; those are read through the router.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import select
+
+from models import db, User, Mention, Notification, NotificationActor
+from sharding import shard_router
+
+DEFAULT_KEEP = 100
+DEFAULT_MAX_MENTIONS = 20
+
+
+def _bump_unread(user_id, delta):
+    User.query.filter_by(id=user_id).update(
+        {User.unread_notifications: User.unread_notifications + delta},
+        synchronize_session=False)
+
+
+def _trim(user_id, keep):
+    """Drop all but the newest `keep` of a user's notifications."""
+
+    old = db.session.execute(
+        select(Notification.id, Notification.seen)
+        .where(Notification.user_id == user_id)
+        .order_by(Notification.updated_at.desc(), Notification.id.desc())
+        .offset(keep)).all()
+
+    if not old:
+        return
+
+    Notification.query.filter(
+        Notification.id.in_([row.id for row in old])
+    ).delete(synchronize_session=False)
+
+    unseen = sum(1 for row in old if not row.seen)
+    if unseen:
+        _bump_unread(user_id, -unseen)
+
+
+def _push(user_id, kind, message_id, actor_id, keep):
+    """Add a notification, or coalesce it into an unseen one."""
+
+    now = datetime.utcnow()
+
+    existing = (Notification
+                .query
+                .filter_by(user_id=user_id, message_id=message_id, kind=kind,
+                           seen=False)
+                .first())
+
+    if existing is not None:
+        # someone already counted un-liking and re-liking isn't news
+        if NotificationActor.query.get((existing.id, actor_id)) is None:
+            db.session.add(NotificationActor(notification_id=existing.id,
+                                             actor_id=actor_id))
+            existing.count += 1
+            existing.actor_id = actor_id
+            existing.updated_at = now
+        return
+
+    note = Notification(user_id=user_id, kind=kind, message_id=message_id,
+                        actor_id=actor_id, updated_at=now)
+    db.session.add(note)
+    _bump_unread(user_id, +1)
+    db.session.flush()
+    db.session.add(NotificationActor(notification_id=note.id,
+                                     actor_id=actor_id))
+    db.session.flush()
+    _trim(user_id, keep)
+
+
+def notify_like(message_id, liker_id, keep=DEFAULT_KEEP):
+    """Tell a warble's author that `liker_id` liked it."""
+
+    msg = shard_router.find_message(message_id)
+    if msg is None or msg.user_id == liker_id:
+        return
+
+    _push(msg.user_id, 'like', message_id, liker_id, keep)
+    db.session.commit()
+
+
+def notify_mentions(message_id, keep=DEFAULT_KEEP,
+                    max_mentions=DEFAULT_MAX_MENTIONS):
+    """Tell the users @mentioned in a message (from the mention index)."""
+
+    msg = shard_router.find_message(message_id)
+    if msg is None:
+        return
+
+    # indexed next to the message
+    user_ids = shard_router.scalars_for(msg.user_id,
+        select(Mention.user_id)
+        .where(Mention.message_id == message_id,
+               Mention.user_id != msg.user_id)
+        .limit(max_mentions))
+
+    for user_id in user_ids:
+        _push(user_id, 'mention', message_id, msg.user_id, keep)
+
+    db.session.commit()
+
+
+def inbox(user, limit=DEFAULT_KEEP):
+    """A user's notifications, most recently updated first.
+
+    Pair with `inbox_messages()` for the messages they're about.
+    """
+
+    return (Notification
+            .query
+            .filter_by(user_id=user.id)
+            .order_by(Notification.updated_at.desc(), Notification.id.desc())
+            .limit(limit)
+            .all())
+
+
+def inbox_messages(notes):
+    """{message id: MessageView} of the notifications' messages, if any
+    are still there."""
+
+    return shard_router.find_messages({note.message_id for note in notes})
+
+
+def mark_all_seen(user):
+    """Mark every notification seen and zero the count; caller commits."""
+
+    Notification.query.filter_by(user_id=user.id, seen=False).update(
+        {Notification.seen: True}, synchronize_session=False)
+    user.unread_notifications = 0
@@ -0,0 +1,455 @@
+"""Time-range partitioning and cold archive for messages.
+
+Message ids are snowflakes (see ids.py), so a calendar month of messages
+is a contiguous id range. On PostgreSQL `messages` is declared
+`PARTITION BY RANGE (id)` with one partition per month (plus a default
+partition as a safety net); `ensure_partitions()` creates the upcoming
+months and should run regularly (`flask ensure-partitions`).
+
+Old months are moved out of the hot table by `archive_month()`: each
+user's messages from the month are packed into zlib-compressed JSON
+chunks in `message_archive`, then the hot rows are deleted (and on
+PostgreSQL the emptied partition is detached and dropped). Months are
+always archived oldest first, so every archived id is older than every
+hot id and reads can simply carry on into the archive once the hot
+table runs out.
+
+Messages kept from before snowflakes have small serial ids (below
+ids.LEGACY_ID_LIMIT), which sit in the first month's id range whatever
+their age. `archive_legacy()` archives them by timestamp instead: the
+longest run of them, in id order, that is all older than the cutoff
+month. Snowflake months are only archived once no legacy rows are left
+hot, so the archive stays older than the hot table.
+
+`MessageRouter` is what reads go through: it pages a user's messages
+from the hot table and lazily continues into the archive, one chunk at
+a time, and finds single archived messages by id for permalinks.
+"""
+
+import json
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import event, func, select, text
+
+from ids import LEGACY_ID_LIMIT, id_to_datetime, min_id_for
+from models import (db, Message, Likes, ArchivedPartition,
+                    MessageArchive)
+
+Partition = namedtuple('Partition', 'name start min_id max_id')
+
+# archived runs of legacy serial-id messages are named after this
+LEGACY_PREFIX = 'messages_legacy'
+
+
+def _month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def _next_month(start):
+    if start.month == 12:
+        return datetime(start.year + 1, 1, 1)
+    return datetime(start.year, start.month + 1, 1)
+
+
+def partition_for(when):
+    """The monthly partition covering naive UTC datetime `when`."""
+
+    start = _month_start(when)
+    end = _next_month(start)
+    return Partition(f"messages_p{start:%Y_%m}", start,
+                     min_id_for(start), min_id_for(end))
+
+
+def partition_for_id(message_id):
+    """The monthly partition message `message_id` lives in."""
+
+    return partition_for(id_to_datetime(message_id))
+
+
+##############################################################################
+# PostgreSQL declarative partitions
+
+
+def ensure_partitions(connection, months_ahead=3, start=None):
+    """Create monthly partitions of `messages` through `months_ahead`.
+
+    PostgreSQL only; other databases keep a single plain table.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS messages_default "
+        "PARTITION OF messages DEFAULT"))
+
+    month = _month_start(start or datetime.utcnow())
+    for _ in range(months_ahead + 1):
+        part = partition_for(month)
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {part.name} PARTITION OF messages "
+            f"FOR VALUES FROM ({part.min_id}) TO ({part.max_id})"))
+        month = _next_month(month)
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def _create_initial_partitions(target, connection, **kw):
+    ensure_partitions(connection)
+
+
+def _drop_partition(part):
+    """Detach and drop an emptied monthly partition, if it exists."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    exists = db.session.execute(
+        text("SELECT to_regclass(:name)"), {'name': part.name}).scalar()
+
+    if exists:
+        db.session.execute(
+            text(f"ALTER TABLE messages DETACH PARTITION {part.name}"))
+        db.session.execute(text(f"DROP TABLE {part.name}"))
+
+
+##############################################################################
+# Cold archive
+
+
+class ArchivedMessage:
+    """Read-only stand-in for a Message that lives in the archive."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'liker_ids', 'user')
+
+    archived = True
+
+    def __init__(self, id, text, timestamp, user_id, liker_ids, user=None):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.liker_ids = liker_ids
+        self.user = user
+
+    def __repr__(self):
+        return f"<ArchivedMessage #{self.id} by user #{self.user_id}>"
+
+    @property
+    def like_count(self):
+        return len(self.liker_ids)
+
+
+def _pack(rows):
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 9)
+
+
+def _unpack(chunk):
+    """ArchivedMessages in a chunk, oldest first."""
+
+    return [ArchivedMessage(msg_id, msg_text,
+                            datetime.fromisoformat(stamp),
+                            chunk.user_id, likers)
+            for msg_id, msg_text, stamp, likers
+            in json.loads(zlib.decompress(chunk.payload))]
+
+
+def _copy_to_archive(part, chunk_rows, batch_size):
+    """Pack every message in `part` into per-user archive chunks.
+
+    Walks the month in (user_id, id) order with keyset pagination.
+    """
+
+    in_month = (Message.id >= part.min_id) & (Message.id < part.max_id)
+    pending = []
+    total = 0
+    last = None
+
+    def flush():
+        if pending:
+            db.session.add(MessageArchive(
+                user_id=pending[0][0],
+                partition=part.name,
+                min_id=pending[0][1][0],
+                max_id=pending[-1][1][0],
+                row_count=len(pending),
+                payload=_pack([row for _, row in pending]),
+            ))
+            pending.clear()
+
+    while True:
+        query = (select(Message.user_id, Message.id, Message.text,
+                        Message.timestamp)
+                 .where(in_month)
+                 .order_by(Message.user_id, Message.id)
+                 .limit(batch_size))
+        if last is not None:
+            query = query.where(
+                (Message.user_id > last[0])
+                | ((Message.user_id == last[0]) & (Message.id > last[1])))
+
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+
+        likers = {}
+        for message_id, user_id in db.session.execute(
+                select(Likes.message_id, Likes.user_id)
+                .where(Likes.message_id.in_([row.id for row in rows]))):
+            likers.setdefault(message_id, []).append(user_id)
+
+        for row in rows:
+            if pending and (pending[0][0] != row.user_id
+                            or len(pending) >= chunk_rows):
+                flush()
+            pending.append((row.user_id, [row.id, row.text,
+                                          row.timestamp.isoformat(),
+                                          likers.get(row.id, [])]))
+
+        total += len(rows)
+        last = (rows[-1].user_id, rows[-1].id)
+        db.session.commit()
+
+    flush()
+    return total
+
+
+def archive_month(when, chunk_rows=1000, batch_size=1000):
+    """Move the month containing `when` from `messages` into the archive.
+
+    Resumable: the copy is redone from scratch until it has completed
+    (`archived_at` set); after that only the hot-row delete is repeated.
+    """
+
+    part = partition_for(when)
+    # legacy serial ids share the first month's range; see archive_legacy()
+    part = part._replace(min_id=max(part.min_id, LEGACY_ID_LIMIT))
+
+    return _archive(part, chunk_rows, batch_size)
+
+
+def archive_legacy(cutoff, chunk_rows=1000, batch_size=1000):
+    """Archive the legacy serial-id messages from before `cutoff`'s month.
+
+    Takes legacy ids up to the first one whose timestamp is in or after
+    that month, so every message archived is old and every one left hot
+    has a higher id. Returns the ArchivedPartition, or None if there was
+    nothing to archive.
+    """
+
+    start = _month_start(cutoff)
+    name = f"{LEGACY_PREFIX}_before_{start:%Y_%m}"
+
+    record = ArchivedPartition.query.get(name)
+    if record is not None:
+        # resume with the range chosen the first time
+        part = Partition(name, start, record.min_id, record.max_id)
+        in_range = (Message.id >= part.min_id) & (Message.id < part.max_id)
+        if (record.archived_at is not None and not db.session.execute(
+                select(Message.id).where(in_range)).first()):
+            return None
+        return _archive(part, chunk_rows, batch_size, drop=False)
+
+    legacy = Message.id < LEGACY_ID_LIMIT
+    oldest = db.session.execute(
+        select(func.min(Message.id)).where(legacy)).scalar()
+    keep_from = db.session.execute(
+        select(func.min(Message.id))
+        .where(legacy, Message.timestamp >= start)).scalar()
+
+    if oldest is None or oldest == keep_from:
+        return None
+
+    part = Partition(name, start, oldest,
+                     keep_from if keep_from is not None else LEGACY_ID_LIMIT)
+    return _archive(part, chunk_rows, batch_size, drop=False)
+
+
+def _archive(part, chunk_rows, batch_size, drop=True):
+    """Move the ids in `part`'s range into the archive, then drop it."""
+
+    record = ArchivedPartition.query.get(part.name)
+
+    if record is None:
+        record = ArchivedPartition(name=part.name, min_id=part.min_id,
+                                   max_id=part.max_id, archived_at=None)
+        db.session.add(record)
+        db.session.commit()
+
+    if record.archived_at is None:
+        MessageArchive.query.filter_by(partition=part.name).delete()
+        record.row_count = _copy_to_archive(part, chunk_rows, batch_size)
+        record.archived_at = datetime.utcnow()
+        db.session.commit()
+
+    # oldest first, so the hot rows left over are always the newest ones
+    # and readers carrying on into the archive never skip any
+    in_month = (Message.id >= part.min_id) & (Message.id < part.max_id)
+    while True:
+        ids = db.session.execute(
+            select(Message.id).where(in_month)
+            .order_by(Message.id).limit(batch_size)).scalars().all()
+        if not ids:
+            break
+
+        db.session.execute(Likes.__table__.delete()
+                           .where(Likes.message_id.in_(ids)))
+        db.session.execute(Message.__table__.delete()
+                           .where(Message.id.in_(ids)))
+        db.session.commit()
+
+    if drop:
+        _drop_partition(part)
+        db.session.commit()
+
+    message_router.invalidate()
+    return record
+
+
+def archive_before(cutoff, **kwargs):
+    """Archive every whole month of messages older than `cutoff`.
+
+    Legacy serial-id messages go first, by timestamp; while any of them
+    are left hot, snowflake months wait.
+    """
+
+    archived = []
+    legacy = Message.id < LEGACY_ID_LIMIT
+
+    if db.session.execute(select(Message.id).where(legacy)).first():
+        record = archive_legacy(cutoff, **kwargs)
+        if record is not None:
+            archived.append(record)
+        if db.session.execute(select(Message.id).where(legacy)).first():
+            return archived
+
+    oldest = db.session.execute(
+        select(func.min(Message.id))
+        .where(Message.id >= LEGACY_ID_LIMIT)).scalar()
+    if oldest is None:
+        return archived
+
+    month = partition_for_id(oldest).start
+    while _next_month(month) <= _month_start(cutoff):
+        archived.append(archive_month(month, **kwargs))
+        month = _next_month(month)
+
+    return archived
+
+
+class MessageRouter:
+    """Sends message reads to the hot table or the archive."""
+
+    def __init__(self, recheck_seconds=60):
+        # archiving usually runs from the CLI, so other processes only
+        # find out about it by re-checking now and then
+        self.recheck_seconds = recheck_seconds
+        self.invalidate()
+
+    def invalidate(self):
+        self._has_archive = None
+        self._checked_at = 0
+
+    def has_archive(self):
+        """Has any month been archived yet? (cached for a short while)"""
+
+        now = time.monotonic()
+        if (self._has_archive is None
+                or now - self._checked_at >= self.recheck_seconds):
+            self._has_archive = db.session.query(
+                ArchivedPartition.query.exists()).scalar()
+            self._checked_at = now
+
+        return self._has_archive
+
+    def archived_user_messages(self, user_id, before=None, limit=100):
+        """A user's archived messages newest-first, ids below `before`.
+
+        Chunks are decompressed one at a time, only as far as needed.
+        """
+
+        chunks = (MessageArchive
+                  .query
+                  .filter(MessageArchive.user_id == user_id)
+                  .order_by(MessageArchive.max_id.desc()))
+        if before is not None:
+            chunks = chunks.filter(MessageArchive.min_id < before)
+
+        found = []
+        for chunk in chunks.yield_per(4):
+            for msg in reversed(_unpack(chunk)):
+                if before is not None and msg.id >= before:
+                    continue
+                found.append(msg)
+                if len(found) == limit:
+                    return found
+
+        return found
+
+    def iter_archived_user_messages(self, user_id):
+        """Every archived message of a user, oldest first, chunk by chunk."""
+
+        chunks = (MessageArchive
+                  .query
+                  .filter(MessageArchive.user_id == user_id)
+                  .order_by(MessageArchive.max_id)
+                  .yield_per(4))
+
+        for chunk in chunks:
+            yield from _unpack(chunk)
+
+    def continue_into_archive(self, user, messages, before, per_page):
+        """Top up a short page of hot messages from the user's archive.
+
+        `messages` is a page from the hot table that came back with no
+        next cursor, i.e. the hot table has nothing older for this user.
+        Returns (messages, next cursor) like `paginate_messages()`.
+        """
+
+        if not self.has_archive() or len(messages) >= per_page:
+            return messages, None
+
+        if messages:
+            before = messages[-1].id
+
+        older = self.archived_user_messages(
+            user.id, before=before, limit=per_page - len(messages) + 1)
+        for msg in older:
+            msg.user = user
+
+        messages = list(messages) + older
+        if len(messages) > per_page:
+            return messages[:per_page], messages[per_page - 1].id
+
+        return messages, None
+
+    def find_archived(self, message_id):
+        """The archived message with this id, or None."""
+
+        if not self.has_archive():
+            return None
+
+        if message_id < LEGACY_ID_LIMIT:
+            in_partition = MessageArchive.partition.startswith(LEGACY_PREFIX)
+        else:
+            in_partition = (MessageArchive.partition
+                            == partition_for_id(message_id).name)
+
+        # several users' chunks can span the same id range
+        chunks = (MessageArchive
+                  .query
+                  .filter(in_partition,
+                          MessageArchive.min_id <= message_id,
+                          MessageArchive.max_id >= message_id))
+
+        for chunk in chunks:
+            for msg in _unpack(chunk):
+                if msg.id == message_id:
+                    return msg
+
+        return None
+
+
+message_router = MessageRouter()
@@ -0,0 +1,133 @@
+"""Per-user write quotas, as token buckets.
+
+Each (action, user) pair has a bucket holding up to `burst` tokens that
+refills at `burst` tokens per `period` seconds; every write takes one.
+The quotas are RATE_LIMITS, e.g. {'message': (30, 60)} allows a burst of
+30 messages and 30 a minute after that.
+
+Buckets live in this process by default: a check is a dict lookup and a
+little arithmetic under a lock. Set RATE_LIMIT_SHARED to 'local' (the
+in-memory stand-in from cache.py) or a client with pymemcache's
+get_many / set_many to share buckets between workers. The shared
+read-modify-write isn't atomic, so a burst spread across workers can
+get a token or two past its quota.
+
+Over quota, routes raise a 429 (see `enforce_rate_limit()` in app.py)
+that says which action was limited and when to retry.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from cache import LocalSharedCache
+
+# allowed: may the write go ahead; remaining: whole tokens left;
+# retry_after: seconds until the next token (0 when allowed)
+Decision = namedtuple('Decision', 'allowed remaining retry_after')
+
+DEFAULT_LIMITS = {
+    'message': (30, 60),
+    'like': (120, 60),
+    'follow': (60, 60),
+}
+
+
+class TokenBuckets:
+    """Token-bucket rate limiter keyed by (action, user id)."""
+
+    key_prefix = 'rate:'
+
+    def __init__(self, limits=None, clock=time.time):
+        self.limits = dict(limits or DEFAULT_LIMITS)
+        self.clock = clock
+        self.shared = None
+        self.max_buckets = 100000
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        app.config.setdefault('RATE_LIMITS_ENABLED', True)
+        # {action: (burst, period in seconds)}
+        app.config.setdefault('RATE_LIMITS', DEFAULT_LIMITS)
+        # None, 'local' (the in-memory stand-in), or a client with
+        # pymemcache's get_many / set_many
+        app.config.setdefault('RATE_LIMIT_SHARED', None)
+        # in-process buckets kept before full ones are dropped
+        app.config.setdefault('RATE_LIMIT_MAX_BUCKETS', self.max_buckets)
+
+        self.limits = dict(app.config['RATE_LIMITS'])
+        shared = app.config['RATE_LIMIT_SHARED']
+        self.shared = LocalSharedCache() if shared == 'local' else shared
+        self.max_buckets = app.config['RATE_LIMIT_MAX_BUCKETS']
+        self.reset()
+
+        app.extensions['rate_limits'] = self
+
+    def reset(self):
+        """Refill every bucket held in this process."""
+
+        with self._lock:
+            self._buckets.clear()
+
+    def _take(self, state, burst, rate, now):
+        """(new state, Decision) for taking a token from `state`."""
+
+        tokens, stamp = state if state is not None else (burst, now)
+        tokens = min(burst, tokens + (now - stamp) * rate)
+
+        if tokens >= 1:
+            tokens -= 1
+            return (tokens, now), Decision(True, int(tokens), 0.0)
+
+        return (tokens, now), Decision(False, 0, (1 - tokens) / rate)
+
+    def hit(self, action, user_id):
+        """Take a token for `user_id` doing `action`; returns a Decision."""
+
+        burst, period = self.limits[action]
+        rate = burst / period
+        now = self.clock()
+        key = (action, user_id)
+
+        if self.shared is not None:
+            return self._hit_shared(key, burst, period, rate, now)
+
+        with self._lock:
+            state, decision = self._take(
+                self._buckets.get(key), burst, rate, now)
+            self._buckets[key] = state
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+
+        return decision
+
+    def _hit_shared(self, key, burst, period, rate, now):
+        name = f"{self.key_prefix}{key[0]}:{key[1]}"
+        found = self.shared.get_many([name]).get(name)
+        state = tuple(map(float, found.split(b','))) if found else None
+
+        state, decision = self._take(state, burst, rate, now)
+        # an untouched bucket is full again after one period
+        self.shared.set_many({name: b'%r,%r' % state}, expire=int(period) + 1)
+
+        return decision
+
+    def _prune(self, now):
+        """Drop buckets that have refilled (they'd start full anyway)."""
+
+        for key, (tokens, stamp) in list(self._buckets.items()):
+            burst, period = self.limits[key[0]]
+            if tokens + (now - stamp) * burst / period >= burst:
+                del self._buckets[key]
+
+        # everyone is mid-burst: forget the oldest half
+        if len(self._buckets) > self.max_buckets:
+            by_age = sorted(self._buckets, key=lambda k: self._buckets[k][1])
+            for key in by_age[:len(by_age) // 2]:
+                del self._buckets[key]
+
+
+rate_limits = TokenBuckets()
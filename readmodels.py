@@ -0,0 +1,34 @@
+"""Read models: the compact rows list pages render.
+
+A list page shows three or four columns per item, so rather than loading
+full `User` / `Message` instances (identity map entries, attribute
+instrumentation, relationship loaders) the routes select just those
+columns and wrap each row in a namedtuple. Templates read them exactly
+as they would the models. bench_readmodels.py measures the difference.
+
+- `MessageView` is one message card (see macros/messages.html).
+- `UserSummary` is one user card; cache.user_summaries caches them.
+"""
+
+from collections import namedtuple
+
+from models import User, Message
+
+MessageView = namedtuple(
+    'MessageView', 'id text timestamp user_id like_count')
+
+MESSAGE_VIEW_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                        Message.user_id, Message.like_count)
+
+UserSummary = namedtuple(
+    'UserSummary', 'id username image_url header_image_url bio')
+
+USER_SUMMARY_COLUMNS = (User.id, User.username, User.image_url,
+                        User.header_image_url, User.bio)
+
+
+def message_view(msg):
+    """MessageView of a Message (or anything with the same attributes)."""
+
+    return MessageView(msg.id, msg.text, msg.timestamp, msg.user_id,
+                       msg.like_count or 0)
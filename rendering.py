@@ -0,0 +1,74 @@
+"""Template rendering helpers for Warbler.
+
+- Compiled templates are cached on disk (Jinja's FileSystemBytecodeCache
+  in JINJA_BYTECODE_CACHE_DIR), so a fresh worker loads bytecode instead
+  of re-parsing every template.
+
+- `stream_template()` sends a page as it renders rather than building it
+  into one string first: the head and nav go out straight away and the
+  message list follows in chunks, so time-to-first-byte doesn't grow
+  with the length of the list. STREAM_RESPONSES = False (the test
+  profile) renders into one string instead: the test client doesn't
+  close a streamed body before following a redirect, and the request
+  context the stream re-pushes then gets popped out of order.
+"""
+
+import os
+import tempfile
+
+from flask import (Response, current_app, get_flashed_messages,
+                   render_template, stream_with_context)
+from jinja2 import FileSystemBytecodeCache
+
+
+def init_template_cache(app):
+    """Turn on the on-disk bytecode cache for `app`'s templates."""
+
+    app.config.setdefault(
+        'JINJA_BYTECODE_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'warbler-jinja-cache'))
+    # number of template events grouped into each chunk sent
+    app.config.setdefault('TEMPLATE_STREAM_BUFFER', 20)
+    app.config.setdefault('STREAM_RESPONSES', True)
+
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def stream_template(template_name, **context):
+    """Like `render_template()`, but returns a streamed Response.
+
+    The request context (g.user, session, flashes, the DB session) stays
+    available while the body is generated.
+    """
+
+    app = current_app._get_current_object()
+
+    if not app.config['STREAM_RESPONSES']:
+        return render_template(template_name, **context)
+
+    # pop flashes now: the session cookie is written before the body is
+    # streamed, so popping them mid-stream would leave them in place
+    get_flashed_messages(with_categories=True)
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    stream = template.stream(context)
+    stream.enable_buffering(app.config['TEMPLATE_STREAM_BUFFER'])
+
+    return Response(stream_with_context(stream))
+
+
+def streamed(chunks):
+    """Response body for the iterable `chunks`, generated as it's sent.
+
+    With STREAM_RESPONSES off, `chunks` is run to the end here instead.
+    """
+
+    if not current_app.config['STREAM_RESPONSES']:
+        return list(chunks)
+
+    return stream_with_context(chunks)
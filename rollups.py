@@ -0,0 +1,241 @@
+"""Daily activity rollups for the admin stats page.
+
+`daily_stats` holds one row per UTC day (messages, likes, follows and
+distinct active users) and `daily_top_posters` that day's busiest
+posters. The stats page and its JSON twin read only these tables, never
+the big ones.
+
+`rollup_day()` recomputes a single day from scratch, so it's safe to
+re-run. Each query is bounded to the day by an index: messages by their
+snowflake id range (see ids.py), likes and follows by their timestamps.
+Legacy serial ids (below ids.LEGACY_ID_LIMIT) say nothing about time, so
+those messages are placed by their unindexed `timestamp` instead; only
+`backfill()` looks for them, since no legacy message is newer than the
+deploy that introduced snowflake ids.
+Writes call `refresh_rollups()` in app.py, which at most once every
+ROLLUP_REFRESH_SECONDS queues a task re-rolling today and yesterday
+(yesterday catches writes that landed around midnight). Past days are
+frozen after that: deleting a message later doesn't change the totals.
+
+`backfill()` rolls up historical days one day per transaction; run it
+(`flask rollup-backfill`) once after deploying, and before archiving a
+month of messages, since archived messages leave the `messages` table.
+
+Under sharding each shard is counted in parallel and the totals added
+up. A user's messages, likes and follows share a shard, so no user is
+active (or a top poster) on two shards and those add up exactly too.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, func, or_, select, union
+
+from ids import LEGACY_ID_LIMIT, id_to_datetime, min_id_for
+from models import db, Message, Likes, Follows, DailyStats, DailyTopPoster
+from sharding import shard_router
+
+# one day as the stats endpoints report it
+DayStats = namedtuple('DayStats',
+                      'day messages likes follows active_users top_posters')
+
+
+def day_bounds(day):
+    """Naive UTC datetimes for the start of `day` and of the day after."""
+
+    start = datetime(day.year, day.month, day.day)
+    return start, start + timedelta(days=1)
+
+
+def _extremes(query):
+    """(min, max) of a `select(min(x), max(x))`, across every shard."""
+
+    rows = shard_router.everywhere(
+        lambda session: session.execute(query).one())
+    lows = [low for low, _ in rows if low is not None]
+    highs = [high for _, high in rows if high is not None]
+    return min(lows, default=None), max(highs, default=None)
+
+
+class DailyRollups:
+    """Maintains and reads the daily rollup tables."""
+
+    def __init__(self, top_n=10):
+        self.top_n = top_n
+        self._lock = threading.Lock()
+        self._claimed_at = None
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        app.config.setdefault('ROLLUP_REFRESH_SECONDS', 300)
+        app.config.setdefault('ROLLUP_TOP_POSTERS', self.top_n)
+        self.top_n = app.config['ROLLUP_TOP_POSTERS']
+        app.extensions['rollups'] = self
+
+    def claim_refresh(self, interval):
+        """True at most once per `interval` seconds: time to refresh."""
+
+        with self._lock:
+            now = time.monotonic()
+            if (self._claimed_at is not None
+                    and now - self._claimed_at < interval):
+                return False
+            self._claimed_at = now
+            return True
+
+    ##########################################################################
+    # Writing
+
+    def rollup_day(self, day, legacy=False):
+        """Recompute `day`'s totals and top posters, and commit.
+
+        With `legacy`, also count legacy serial-id messages from the day
+        (a scan of all of them, as their timestamps aren't indexed).
+        """
+
+        start, end = day_bounds(day)
+        in_day = and_(Message.id >= max(min_id_for(start), LEGACY_ID_LIMIT),
+                      Message.id < min_id_for(end))
+        if legacy:
+            in_day = or_(in_day, and_(Message.id < LEGACY_ID_LIMIT,
+                                      Message.timestamp >= start,
+                                      Message.timestamp < end))
+
+        tallies = shard_router.everywhere(
+            lambda session: self._tally(session, in_day, start, end))
+
+        messages, likes, follows, active_users = (
+            sum(tally[i] for tally in tallies) for i in range(4))
+        top_posters = sorted(
+            (poster for tally in tallies for poster in tally[4]),
+            key=lambda poster: (-poster[1], poster[0]))[:self.top_n]
+
+        db.session.merge(DailyStats(
+            day=day, messages=messages, likes=likes, follows=follows,
+            active_users=active_users, computed_at=datetime.utcnow()))
+        db.session.execute(
+            delete(DailyTopPoster).where(DailyTopPoster.day == day))
+        db.session.add_all([
+            DailyTopPoster(day=day, user_id=user_id, messages=count)
+            for user_id, count in top_posters])
+        db.session.commit()
+
+    def _tally(self, session, in_day, start, end):
+        """(messages, likes, follows, active users, top posters) of one
+        database for the day."""
+
+        messages = session.execute(
+            select(func.count()).select_from(Message).where(in_day)).scalar()
+        likes = session.execute(
+            select(func.count()).select_from(Likes)
+            .where(Likes.timestamp >= start, Likes.timestamp < end)).scalar()
+        follows = session.execute(
+            select(func.count()).select_from(Follows)
+            .where(Follows.timestamp >= start,
+                   Follows.timestamp < end)).scalar()
+
+        actors = union(
+            select(Message.user_id.label('user_id')).where(in_day),
+            select(Likes.user_id)
+            .where(Likes.timestamp >= start, Likes.timestamp < end),
+            select(Follows.user_following_id)
+            .where(Follows.timestamp >= start, Follows.timestamp < end),
+        ).subquery()
+        active_users = session.execute(
+            select(func.count()).select_from(actors)).scalar()
+
+        posted = func.count().label('messages')
+        top_posters = session.execute(
+            select(Message.user_id, posted)
+            .where(in_day)
+            .group_by(Message.user_id)
+            .order_by(posted.desc(), Message.user_id)
+            .limit(self.top_n)).all()
+
+        return messages, likes, follows, active_users, [
+            tuple(poster) for poster in top_posters]
+
+    def refresh(self, now=None):
+        """Re-roll today and yesterday."""
+
+        today = (now or datetime.utcnow()).date()
+        self.rollup_day(today - timedelta(days=1))
+        self.rollup_day(today)
+
+    def backfill(self, since=None, until=None):
+        """Roll up every day from `since` to `until` (inclusive).
+
+        `since` defaults to the day of the oldest message, like or follow
+        and `until` to today. One day per transaction, so an interrupted
+        backfill keeps the days it finished. Returns the number of days
+        rolled up.
+        """
+
+        # one scan of the legacy messages, if there are any, for the days
+        # they span; every other day is counted off the id index alone
+        oldest_legacy, newest_legacy = _extremes(
+            select(func.min(Message.timestamp), func.max(Message.timestamp))
+            .where(Message.id < LEGACY_ID_LIMIT))
+
+        if since is None:
+            # each straight off an index
+            oldest_id, oldest_like, oldest_follow = (
+                _extremes(select(func.min(col), func.max(col)))[0]
+                for col in (Message.id, Likes.timestamp, Follows.timestamp))
+            if oldest_legacy is not None:
+                oldest_message = oldest_legacy
+            else:
+                oldest_message = oldest_id and id_to_datetime(oldest_id)
+            oldest = [when for when in (
+                oldest_message, oldest_like, oldest_follow)
+                if when is not None]
+            if not oldest:
+                return 0
+            since = min(oldest).date()
+        until = until or datetime.utcnow().date()
+
+        days = 0
+        day = since
+        while day <= until:
+            self.rollup_day(day, legacy=(newest_legacy is not None
+                                         and day <= newest_legacy.date()))
+            days += 1
+            day += timedelta(days=1)
+
+        return days
+
+    ##########################################################################
+    # Reading
+
+    def recent(self, days=30, now=None):
+        """DayStats for the last `days` days, newest first.
+
+        Days that haven't been rolled up yet are left out.
+        """
+
+        until = (now or datetime.utcnow()).date()
+        since = until - timedelta(days=days - 1)
+
+        rows = (DailyStats.query
+                .filter(DailyStats.day >= since, DailyStats.day <= until)
+                .order_by(DailyStats.day.desc())
+                .all())
+
+        top = {}
+        for poster in (DailyTopPoster.query
+                       .filter(DailyTopPoster.day >= since,
+                               DailyTopPoster.day <= until)
+                       .order_by(DailyTopPoster.messages.desc(),
+                                 DailyTopPoster.user_id)):
+            top.setdefault(poster.day, []).append(
+                (poster.user_id, poster.messages))
+
+        return [DayStats(row.day, row.messages, row.likes, row.follows,
+                         row.active_users, top.get(row.day, []))
+                for row in rows]
+
+
+rollups = DailyRollups()
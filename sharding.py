@@ -0,0 +1,616 @@
+"""Horizontal sharding of messages, likes and follows by user id.
+
+Users (and everything that isn't per-user) stay in the main database.
+A user's messages, the likes they give and the follows they make live
+together on one shard, so their writes and their own pages touch a
+single database. SHARDS maps shard names to database URLs; with no
+shards configured the router is off and everything stays in the main
+database.
+
+Placement goes through the `shard_directory` table: a user with an entry
+lives on that shard, and anyone else on the shard their id hashes to.
+Before adding a shard, run `flask shard-pin-users` so existing users keep
+their current placement. Then move users across one at a time with
+`flask shard-move-user`. `move_user()` copies the user's rows in chunks,
+verifies the copy, repoints the directory, then deletes the old copies;
+a failed move can simply be run again. The user's writes should be
+paused while it runs. Directory lookups are cached for
+SHARD_DIRECTORY_TTL seconds, which bounds how long other workers keep
+using the old shard.
+
+When the router is on, the routes write through it: posting and deleting
+go to the author's shard (with the message's @mention and #hashtag index
+rows, see mentions.py), follows to the follower's, and a like to the
+liker's shard while the message's like count is bumped on the author's
+(two transactions, so a failure between them leaves the count off by
+one until `Message.recount_likes()`).
+
+Reads of one user's rows (their profile, likes, following, counts and
+export) go to their shard. Reads that span users, like the feeds, a
+user's followers, permalinks and the rollups, are scatter-gather: one
+query per shard involved, run in parallel on a thread pool, with the
+newest-first results merged in Python. Shards can't join to `users`, so
+those reads drop deactivated users' rows afterwards. Account purges,
+the follow graph, the trending counters and the mentions and tag pages
+read every shard too. Notifications stay in the main database and find
+their messages through the router. Bulk import refuses to run.
+
+Shards have the same tables as the main database, minus foreign keys
+(a like's message and a follow's target usually live elsewhere), so
+deleting a message removes its index rows explicitly.
+"""
+
+import heapq
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+from sqlalchemy import (Column, Index, MetaData, Table, create_engine, delete,
+                        func, select, tuple_, update)
+from sqlalchemy.orm import Session
+
+from cache import LRUCache
+from mentions import index_messages
+from models import (db, User, Message, Likes, Follows, Mention, MessageTag,
+                    ShardAssignment)
+from readmodels import MessageView, MESSAGE_VIEW_COLUMNS, message_view
+
+
+def _shard_metadata():
+    """Copies of the sharded tables and their indexes, minus foreign keys."""
+
+    metadata = MetaData()
+    for table in (Message.__table__, Likes.__table__, Follows.__table__,
+                  Mention.__table__, MessageTag.__table__):
+        Table(table.name, metadata,
+              *[Column(col.name, col.type, primary_key=col.primary_key,
+                       nullable=col.nullable, autoincrement=False)
+                for col in table.columns],
+              *[Index(index.name, *[col.name for col in index.columns])
+                for index in table.indexes])
+    return metadata
+
+
+SHARD_METADATA = _shard_metadata()
+
+# each sharded table, the column naming its owner, and its primary key;
+# a message's mentions and tags (no owner column) belong to its author.
+# Copied in this order and deleted in reverse, messages last.
+OWNED_BY = {
+    'messages': ('user_id', ('id',)),
+    'likes': ('user_id', ('user_id', 'message_id')),
+    'follows': ('user_following_id',
+                ('user_following_id', 'user_being_followed_id')),
+    'mentions': (None, ('user_id', 'message_id')),
+    'message_tags': (None, ('tag', 'message_id')),
+}
+
+
+def _owned(name, user_id):
+    """Where-clause for `user_id`'s rows of sharded table `name`."""
+
+    table = SHARD_METADATA.tables[name]
+    owner, _ = OWNED_BY[name]
+    if owner is not None:
+        return table.c[owner] == user_id
+
+    messages = SHARD_METADATA.tables['messages']
+    return table.c.message_id.in_(
+        select(messages.c.id).where(messages.c.user_id == user_id))
+
+
+class ShardRouter:
+    """Maps user ids to shards and runs queries against them."""
+
+    def __init__(self):
+        self.directory = LRUCache(maxsize=100000, ttl=60)
+        self._shards = {}
+        self._names = []
+        self._engines = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        # {name: database URL}; empty keeps everything in the main database
+        app.config.setdefault('SHARDS', {})
+        app.config.setdefault('SHARD_DIRECTORY_TTL', 60)
+        app.config.setdefault('SHARD_SCATTER_THREADS', 8)
+
+        self.directory = LRUCache(ttl=app.config['SHARD_DIRECTORY_TTL'])
+        self.configure(app.config['SHARDS'],
+                       app.config['SHARD_SCATTER_THREADS'])
+
+        app.extensions['shard_router'] = self
+
+    def configure(self, shards, threads=8):
+        """Point the router at `shards` ({name: database URL})."""
+
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._shards = dict(shards)
+            self._names = sorted(shards)
+            self._engines = {}
+            self._pool = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix='shard')
+        self.directory.clear()
+
+    @property
+    def enabled(self):
+        return bool(self._shards)
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    ##########################################################################
+    # Placement
+
+    def hash_shard(self, user_id):
+        """Where a user with no directory entry lives."""
+
+        # Knuth's multiplicative hash spreads consecutive ids evenly
+        return self._names[(user_id * 2654435761) % 2**32
+                           % len(self._names)]
+
+    def shards_for(self, user_ids):
+        """{user id: shard name} from the directory, then the hash."""
+
+        user_ids = set(user_ids)
+        found = self.directory.get_many(user_ids)
+        missing = user_ids - found.keys()
+
+        if missing:
+            pinned = dict(db.session.execute(
+                select(ShardAssignment.user_id, ShardAssignment.shard)
+                .where(ShardAssignment.user_id.in_(missing))).all())
+            looked_up = {uid: pinned.get(uid) or self.hash_shard(uid)
+                         for uid in missing}
+            self.directory.set_many(looked_up)
+            found.update(looked_up)
+
+        return found
+
+    def shard_for(self, user_id):
+        return self.shards_for([user_id])[user_id]
+
+    def assign(self, user_id, shard):
+        """Point the directory at `shard` for `user_id`; caller commits."""
+
+        entry = ShardAssignment.query.get(user_id)
+        if entry is None:
+            db.session.add(ShardAssignment(user_id=user_id, shard=shard))
+        else:
+            entry.shard = shard
+        self.directory.delete(user_id)
+
+    def pin_users(self, chunk_size=5000):
+        """Give every user without an entry one for their hash shard."""
+
+        pinned = 0
+        last_id = 0
+
+        while True:
+            user_ids = db.session.execute(
+                select(User.id)
+                .outerjoin(ShardAssignment,
+                           ShardAssignment.user_id == User.id)
+                .where(User.id > last_id, ShardAssignment.user_id.is_(None))
+                .order_by(User.id)
+                .limit(chunk_size)).scalars().all()
+
+            if not user_ids:
+                return pinned
+
+            db.session.add_all([
+                ShardAssignment(user_id=user_id,
+                                shard=self.hash_shard(user_id))
+                for user_id in user_ids])
+            db.session.commit()
+
+            pinned += len(user_ids)
+            last_id = user_ids[-1]
+
+    ##########################################################################
+    # Connections
+
+    def engine(self, shard):
+        with self._lock:
+            engine = self._engines.get(shard)
+            if engine is None:
+                url = self._shards[shard]
+                # scatter-gather uses SQLite connections from pool threads
+                kwargs = ({'connect_args': {'check_same_thread': False}}
+                          if url.startswith('sqlite') else {})
+                engine = self._engines[shard] = create_engine(url, **kwargs)
+            return engine
+
+    def create_all(self):
+        """Create the sharded tables on every shard (if missing)."""
+
+        for shard in self._names:
+            SHARD_METADATA.create_all(self.engine(shard))
+
+    @contextmanager
+    def session(self, shard):
+        """A session on `shard`; commits on success, rolls back on error."""
+
+        session = Session(self.engine(shard), future=True)
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def session_for(self, user_id):
+        """A session on the shard holding `user_id`'s rows."""
+
+        return self.session(self.shard_for(user_id))
+
+    def scatter(self, fn, shards):
+        """{shard: fn(session, shard)}, run on each shard in parallel."""
+
+        def run(shard):
+            with self.session(shard) as session:
+                return fn(session, shard)
+
+        futures = {shard: self._pool.submit(run, shard) for shard in shards}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    ##########################################################################
+    # Writes
+
+    def add_message(self, user_id, text):
+        """Post a message on its author's shard, indexing its mentions and
+        tags there too.
+
+        Returns (its MessageView, the number of mentions indexed).
+        """
+
+        msg = Message(user_id=user_id, text=text)
+        with self.session_for(user_id) as session:
+            session.add(msg)
+            session.flush()
+            mentioned = index_messages([(msg.id, msg.text)], session)
+            return message_view(msg), mentioned
+
+    def delete_message(self, user_id, message_id):
+        """Delete one of `user_id`'s messages; False if they have no such."""
+
+        with self.session_for(user_id) as session:
+            result = session.execute(
+                delete(Message).where(Message.id == message_id,
+                                      Message.user_id == user_id))
+            if result.rowcount == 0:
+                return False
+
+            # shards have no foreign keys to cascade the index rows
+            for model in (Mention, MessageTag):
+                session.execute(
+                    delete(model).where(model.message_id == message_id))
+            return True
+
+    def toggle_like(self, user_id, msg):
+        """Like `msg` (a MessageView) as `user_id`, or unlike it if liked.
+
+        Returns (+1 or -1, when the like was made).
+        """
+
+        with self.session_for(user_id) as session:
+            like = session.execute(
+                select(Likes).filter_by(user_id=user_id,
+                                        message_id=msg.id)).scalar()
+            if like is None:
+                like = Likes(user_id=user_id, message_id=msg.id)
+                session.add(like)
+                session.flush()
+                delta = +1
+            else:
+                session.delete(like)
+                delta = -1
+            liked_at = like.timestamp
+
+        with self.session_for(msg.user_id) as session:
+            session.execute(
+                update(Message).where(Message.id == msg.id)
+                .values(like_count=Message.like_count + delta))
+
+        return delta, liked_at
+
+    def follow(self, user_id, other_id):
+        """Have `user_id` follow `other_id` (no-op if they already do)."""
+
+        with self.session_for(user_id) as session:
+            found = session.execute(
+                select(Follows.user_following_id)
+                .filter_by(user_following_id=user_id,
+                           user_being_followed_id=other_id)).first()
+            if found is None:
+                session.add(Follows(user_following_id=user_id,
+                                    user_being_followed_id=other_id))
+
+    def unfollow(self, user_id, other_id):
+        """Have `user_id` stop following `other_id`."""
+
+        with self.session_for(user_id) as session:
+            session.execute(
+                delete(Follows).where(
+                    Follows.user_following_id == user_id,
+                    Follows.user_being_followed_id == other_id))
+
+    ##########################################################################
+    # Reads
+    #
+    # `everywhere()`, `count()` and `scalars_for()` also work with no
+    # shards configured: they run on the main database then.
+
+    def everywhere(self, fn):
+        """[fn(session)] for every shard, in parallel.
+
+        With the router off, just [fn(db.session)].
+        """
+
+        if not self.enabled:
+            return [fn(db.session)]
+
+        return list(self.scatter(lambda session, shard: fn(session),
+                                 self._names).values())
+
+    def count(self, query, user_id=None):
+        """Scalar `query` (a count) on `user_id`'s shard.
+
+        With no `user_id`, summed over every shard.
+        """
+
+        if self.enabled and user_id is not None:
+            with self.session_for(user_id) as session:
+                return session.execute(query).scalar()
+
+        return sum(self.everywhere(
+            lambda session: session.execute(query).scalar()))
+
+    def scalars_for(self, user_id, query):
+        """`query`'s first column, run on `user_id`'s shard."""
+
+        if not self.enabled:
+            return db.session.execute(query).scalars().all()
+
+        with self.session_for(user_id) as session:
+            return session.execute(query).scalars().all()
+
+    def newest(self, query, limit, key=lambda row: row.id, shards=None):
+        """The first `limit` rows of `query` across `shards` (default: all).
+
+        `query` must sort newest first by `key` and carry its own limit;
+        it runs on each shard in parallel and the pages are merged.
+        """
+
+        pages = self.scatter(
+            lambda session, shard: session.execute(query).all(),
+            self._names if shards is None else shards).values()
+        return list(islice(heapq.merge(*pages, key=key, reverse=True),
+                           limit))
+
+    def find_messages(self, message_ids):
+        """{id: MessageView} for those of `message_ids` that exist.
+
+        Message ids don't say whose they are, so this asks every shard.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+
+        query = (select(*MESSAGE_VIEW_COLUMNS)
+                 .where(Message.id.in_(message_ids)))
+        found = {}
+        for rows in self.everywhere(
+                lambda session: session.execute(query).all()):
+            found.update((row.id, MessageView(*row)) for row in rows)
+        return found
+
+    def find_message(self, message_id):
+        """MessageView of `message_id`, or None if there's no such message."""
+
+        return self.find_messages([message_id]).get(message_id)
+
+    def user_messages(self, user_id, before=None, per_page=100):
+        """(MessageViews, next cursor) for a page of `user_id`'s messages."""
+
+        query = (select(*MESSAGE_VIEW_COLUMNS)
+                 .where(Message.user_id == user_id)
+                 .order_by(Message.id.desc())
+                 .limit(per_page + 1))
+        if before is not None:
+            query = query.where(Message.id < before)
+
+        with self.session_for(user_id) as session:
+            return _page([MessageView(*row) for row in session.execute(query)],
+                         per_page)
+
+    def messages_page(self, query, before=None, per_page=100):
+        """(MessageViews, next cursor) for a page of `query` across shards.
+
+        `query` selects MESSAGE_VIEW_COLUMNS (e.g. everyone's messages, or
+        those with a tag); this pages it by id like app.paginate_messages().
+        Messages by deactivated users are dropped after paging, so a page
+        can come up short.
+        """
+
+        query = query.order_by(Message.id.desc()).limit(per_page + 1)
+        if before is not None:
+            query = query.where(Message.id < before)
+
+        messages, cursor = _page(
+            [MessageView(*row) for row in self.newest(query, per_page + 1)],
+            per_page)
+        return drop_deactivated(messages), cursor
+
+    def following_feed(self, user_id, before=None, per_page=100):
+        """(MessageViews, next cursor) for `user_id`'s following feed.
+
+        Reads who they follow from their own shard, then each shard's
+        messages by the followed users it holds, in parallel.
+        """
+
+        with self.session_for(user_id) as session:
+            followed = session.execute(
+                select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == user_id)).scalars().all()
+
+        author_ids = active_user_ids(set(followed) | {user_id})
+
+        by_shard = defaultdict(list)
+        for author_id, shard in self.shards_for(author_ids).items():
+            by_shard[shard].append(author_id)
+
+        def newest(session, shard):
+            query = (select(*MESSAGE_VIEW_COLUMNS)
+                     .where(Message.user_id.in_(by_shard[shard]))
+                     .order_by(Message.id.desc())
+                     .limit(per_page + 1))
+            if before is not None:
+                query = query.where(Message.id < before)
+            return [MessageView(*row) for row in session.execute(query)]
+
+        pages = self.scatter(newest, by_shard).values()
+        return _page(list(islice(
+            heapq.merge(*pages, key=lambda msg: msg.id, reverse=True),
+            per_page + 1)), per_page)
+
+    def adjust_like_counts(self, message_ids, delta):
+        """Add `delta` to the like counts of `message_ids` on any shard."""
+
+        if not message_ids:
+            return
+
+        def adjust(session, shard):
+            session.execute(
+                update(Message).where(Message.id.in_(message_ids))
+                .values(like_count=Message.like_count + delta))
+
+        self.scatter(adjust, self._names)
+
+    ##########################################################################
+    # Resharding
+
+    def move_user(self, user_id, to_shard, chunk_size=1000):
+        """Move a user's messages, likes and follows to `to_shard`.
+
+        Copies in chunks of `chunk_size` rows, checks every table's row
+        count matches on both shards, repoints the directory, then
+        deletes the user's rows from every other shard. Each step can be
+        re-run: if a move fails after the directory was repointed, running
+        it again finds the user already on `to_shard` and just finishes
+        the cleanup. Returns the number of rows copied.
+        """
+
+        from_shard = self.shard_for(user_id)
+        moved = 0
+
+        if from_shard != to_shard:
+            for name, (_, key) in OWNED_BY.items():
+                moved += self._copy_rows(name, key, user_id,
+                                         from_shard, to_shard, chunk_size)
+
+            for name in OWNED_BY:
+                copied = self._count_rows(to_shard, name, user_id)
+                expected = self._count_rows(from_shard, name, user_id)
+                if copied != expected:
+                    raise RuntimeError(
+                        f"user #{user_id}: {copied} of {expected} {name} "
+                        f"rows copied to {to_shard}; not moving")
+
+            self.assign(user_id, to_shard)
+            db.session.commit()
+
+        def purge(session, shard):
+            for name in reversed(OWNED_BY):
+                session.execute(delete(SHARD_METADATA.tables[name])
+                                .where(_owned(name, user_id)))
+
+        self.scatter(purge, [name for name in self._names
+                             if name != to_shard])
+
+        return moved
+
+    def _copy_rows(self, name, key, user_id, from_shard, to_shard,
+                   chunk_size):
+        table = SHARD_METADATA.tables[name]
+        key_cols = [table.c[col] for col in key]
+
+        # clear any partial copy left by an earlier attempt
+        with self.session(to_shard) as target:
+            target.execute(delete(table).where(_owned(name, user_id)))
+
+        copied = 0
+        last = None
+        while True:
+            with self.session(from_shard) as source:
+                query = (select(table)
+                         .where(_owned(name, user_id))
+                         .order_by(*key_cols)
+                         .limit(chunk_size))
+                if last is not None:
+                    query = query.where(tuple_(*key_cols) > last)
+                rows = [dict(row._mapping) for row in source.execute(query)]
+
+            if not rows:
+                return copied
+
+            with self.session(to_shard) as target:
+                target.execute(table.insert(), rows)
+
+            copied += len(rows)
+            last = tuple(rows[-1][col] for col in key)
+
+    def _count_rows(self, shard, name, user_id):
+        table = SHARD_METADATA.tables[name]
+        with self.session(shard) as session:
+            return session.execute(
+                select(func.count()).select_from(table)
+                .where(_owned(name, user_id))).scalar()
+
+
+def _page(messages, per_page):
+    """Page of `per_page` MessageViews (of `per_page + 1` fetched), plus
+    the cursor for the next; see app.message_page()."""
+
+    if len(messages) > per_page:
+        return messages[:per_page], messages[per_page - 1].id
+
+    return messages, None
+
+
+def active_user_ids(user_ids):
+    """Which of `user_ids` haven't been deactivated (a main-database read)."""
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+
+    return set(db.session.execute(
+        select(User.id).where(User.id.in_(user_ids),
+                              User.deactivated_at.is_(None))).scalars())
+
+
+def drop_deactivated(messages):
+    """`messages` less those whose authors have been deactivated.
+
+    Shards can't join to `users`, so sharded reads filter afterwards.
+    """
+
+    active = active_user_ids(msg.user_id for msg in messages)
+    return [msg for msg in messages if msg.user_id in active]
+
+
+shard_router = ShardRouter()
@@ -0,0 +1,92 @@
+"""Small in-process background task queue for Warbler.
+
+Work that doesn't need to finish inside a request (purging a deleted
+account, etc.) gets handed to `tasks.enqueue()`. A single daemon worker
+thread runs each task inside an app context. Set TASKS_EAGER to run
+tasks inline instead (handy for tests and one-off scripts).
+
+A task enqueued while a request is being traced runs in a span of that
+trace (see tracing.py).
+"""
+
+import logging
+import queue
+import threading
+
+from flask import current_app
+
+from tracing import CONSUMER, tracer
+
+logger = logging.getLogger(__name__)
+
+
+class TaskQueue:
+    """FIFO queue of callables run by a background worker thread."""
+
+    def __init__(self, app=None):
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        app.config.setdefault('TASKS_EAGER', False)
+        app.extensions['tasks'] = self
+
+    def enqueue(self, fn, *args, **kwargs):
+        """Schedule `fn(*args, **kwargs)` to run in the background.
+
+        Must be called while an app context is active; the task runs in
+        a fresh app context for the same app.
+        """
+
+        app = current_app._get_current_object()
+        trace = tracer.context()
+
+        if app.config['TASKS_EAGER']:
+            with self._span(fn, trace):
+                return fn(*args, **kwargs)
+
+        self._ensure_worker()
+        self._queue.put((app, trace, fn, args, kwargs))
+
+    def join(self):
+        """Block until every queued task has been processed."""
+
+        self._queue.join()
+
+    @staticmethod
+    def _span(fn, trace):
+        name = getattr(fn, '__qualname__', type(fn).__name__)
+        return tracer.trace(f"task {name}", parent=trace, kind=CONSUMER)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name='warbler-tasks', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        # imported here so this module stays importable without models
+        from models import db
+
+        while True:
+            app, trace, fn, args, kwargs = self._queue.get()
+            try:
+                with app.app_context(), self._span(fn, trace):
+                    try:
+                        fn(*args, **kwargs)
+                    finally:
+                        db.session.remove()
+            except Exception:
+                logger.exception("Background task %r failed", fn)
+            finally:
+                self._queue.task_done()
+
+
+tasks = TaskQueue()
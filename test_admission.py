@@ -0,0 +1,89 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app
+from admission import AdmissionControl, admission, queued_for, route_class
+
+db.create_all()
+
+WAITS = {'feed': 1.0, 'write': 0.5, 'read': 0.2, 'login': 0.1}
+
+
+class AdmissionTestCase(TestCase):
+    """Test classifying, limiting and shedding requests."""
+
+    def test_route_classes(self):
+        """ requests are sorted by endpoint and method """
+
+        self.assertEqual(route_class('GET', 'warbler.homepage'), 'feed')
+        self.assertEqual(route_class('GET', 'warbler.login'), 'read')
+        self.assertEqual(route_class('POST', 'warbler.login'), 'login')
+        self.assertEqual(route_class('POST', 'warbler.like_message'), 'write')
+        self.assertIsNone(route_class('GET', 'static'))
+
+        self.assertAlmostEqual(queued_for("t=100.5", now=101), 0.5)
+        self.assertAlmostEqual(queued_for("1700000000250", now=1.7e9 + 1),
+                               0.75)
+        self.assertEqual(queued_for("garbage"), 0.0)
+
+    def test_queue_wait_and_priority(self):
+        """ long waits are shed; a backed-up queue sheds lower classes first """
+
+        control = AdmissionControl()
+        control.configure(WAITS)
+
+        self.assertTrue(control.admit('read', 0.1))
+        self.assertFalse(control.admit('read', 0.3))
+        self.assertTrue(control.admit('feed', 0.3))
+
+        # the queue backs up: the average wait climbs past read's budget
+        while control.stats()['avg_wait_ms'] <= 450:
+            control.admit('feed', 0.9)
+        self.assertFalse(control.admit('read', 0))
+        self.assertFalse(control.admit('login', 0))
+        self.assertTrue(control.admit('write', 0))
+        self.assertTrue(control.admit('feed', 0))
+
+        # once requests stop queueing, the average decays and reads return
+        while control.stats()['avg_wait_ms'] > 200:
+            control.admit('feed', 0)
+        self.assertTrue(control.admit('read', 0))
+
+        stats = control.stats()['classes']
+        self.assertEqual(stats['read']['admitted'], 2)
+        self.assertEqual(stats['read']['shed'], 2)
+        self.assertEqual(stats['login']['shed'], 1)
+
+    def test_shed_response(self):
+        """ a shed request gets a 503 with Retry-After """
+
+        admission.configure({**WAITS, 'read': 0.5})
+
+        try:
+            c = app.test_client()
+            stamp = f"t={time.time() - 1:.3f}"
+            res = c.get("/login", headers={'X-Request-Start': stamp})
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers['Retry-After'], "2")
+
+            self.assertEqual(c.get("/login").status_code, 200)
+            stats = admission.stats()
+            self.assertEqual(stats['stamped'], 1)
+            self.assertEqual(stats['classes']['read']['shed'], 1)
+
+            self.assertEqual(c.get("/admin/admission.json").status_code, 403)
+        finally:
+            admission.configure(app.config['ADMISSION_MAX_WAIT'])
@@ -0,0 +1,249 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+from cache import (LRUCache, LocalSharedCache, Permalink, PermalinkCache,
+                   SingleFlightCache, UserSummaryCache, user_summaries)
+from feeds import RecentMessages
+from readmodels import MessageView
+
+db.create_all()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process tier."""
+
+    def test_eviction_and_expiry(self):
+        """ least recently used entries go first; old entries expire """
+
+        clock = FakeClock()
+        lru = LRUCache(maxsize=2, ttl=10, clock=clock)
+
+        lru.set_many({1: 'a', 2: 'b'})
+        lru.get(1)
+        lru.set(3, 'c')
+        self.assertEqual(lru.get_many([1, 2, 3]), {1: 'a', 3: 'c'})
+
+        clock.now = 10
+        self.assertEqual(lru.get_many([1, 3]), {})
+        self.assertEqual(len(lru), 0)
+
+    def test_shared_stand_in_takes_bytes(self):
+        """ the stand-in behaves like an out-of-process cache """
+
+        shared = LocalSharedCache()
+        shared.set_many({'k': b'v'})
+        self.assertEqual(shared.get_many(['k', 'x']), {'k': b'v'})
+        self.assertRaises(TypeError, shared.set_many, {'k': 'str'})
+
+
+class UserSummaryCacheTestCase(TestCase):
+    """Test user summaries through both tiers and the database."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([
+            User(id=1, username="user1", email="user1@test.com", password="x"),
+            User(id=2, username="user2", email="user2@test.com", password="x"),
+        ])
+        db.session.commit()
+
+        self.cache = UserSummaryCache()
+        self.cache.shared = LocalSharedCache()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_tiers(self):
+        """ misses are filled from one query and served from cache after """
+
+        found = self.cache.get_many([1, 2, 3])
+        self.assertEqual(sorted(found), [1, 2])
+        self.assertEqual(found[1].username, "user1")
+
+        User.query.get(1).username = "renamed"
+        db.session.commit()
+
+        # still cached locally, then from the shared tier once local forgets
+        self.assertEqual(self.cache.get(1).username, "user1")
+        self.cache.clear()
+        self.assertEqual(self.cache.get(1).username, "user1")
+
+        self.cache.invalidate(1)
+        self.assertEqual(self.cache.get(1).username, "renamed")
+
+    def test_profile_invalidates(self):
+        """ editing a profile drops the cached summary """
+
+        user_summaries.shared = LocalSharedCache()
+        user_summaries.shared.set_many(
+            {user_summaries._key(1): b'[1, "stale", "", "", null]'})
+
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 1
+
+                c.post("/users/profile", data={
+                    "username": "fresh", "email": "user1@test.com",
+                    "password": "password", "image_url": "", "header_image_url": "",
+                    "bio": ""})
+
+            self.assertEqual(user_summaries.get(1).username, "fresh")
+        finally:
+            user_summaries.shared = None
+
+
+class SingleFlightCacheTestCase(TestCase):
+    """Test request coalescing and stale-while-revalidate."""
+
+    def test_concurrent_misses_share_one_load(self):
+        """ callers arriving during a load wait for it instead of loading """
+
+        cache = SingleFlightCache()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            release.wait(5)
+            return "value"
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.get("k", loader)))
+            for _ in range(10)]
+        for thread in threads:
+            thread.start()
+
+        # give every thread time to reach the cache before the load finishes
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ["value"] * 10)
+        self.assertEqual(len(calls), 1)
+
+    def test_stale_while_revalidate(self):
+        """ stale entries are served while one refresh runs """
+
+        clock = FakeClock()
+        spawned = []
+        cache = SingleFlightCache(ttl=5, stale_ttl=60, clock=clock,
+                                  spawn=spawned.append)
+
+        self.assertEqual(cache.get("k", lambda: "v1"), "v1")
+
+        clock.now = 10
+        self.assertEqual(cache.get("k", lambda: "v2"), "v1")
+        self.assertEqual(cache.get("k", lambda: "v2"), "v1")
+        self.assertEqual(len(spawned), 1)
+
+        spawned[0]()
+        self.assertEqual(cache.get("k", lambda: "v3"), "v2")
+
+        clock.now = 100
+        self.assertEqual(cache.get("k", lambda: "v4"), "v4")
+
+        cache.invalidate("k")
+        self.assertEqual(cache.get("k", lambda: "v5"), "v5")
+
+    def test_errors_are_not_cached(self):
+        """ a failing load raises and the next call tries again """
+
+        cache = SingleFlightCache()
+
+        def broken():
+            raise RuntimeError("db down")
+
+        self.assertRaises(RuntimeError, cache.get, "k", broken)
+        self.assertEqual(cache.get("k", lambda: "ok"), "ok")
+
+    def test_permalinks_invalidate_user(self):
+        """ dropping a user's permalinks leaves everyone else's """
+
+        cache = PermalinkCache()
+
+        def permalink(message_id, user_id):
+            return lambda: Permalink(message_id, "hi", None, user_id, 0,
+                                     archived=False)
+
+        cache.get(1, permalink(1, 7))
+        cache.get(2, permalink(2, 8))
+        cache.get(3, lambda: None)
+
+        cache.invalidate_user(7)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(1, permalink(1, 9)).user_id, 9)
+        self.assertEqual(cache.get(2, permalink(2, 9)).user_id, 8)
+
+
+def recent(message_id, user_id=1, like_count=0):
+    return MessageView(message_id, f"warble {message_id}", None, user_id,
+                         like_count)
+
+
+class RecentMessagesTestCase(TestCase):
+    """Test the per-user profile page cache."""
+
+    def test_updates_in_place(self):
+        """ posts, deletes and likes change the cached page """
+
+        cache = RecentMessages(per_user=2)
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return [recent(3), recent(2)], 2
+
+        self.assertEqual(cache.get(1, loader), ([recent(3), recent(2)], 2))
+        self.assertEqual(cache.get(1, loader), ([recent(3), recent(2)], 2))
+        self.assertEqual(len(loads), 1)
+
+        cache.add(recent(4))
+        cache.adjust_like_count(1, 3, +1)
+        self.assertEqual(cache.get(1, loader),
+                         ([recent(4), recent(3, like_count=1)], 3))
+
+        # the page can't be topped back up from memory, so it reloads
+        cache.remove(1, 4)
+        cache.get(1, loader)
+        self.assertEqual(len(loads), 2)
+
+    def test_lru_memory_cap(self):
+        """ least recently viewed users go once the cap is reached """
+
+        one_page = RecentMessages()
+        one_page.get(1, lambda: ([recent(1)], None))
+
+        cache = RecentMessages(max_bytes=one_page.nbytes * 2)
+        for user_id in (1, 2, 1, 3):
+            cache.get(user_id, lambda: ([recent(user_id, user_id)], None))
+
+        self.assertEqual(list(cache._pages), [1, 3])
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
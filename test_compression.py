@@ -0,0 +1,89 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import os
+from unittest import TestCase, skipIf
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+import compression
+
+db.create_all()
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+
+class CompressionTestCase(TestCase):
+    """Test negotiation, streaming and ETags."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(id=1, username="user1", email="user1@test.com",
+                            password="x"))
+        db.session.add_all([Message(id=n, text=f"warble number {n}",
+                                    user_id=1) for n in range(1, 51)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_streamed_page(self):
+        """ streamed pages are gzipped on the fly """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            res = c.get("/users/1", headers=GZIP)
+            self.assertTrue(res.is_streamed)
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+            html = gzip.decompress(res.get_data()).decode()
+            self.assertIn("warble number 50", html)
+            self.assertIn("warble number 1<", html)
+
+            plain = c.get("/users/1")
+            self.assertNotIn('Content-Encoding', plain.headers)
+
+    def test_etag_and_skips(self):
+        """ whole pages get a per-encoding ETag; images are left alone """
+
+        res = self.client.get("/login", headers=GZIP)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn("<form", gzip.decompress(res.get_data()).decode())
+
+        etag = res.headers['ETag']
+        self.assertNotEqual(etag, self.client.get("/login").headers['ETag'])
+
+        res = self.client.get("/login", headers={**GZIP,
+                                                 'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client.get("/static/images/default-pic.png", headers=GZIP)
+        self.assertNotIn('Content-Encoding', res.headers)
+        res.close()
+
+        with app.test_request_context(headers=GZIP):
+            small = app.response_class("tiny", mimetype='text/html')
+            compression.compress_response(small, app.config)
+            self.assertEqual(small.get_data(), b"tiny")
+
+    @skipIf(compression.brotli is None, "brotli not installed")
+    def test_brotli_preferred(self):
+        """ brotli wins when the client takes both """
+
+        res = self.client.get("/login",
+                              headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertIn(b"<form", compression.brotli.decompress(res.get_data()))
@@ -0,0 +1,124 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app
+from follow_graph import FollowGraph, _row
+
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the in-memory follow graph."""
+
+    def setUp(self):
+        """Create users 1-5 and some follows."""
+
+        db.drop_all()
+        db.create_all()
+
+        for n in range(1, 6):
+            db.session.add(User(id=n, username=f"user{n}",
+                                email=f"user{n}@test.com", password="x"))
+        db.session.commit()
+
+        # 1 -> 2, 3; 2 -> 4; 3 -> 4, 5
+        for follower, followed in [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5)]:
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+        self.graph = FollowGraph()
+        self.graph.load(chunk_size=2)
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_load(self):
+        """ test graph loads every edge in small chunks """
+
+        self.assertEqual(len(self.graph), 5)
+        self.assertEqual(list(self.graph.following(1)), [2, 3])
+        self.assertEqual(list(self.graph.following(3)), [4, 5])
+        self.assertEqual(list(self.graph.following(5)), [])
+        self.assertEqual(list(self.graph.following(99)), [])
+
+    def test_suggest(self):
+        """ test friends-of-friends ranked by shared connections """
+
+        self.assertEqual(self.graph.suggest(1), [4, 5])
+        self.assertEqual(self.graph.suggest(1, limit=1), [4])
+
+    def test_overlay_and_compact(self):
+        """ test follows/unfollows after load, before and after compaction """
+
+        self.graph.add_edge(1, 4)
+        self.graph.remove_edge(1, 2)
+        self.graph.add_edge(7, 1)
+
+        self.assertEqual(sorted(self.graph.following(1)), [3, 4])
+        self.assertEqual(self.graph.suggest(1), [5])
+
+        self.graph.compact()
+
+        self.assertEqual(len(self.graph), 6)
+        self.assertEqual(list(self.graph.following(1)), [3, 4])
+        self.assertEqual(list(self.graph.following(7)), [1])
+        self.assertEqual(self.graph.suggest(1), [5])
+
+    def test_compact_waits_for_load(self):
+        """ test compaction before loading keeps the overlay """
+
+        graph = FollowGraph()
+        graph.add_edge(1, 2)
+        graph.compact()
+        self.assertEqual(list(graph.following(1)), [2])
+        self.assertTrue(graph.needs_compaction(1))
+
+        graph.load(chunk_size=2)
+        self.assertEqual(sorted(graph.following(1)), [2, 3])
+
+    def test_compact_keeps_edits_made_meanwhile(self):
+        """ test follows during a rebuild survive it, as does a reload """
+
+        self.graph.add_edge(1, 4)
+        build = _row
+
+        def follow_mid_build(offsets, targets, user_id):
+            if user_id == 0:
+                self.graph.add_edge(2, 5)
+                self.assertEqual(sorted(self.graph.following(1)), [2, 3, 4])
+            return build(offsets, targets, user_id)
+
+        with patch('follow_graph._row', follow_mid_build):
+            self.graph.compact()
+
+        self.assertEqual(sorted(self.graph.following(1)), [2, 3, 4])
+        self.assertEqual(sorted(self.graph.following(2)), [4, 5])
+        self.assertEqual(len(self.graph), 6)
+
+        def reload_mid_build(offsets, targets, user_id):
+            if user_id == 0:
+                self.graph.load(chunk_size=2)
+            return build(offsets, targets, user_id)
+
+        self.graph.add_edge(5, 1)
+        with patch('follow_graph._row', reload_mid_build):
+            self.graph.compact()
+
+        self.assertEqual(len(self.graph), 5)
+        self.assertEqual(list(self.graph.following(5)), [1])
+        self.assertEqual(sorted(self.graph.following(2)), [4, 5])
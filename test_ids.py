@@ -0,0 +1,45 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ids.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from ids import (SnowflakeGenerator, id_to_datetime, min_id_for,
+                 MAX_WORKER_ID, SEQUENCE_BITS)
+
+
+class SnowflakeTestCase(TestCase):
+    """Test time-ordered id generation."""
+
+    def test_ids_increase(self):
+        """ test ids are unique and strictly increasing """
+
+        gen = SnowflakeGenerator(worker_id=7)
+        ids = [gen.next_id() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all(0 < i < 2 ** 63 for i in ids))
+
+    def test_worker_bits(self):
+        """ test worker id is encoded and validated """
+
+        gen = SnowflakeGenerator(worker_id=5)
+        self.assertEqual((gen() >> SEQUENCE_BITS) & MAX_WORKER_ID, 5)
+
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(worker_id=MAX_WORKER_ID + 1)
+
+    def test_time_round_trip(self):
+        """ test ids decode to their creation time and bound time ranges """
+
+        before = datetime.utcnow() - timedelta(milliseconds=1)
+        snowflake = SnowflakeGenerator(worker_id=1).next_id()
+        after = datetime.utcnow() + timedelta(milliseconds=1)
+
+        self.assertTrue(before <= id_to_datetime(snowflake) <= after)
+        self.assertLessEqual(min_id_for(before), snowflake)
+        self.assertGreater(min_id_for(after), snowflake)
@@ -0,0 +1,198 @@
+"""Bulk import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_importer.py
+
+
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import (db, User, Message, Follows, Likes, Mention,
+                    MessageTag, Notification)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+from feeds import firehose
+from ids import id_to_datetime
+from importer import import_stream
+
+db.create_all()
+
+HASH = "$2b$12$" + "x" * 53
+
+
+def ndjson(*records):
+    return [json.dumps(record) + "\n" for record in records]
+
+
+class ImporterTestCase(TestCase):
+    """Test importing NDJSON and CSV streams."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(id=1, username="old", email="old@test.com",
+                            password=HASH, bio="before"))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_import_ndjson(self):
+        """ rows are upserted and bad rows reported without stopping """
+
+        report = import_stream(ndjson(
+            {"type": "user", "username": "old", "email": "new@test.com",
+             "password": HASH, "bio": "after"},
+            {"type": "user", "id": 2, "username": "two",
+             "email": "two@test.com", "password": HASH},
+            {"type": "user", "username": "bad", "email": "bad@test.com",
+             "password": "plaintext"},
+            {"type": "message", "id": 10, "user_id": 2, "text": "hi",
+             "timestamp": "2024-01-01T00:00:00"},
+            {"type": "message", "user_id": 2, "text": "x" * 141},
+            {"type": "follow", "user_id": 1, "followed_id": 2},
+            {"type": "follow", "user_id": 1, "followed_id": 2},
+            {"type": "like", "user_id": 1, "message_id": 10},
+            {"type": "poke", "user_id": 1},
+        ) + ["not json\n"], batch_size=3)
+
+        self.assertEqual(report.imported,
+                         {'user': 2, 'message': 1, 'follow': 2, 'like': 1})
+        self.assertEqual([err['line'] for err in report.errors],
+                         [3, 5, 9, 10])
+
+        old = User.query.get(1)
+        self.assertEqual(old.email, "new@test.com")
+        self.assertEqual(old.bio, "after")
+        self.assertEqual(User.query.get(2).username, "two")
+        self.assertEqual(Message.query.get(10).text, "hi")
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Message.query.get(10).like_count, 1)
+
+        # importing the same message again updates it in place
+        import_stream(ndjson({"type": "message", "id": 10, "user_id": 2,
+                              "text": "edited"}))
+        self.assertEqual(Message.query.get(10).text, "edited")
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_repeats_in_a_batch(self):
+        """ a row repeated within one batch goes in once, the last one wins """
+
+        report = import_stream(ndjson(
+            {"type": "message", "id": 10, "user_id": 1, "text": "first"},
+            {"type": "message", "id": 10, "user_id": 1, "text": "second"},
+            {"type": "like", "user_id": 1, "message_id": 10},
+            {"type": "like", "user_id": 1, "message_id": 10},
+        ))
+
+        self.assertEqual(report.error_count, 0)
+        self.assertEqual(Message.query.get(10).text, "second")
+        self.assertEqual(Message.query.get(10).like_count, 1)
+
+    def test_signup_after_import(self):
+        """ imported user ids don't collide with later signups """
+
+        import_stream(ndjson({"type": "user", "id": 50, "username": "fifty",
+                              "email": "fifty@test.com", "password": HASH}))
+
+        user = User.signup("later", "later@test.com", "password", None)
+        db.session.commit()
+        self.assertGreater(user.id, 50)
+
+    def test_message_ids_follow_timestamps(self):
+        """ messages without an id get one from their own timestamp """
+
+        lines = ndjson(
+            {"type": "message", "user_id": 1, "text": "newer",
+             "timestamp": "2024-03-01T12:00:00"},
+            {"type": "message", "user_id": 1, "text": "older",
+             "timestamp": "2024-03-01T12:00:00+01:00"},
+            {"type": "message", "user_id": 1, "text": "same time",
+             "timestamp": "2024-03-01T12:00:00"},
+            {"type": "message", "user_id": 1, "text": "when?"},
+            {"type": "message", "user_id": 1, "text": "too old",
+             "timestamp": "2022-12-31T00:00:00"},
+        )
+        report = import_stream(lines)
+
+        by_text = {msg.text: msg for msg in Message.query}
+        self.assertEqual(id_to_datetime(by_text["newer"].id),
+                         datetime(2024, 3, 1, 12))
+        self.assertEqual(by_text["older"].timestamp, datetime(2024, 3, 1, 11))
+        self.assertEqual(id_to_datetime(by_text["older"].id),
+                         datetime(2024, 3, 1, 11))
+        self.assertNotEqual(by_text["same time"].id, by_text["newer"].id)
+        self.assertEqual([err['line'] for err in report.errors], [4, 5])
+
+        # importing the same file again finds the same messages
+        import_stream(lines)
+        self.assertEqual({msg.text: msg.id for msg in Message.query},
+                         {text: msg.id for text, msg in by_text.items()})
+
+    def test_mentions_and_tags(self):
+        """ imported messages are indexed; editing one re-indexes it """
+
+        import_stream(ndjson(
+            {"type": "message", "id": 10, "user_id": 1,
+             "text": "hi @old #Import"}))
+
+        self.assertEqual([(m.user_id, m.message_id) for m in Mention.query],
+                         [(1, 10)])
+        self.assertEqual([t.tag for t in MessageTag.query], ["import"])
+        self.assertEqual(Notification.query.count(), 0)
+
+        import_stream(ndjson(
+            {"type": "message", "id": 10, "user_id": 1, "text": "#edited"}))
+
+        self.assertEqual(Mention.query.count(), 0)
+        self.assertEqual([t.tag for t in MessageTag.query], ["edited"])
+
+    def test_import_csv(self):
+        """ CSV rows in the export layout are imported """
+
+        lines = [
+            "type,id,user_id,followed_id,text,timestamp\n",
+            "message,20,1,,from csv,2024-02-01T00:00:00\n",
+            "message,21,,,no author,\n",
+        ]
+        report = import_stream(lines, 'csv')
+
+        self.assertEqual(report.imported['message'], 1)
+        self.assertEqual(report.errors,
+                         [{'line': 3, 'error': "user_id is required"}])
+        self.assertEqual(Message.query.get(20).user_id, 1)
+
+    def test_import_endpoint(self):
+        """ only admins can import over HTTP """
+
+        body = "".join(ndjson({"type": "message", "id": 30, "user_id": 1,
+                               "text": "over http"}))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.post("/admin/import", data=body)
+            self.assertEqual(resp.status_code, 403)
+
+            User.query.get(1).is_admin = True
+            db.session.commit()
+            firehose.refresh()
+
+            resp = c.post("/admin/import", data=body)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['imported']['message'], 1)
+            self.assertEqual(Message.query.get(30).text, "over http")
+            # reloaded on next use, imported message included
+            self.assertFalse(firehose.loaded)
@@ -0,0 +1,91 @@
+"""Per-route memory profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_memprofile.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import create_app, CURR_USER_KEY
+from config import TestConfig
+from memprofile import MemoryProfiler, memory_profiler
+
+
+class ProfiledConfig(TestConfig):
+    MEMORY_PROFILING = True
+    # every route is over budget, so the second request takes snapshots
+    MEMORY_PROFILE_THRESHOLD = 1024
+    MEMORY_PROFILE_SNAPSHOT_INTERVAL = 0
+
+
+app = create_app(ProfiledConfig)
+
+with app.app_context():
+    db.create_all()
+
+
+class MemoryProfilerTestCase(TestCase):
+    """Test recording, flagging and reporting per-route memory."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add_all([
+                User(id=n, username=f"user{n}", email=f"user{n}@test.com",
+                     password="x") for n in range(1, 201)])
+            db.session.commit()
+
+        memory_profiler.reset()
+
+    def test_flagging(self):
+        """ routes are flagged only once a request peaks over the threshold """
+
+        profiler = MemoryProfiler(threshold=1000)
+        profiler._record("GET /a", 400, 100, None)
+        profiler._record("GET /a", 600, 0, None)
+        profiler._record("GET /b", 5000, 0, None)
+
+        stats = profiler.stats()
+        self.assertEqual(list(stats), ["GET /b", "GET /a"])
+        self.assertEqual(stats["GET /a"]['requests'], 2)
+        self.assertEqual(stats["GET /a"]['mean_peak'], 500)
+        self.assertEqual(stats["GET /a"]['mean_retained'], 50)
+        self.assertFalse(stats["GET /a"]['flagged'])
+        self.assertTrue(stats["GET /b"]['flagged'])
+
+    def test_profiled_requests(self):
+        """ a flagged route gets its top allocation sites recorded """
+
+        # not `with`: each request's teardown (which records it) runs as
+        # soon as the response is read
+        c = app.test_client()
+        c.get("/users").get_data()
+        c.get("/users").get_data()
+
+        route = memory_profiler.stats()["GET /users"]
+        self.assertEqual(route['requests'], 2)
+        self.assertGreater(route['max_peak'], 1024)
+        self.assertTrue(route['flagged'])
+        self.assertTrue(route['top_sites'])
+        self.assertTrue(all(site['size'] > 0 for site in route['top_sites']))
+
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        self.assertEqual(c.get("/admin/memory.json").status_code, 403)
+
+        with app.app_context():
+            User.query.get(1).is_admin = True
+            db.session.commit()
+
+        res = c.get("/admin/memory.json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['threshold'], 1024)
+        self.assertIn("GET /users", res.json['routes'])
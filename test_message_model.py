@@ -12,6 +12,7 @@ from sqlalchemy import exc
 from models import db, User, Message, Follows, Likes
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
 
 from app import app
 
@@ -76,6 +77,8 @@ class MessageModelTestCase(TestCase):
         db.session.add(like)
         db.session.commit()
 
-        self.assertEqual(Likes.query.get(1).message_id, self.message1_id)
+        self.assertEqual(
+            Likes.query.get((self.user1_id, self.message1_id)).message_id,
+            self.message1_id)
 
     
@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes
+from models import (db, connect_db, Message, User, Likes, Follows, Mention,
+                    MessageTag, Notification)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,11 +17,14 @@ from models import db, connect_db, Message, User, Likes
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from feeds import Firehose, firehose
+from ids import SnowflakeGenerator
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -40,6 +44,11 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Notification.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Mention.query.delete()
+        MessageTag.query.delete()
         User.query.delete()
         Message.query.delete()
 
@@ -91,7 +100,7 @@ class MessageViewTestCase(TestCase):
             # Make sure it redirects
             self.assertEqual(resp.status_code, 302)
 
-            msg = Message.query.get(1)
+            msg = Message.query.filter_by(text="Hello").one()
             self.assertEqual(msg.text, "Hello")
 
     def test_add_message_without_authentication(self):
@@ -179,4 +188,132 @@ class MessageViewTestCase(TestCase):
             res = c.post(f"/messages/{message2_id}/delete", follow_redirects=True)
             html = res.get_data(as_text=True)
             self.assertEqual(res.status_code, 200)
-            self.assertIn("Access unauthorized.", html)
\ No newline at end of file
+            self.assertIn("Access unauthorized.", html)
+    def test_mentions_and_tags(self):
+        """ are @mentions and #hashtags indexed, linked and listed? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new",
+                   data={"text": "hi @testuser and @nobody #Flask"})
+
+            msg = Message.query.filter_by(
+                text="hi @testuser and @nobody #Flask").one()
+            self.assertEqual(
+                [(m.user_id, m.message_id) for m in Mention.query.all()],
+                [(1111, msg.id)])
+            self.assertEqual(
+                [(t.tag, t.message_id) for t in MessageTag.query.all()],
+                [("flask", msg.id)])
+
+            res = c.get("/tags/FLASK")
+            html = res.get_data(as_text=True)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('<a href="/tags/flask">#Flask</a>', html)
+            self.assertIn('<a href="/@testuser">@testuser</a>', html)
+            self.assertNotIn("testtesttest", html)
+
+            html = c.get("/users/1111/mentions").get_data(as_text=True)
+            self.assertIn(f'href="/messages/{msg.id}"', html)
+
+            res = c.get("/@testuser")
+            self.assertEqual(res.location.rsplit("/", 1)[-1], "1111")
+            self.assertEqual(c.get("/@nobody").status_code, 404)
+
+    def test_like_counts(self):
+        """ can several users like a message, and is the count kept? """
+
+        for n in (2, 3):
+            user = User.signup(f"liker{n}", f"liker{n}@test.com", "password", None)
+            user.id = n
+        db.session.commit()
+
+        with self.client as c:
+            for liker in (2, 3):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = liker
+                c.post("/users/add_like/1111")
+
+            self.assertEqual(Message.query.get(1111).like_count, 2)
+            self.assertEqual(Likes.query.filter_by(message_id=1111).count(), 2)
+
+            # liking again un-likes
+            c.post("/users/add_like/1111")
+            self.assertEqual(Message.query.get(1111).like_count, 1)
+
+            html = c.get("/messages/1111").get_data(as_text=True)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 1</span>', html)
+
+    def test_feeds(self):
+        """ following feed vs. the global firehose """
+
+        for n in (2, 3):
+            user = User.signup(f"user{n}", f"user{n}@test.com", "password", None)
+            user.id = n
+        db.session.commit()
+
+        db.session.add_all([
+            Message(id=2000, text="followed warble", user_id=2),
+            Message(id=3000, text="stranger warble", user_id=3),
+            Follows(user_following_id=1111, user_being_followed_id=2),
+        ])
+        db.session.commit()
+        firehose.reset()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("testtesttest", html)
+            self.assertIn("followed warble", html)
+            self.assertNotIn("stranger warble", html)
+
+            html = c.get("/?feed=global").get_data(as_text=True)
+            self.assertIn("stranger warble", html)
+            self.assertTrue(firehose.loaded)
+            self.assertEqual(len(firehose), 3)
+
+            # posting and deleting update the buffer in place
+            c.post("/messages/new", data={"text": "fresh warble"})
+            c.post("/messages/1111/delete")
+
+            html = c.get("/?feed=global").get_data(as_text=True)
+            self.assertIn("fresh warble", html)
+            self.assertNotIn("testtesttest", html)
+            self.assertEqual(len(firehose), 3)
+
+            self.assertEqual(c.get("/?feed=bogus").status_code, 404)
+
+    def test_firehose_workers_interleave(self):
+        """ a refresh picks up other workers' posts below our own """
+
+        here, there = Firehose(), Firehose()
+        here_ids = SnowflakeGenerator(worker_id=2)
+        there_ids = SnowflakeGenerator(worker_id=1)
+        here.refresh()
+        there.refresh()
+
+        # made in the other worker first, committed after ours
+        early = Message(id=there_ids.next_id(), text="early warble",
+                        user_id=1111)
+        mine = Message(id=here_ids.next_id(), text="my warble", user_id=1111)
+        db.session.add(mine)
+        db.session.commit()
+        here.push(mine)
+        here.refresh()
+
+        db.session.add(early)
+        db.session.commit()
+        there.push(early)
+        self.assertLess(early.id, mine.id)
+
+        here.refresh()
+        texts = [item.text for item in here.page()[0]]
+        self.assertEqual(texts, ["my warble", "early warble", "testtesttest"])
+
+        # refreshing again doesn't duplicate anything
+        here.refresh()
+        self.assertEqual(len(here), 3)
@@ -0,0 +1,96 @@
+"""Notification inbox tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Notification
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+from notifications import notify_like
+
+db.create_all()
+
+
+class NotificationTestCase(TestCase):
+    """Test filling, coalescing, trimming and reading the inbox."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for n in range(1, 6):
+            db.session.add(User(id=n, username=f"user{n}",
+                                email=f"user{n}@test.com", password="x"))
+        db.session.commit()
+
+        db.session.add_all([Message(id=n, text=f"warble {n}", user_id=1)
+                            for n in range(1, 4)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_likes_coalesce(self):
+        """ a burst of likes is one notification with a count """
+
+        for liker in (2, 3, 4, 4):
+            notify_like(1, liker)
+        notify_like(1, 1)
+
+        note = Notification.query.one()
+        self.assertEqual((note.user_id, note.count, note.actor_id), (1, 3, 4))
+        self.assertEqual(User.query.get(1).unread_notifications, 1)
+
+    def test_relike_counted_once(self):
+        """ someone liking again after others doesn't count twice """
+
+        for liker in (2, 3, 2):
+            notify_like(1, liker)
+
+        note = Notification.query.one()
+        self.assertEqual((note.count, note.actor_id), (2, 3))
+
+    def test_inbox_is_capped(self):
+        """ only the newest notifications are kept, and the count follows """
+
+        for message_id in (1, 2, 3):
+            notify_like(message_id, 2, keep=2)
+
+        self.assertEqual(
+            sorted(n.message_id for n in Notification.query.all()), [2, 3])
+        self.assertEqual(User.query.get(1).unread_notifications, 2)
+
+    def test_mention_and_like_views(self):
+        """ mentions and likes reach the inbox, which marks them seen """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            c.post("/messages/new", data={"text": "hey @user1"})
+            c.post("/users/add_like/1")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('badge-danger">2</span>', html)
+
+            html = c.get("/notifications").get_data(as_text=True)
+            self.assertIn("mentioned you", html)
+            self.assertIn("liked your warble", html)
+            self.assertNotIn("badge-danger", html)
+
+            self.assertEqual(User.query.get(1).unread_notifications, 0)
+            self.assertFalse(Notification.query.filter_by(seen=False).count())
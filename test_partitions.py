@@ -0,0 +1,141 @@
+"""Message partitioning and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Likes, MessageArchive, ArchivedPartition
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+from ids import min_id_for
+from partitions import (archive_before, message_router, partition_for,
+                        partition_for_id)
+
+db.create_all()
+
+
+class PartitionTestCase(TestCase):
+    """Test archiving old months of messages."""
+
+    def setUp(self):
+        """Create two users with messages in Jan, Feb and Mar 2024."""
+
+        db.drop_all()
+        db.create_all()
+        message_router.invalidate()
+
+        db.session.add_all([
+            User(id=1, username="user1", email="user1@test.com", password="x"),
+            User(id=2, username="user2", email="user2@test.com", password="x"),
+        ])
+        db.session.commit()
+
+        for month in (1, 2, 3):
+            base = min_id_for(datetime(2024, month, 1))
+            for n in range(3):
+                for user_id in (1, 2):
+                    db.session.add(Message(
+                        id=base + n * 10 + user_id,
+                        text=f"u{user_id} m{month} n{n}",
+                        timestamp=datetime(2024, month, 1 + n),
+                        user_id=user_id))
+        db.session.commit()
+
+        self.jan_msg = min_id_for(datetime(2024, 1, 1)) + 1
+        db.session.add(Likes(user_id=2, message_id=self.jan_msg))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_partition_bounds(self):
+        """ test months map to contiguous id ranges """
+
+        jan = partition_for(datetime(2024, 1, 15))
+        feb = partition_for(datetime(2024, 2, 1))
+
+        self.assertEqual(jan.name, "messages_p2024_01")
+        self.assertEqual(jan.max_id, feb.min_id)
+        self.assertEqual(partition_for_id(self.jan_msg), jan)
+
+    def test_archive(self):
+        """ test whole months before the cutoff move into the archive """
+
+        archived = archive_before(datetime(2024, 3, 10), chunk_rows=2)
+
+        self.assertEqual([p.name for p in archived],
+                         ["messages_p2024_01", "messages_p2024_02"])
+        self.assertEqual(ArchivedPartition.query.get("messages_p2024_01").row_count, 6)
+        self.assertEqual(Message.query.count(), 6)
+        self.assertEqual(Likes.query.count(), 0)
+        # 3 messages per user per month, at most 2 per chunk
+        self.assertEqual(MessageArchive.query.count(), 8)
+
+        older = message_router.archived_user_messages(1, limit=4)
+        self.assertEqual([m.text for m in older],
+                         ["u1 m2 n2", "u1 m2 n1", "u1 m2 n0", "u1 m1 n2"])
+
+        liked = message_router.find_archived(self.jan_msg)
+        self.assertEqual(liked.text, "u1 m1 n0")
+        self.assertEqual(liked.liker_ids, [2])
+
+    def test_profile_reads_archive(self):
+        """ test profile and permalink pages fall back to the archive """
+
+        archive_before(datetime(2024, 3, 10))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            html = c.get("/users/1").get_data(as_text=True)
+            self.assertIn("u1 m3 n2", html)
+            self.assertIn("u1 m1 n0", html)
+
+            res = c.get(f"/messages/{self.jan_msg}")
+            self.assertEqual(res.status_code, 200)
+            self.assertIn("u1 m1 n0", res.get_data(as_text=True))
+
+    def test_archive_legacy(self):
+        """ test legacy serial ids are archived by timestamp, not id """
+
+        db.session.add_all([
+            Message(id=1, text="legacy old", user_id=1,
+                    timestamp=datetime(2022, 6, 1)),
+            Message(id=2, text="legacy older", user_id=2,
+                    timestamp=datetime(2022, 5, 1)),
+            Message(id=3, text="legacy recent", user_id=1,
+                    timestamp=datetime(2024, 3, 5)),
+        ])
+        db.session.commit()
+
+        archived = archive_before(datetime(2024, 3, 10))
+
+        # the snowflake months wait until no legacy rows are hot
+        self.assertEqual([p.name for p in archived],
+                         ["messages_legacy_before_2024_03"])
+        self.assertEqual(archived[0].row_count, 2)
+        self.assertEqual(Message.query.get(3).text, "legacy recent")
+        self.assertEqual(Message.query.count(), 19)
+        self.assertEqual(message_router.find_archived(2).text,
+                         "legacy older")
+
+        self.assertEqual(archive_before(datetime(2024, 3, 10)), [])
+
+        archived = archive_before(datetime(2024, 4, 10))
+        self.assertEqual([p.name for p in archived],
+                         ["messages_legacy_before_2024_04",
+                          "messages_p2024_01", "messages_p2024_02",
+                          "messages_p2024_03"])
+        self.assertEqual(Message.query.count(), 0)
@@ -0,0 +1,118 @@
+"""Write rate limit tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+from cache import LocalSharedCache
+from ratelimit import TokenBuckets, rate_limits
+
+db.create_all()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTestCase(TestCase):
+    """Test bursts, refills and the shared backend."""
+
+    def check_bucket(self, buckets, clock):
+        for _ in range(3):
+            self.assertTrue(buckets.hit('like', 1).allowed)
+
+        decision = buckets.hit('like', 1)
+        self.assertFalse(decision.allowed)
+        self.assertAlmostEqual(decision.retry_after, 20)
+
+        # other users and actions have their own buckets
+        self.assertTrue(buckets.hit('like', 2).allowed)
+        self.assertTrue(buckets.hit('follow', 1).allowed)
+
+        clock.now += 20
+        self.assertEqual(buckets.hit('like', 1), (True, 0, 0.0))
+        self.assertFalse(buckets.hit('like', 1).allowed)
+
+    def test_local(self):
+        """ a burst is allowed, then one token per refill interval """
+
+        clock = FakeClock()
+        self.check_bucket(
+            TokenBuckets({'like': (3, 60), 'follow': (1, 60)}, clock), clock)
+
+    def test_shared(self):
+        """ the shared backend gives the same answers """
+
+        clock = FakeClock()
+        buckets = TokenBuckets({'like': (3, 60), 'follow': (1, 60)}, clock)
+        buckets.shared = LocalSharedCache()
+        self.check_bucket(buckets, clock)
+
+    def test_prune(self):
+        """ refilled buckets are dropped once there are too many """
+
+        clock = FakeClock()
+        buckets = TokenBuckets({'like': (3, 60)}, clock)
+        buckets.max_buckets = 2
+
+        buckets.hit('like', 1)
+        clock.now += 60
+        buckets.hit('like', 2)
+        buckets.hit('like', 3)
+        self.assertEqual(sorted(buckets._buckets), [('like', 2), ('like', 3)])
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test limited routes."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([
+            User(id=1, username="user1", email="user1@test.com", password="x"),
+            User(id=2, username="user2", email="user2@test.com", password="x"),
+        ])
+        db.session.add(Message(id=1, text="likeable", user_id=2))
+        db.session.commit()
+
+        rate_limits.reset()
+
+    def tearDown(self):
+        rate_limits.limits = dict(app.config['RATE_LIMITS'])
+        rate_limits.reset()
+
+    def test_like_limited(self):
+        """ over quota, the route answers 429 with Retry-After """
+
+        rate_limits.limits['like'] = (2, 60)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            self.assertEqual(c.post("/users/add_like/1").status_code, 302)
+            self.assertEqual(c.post("/users/add_like/1").status_code, 302)
+
+            res = c.post("/users/add_like/1")
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(res.headers['Retry-After'], "30")
+            self.assertIn("liking warbles too quickly",
+                          res.get_data(as_text=True))
+
+            # other writes aren't affected
+            self.assertEqual(c.post("/users/follow/2").status_code, 302)
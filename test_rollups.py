@@ -0,0 +1,144 @@
+"""Daily rollup tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_rollups.py
+
+
+import os
+from datetime import date, datetime, timedelta
+from unittest import TestCase
+
+from models import (db, User, Message, Likes, Follows, DailyStats,
+                    DailyTopPoster)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+from ids import min_id_for
+from rollups import rollups
+
+db.create_all()
+
+DAY = date(2024, 3, 1)
+NOON = datetime(2024, 3, 1, 12)
+
+
+class RollupTestCase(TestCase):
+    """Test rolling up days and the stats endpoints."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([
+            User(id=n, username=f"user{n}", email=f"user{n}@test.com",
+                 password="x") for n in range(1, 5)])
+
+        # user 1 posts three warbles that day, user 2 one, user 3 one the
+        # day after
+        db.session.add_all([
+            Message(id=min_id_for(NOON) + n, user_id=user_id,
+                    text="warble", timestamp=NOON)
+            for n, user_id in enumerate((1, 1, 1, 2))])
+        db.session.add(Message(id=min_id_for(NOON + timedelta(days=1)),
+                               user_id=3, text="later",
+                               timestamp=NOON + timedelta(days=1)))
+        db.session.flush()
+
+        first = min_id_for(NOON)
+        db.session.add_all([
+            Likes(user_id=4, message_id=first, timestamp=NOON),
+            Likes(user_id=2, message_id=first, timestamp=NOON),
+            Follows(user_following_id=4, user_being_followed_id=1,
+                    timestamp=NOON),
+            Follows(user_following_id=1, user_being_followed_id=3,
+                    timestamp=NOON - timedelta(days=3)),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_rollup_day(self):
+        """ a day's totals count only that day, and re-running is safe """
+
+        rollups.rollup_day(DAY)
+        rollups.rollup_day(DAY)
+
+        stats = DailyStats.query.get(DAY)
+        self.assertEqual((stats.messages, stats.likes, stats.follows,
+                          stats.active_users), (4, 2, 1, 3))
+
+        top = (DailyTopPoster.query
+               .filter_by(day=DAY)
+               .order_by(DailyTopPoster.messages.desc())
+               .all())
+        self.assertEqual([(p.user_id, p.messages) for p in top],
+                         [(1, 3), (2, 1)])
+
+    def test_backfill(self):
+        """ the backfill covers every day from the oldest activity """
+
+        days = rollups.backfill(until=DAY + timedelta(days=1))
+        self.assertEqual(days, 5)
+        self.assertEqual(DailyStats.query.count(), 5)
+
+        recent = rollups.recent(days=7, now=NOON + timedelta(days=1))
+        self.assertEqual([d.day for d in recent][:2],
+                         [DAY + timedelta(days=1), DAY])
+        self.assertEqual(recent[0].messages, 1)
+        self.assertEqual(recent[0].top_posters, [(3, 1)])
+        self.assertEqual(recent[-1].follows, 1)
+
+    def test_legacy_ids(self):
+        """ pre-snowflake serial ids are counted by their timestamps """
+
+        db.session.add_all([
+            Message(id=7, user_id=2, text="legacy", timestamp=NOON),
+            Message(id=8, user_id=2, text="legacy",
+                    timestamp=NOON - timedelta(days=5)),
+        ])
+        db.session.commit()
+
+        # today's refreshes don't look for legacy messages...
+        rollups.rollup_day(DAY)
+        self.assertEqual(DailyStats.query.get(DAY).messages, 4)
+
+        rollups.rollup_day(date(2023, 1, 1), legacy=True)
+        self.assertEqual(DailyStats.query.get(date(2023, 1, 1)).messages, 0)
+
+        # ...the backfill does
+        days = rollups.backfill(until=DAY)
+        self.assertEqual(days, 6)
+        self.assertEqual(DailyStats.query.get(DAY).messages, 5)
+
+    def test_stats_views(self):
+        """ admins see the rollups as a page and as JSON """
+
+        rollups.rollup_day(date.today())
+        rollups.rollup_day(date.today() - timedelta(days=1))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            self.assertEqual(c.get("/admin/stats.json").status_code, 403)
+
+            User.query.get(1).is_admin = True
+            db.session.commit()
+
+            res = c.get("/admin/stats.json?days=1")
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(
+                res.json['days'],
+                [{'day': date.today().isoformat(), 'messages': 0, 'likes': 0,
+                  'follows': 0, 'active_users': 0, 'top_posters': []}])
+
+            self.assertEqual(c.get("/admin/stats?days=0").status_code, 400)
+
+            res = c.get("/admin/stats")
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('id="daily-stats"', res.get_data(as_text=True))
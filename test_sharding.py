@@ -0,0 +1,356 @@
+"""Shard router tests, against several local SQLite databases."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import func, select
+
+from models import (db, User, Message, Likes, Follows, Mention, MessageTag,
+                    Notification, ShardAssignment, DailyStats)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app, CURR_USER_KEY
+from cache import permalinks
+from deletion import deactivate_user, purge_user
+from export import iter_records
+from feeds import Firehose
+from follow_graph import FollowGraph
+from rollups import rollups
+from sharding import ShardRouter, shard_router
+
+db.create_all()
+
+SHARDS = ('a', 'b', 'c')
+
+
+def populate(router, tmpdir):
+    """Shards in `tmpdir`, and users 1-6 with two messages each.
+
+    User 1 follows users 2-5 and likes message 21.
+    """
+
+    router.configure({
+        name: f"sqlite:///{os.path.join(tmpdir, name)}.db"
+        for name in SHARDS})
+    router.create_all()
+
+    db.session.add_all([
+        User(id=n, username=f"user{n}", email=f"user{n}@test.com",
+             password="x") for n in range(1, 7)])
+    db.session.commit()
+
+    start = datetime(2024, 1, 1)
+    for user_id in range(1, 7):
+        with router.session_for(user_id) as session:
+            session.add_all([
+                Message(id=user_id * 10 + n, user_id=user_id,
+                        text=f"user{user_id} warble {n}",
+                        timestamp=start + timedelta(minutes=n))
+                for n in (1, 2)])
+            if user_id == 1:
+                session.add_all([
+                    Follows(user_following_id=1,
+                            user_being_followed_id=other)
+                    for other in range(2, 6)])
+                session.add(Likes(user_id=1, message_id=21))
+
+
+class ShardRouterTestCase(TestCase):
+    """Test placement, scatter-gather reads and moving users."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.router = ShardRouter()
+        populate(self.router, self.tmp.name)
+
+    def tearDown(self):
+        self.router.configure({})
+        self.tmp.cleanup()
+        db.session.rollback()
+        db.session.remove()
+
+    def count(self, shard, model, **where):
+        with self.router.session(shard) as session:
+            return session.execute(
+                select(func.count()).select_from(model)
+                .filter_by(**where)).scalar()
+
+    def test_placement(self):
+        """ users spread over the shards; the directory overrides the hash """
+
+        placed = self.router.shards_for(range(1, 7))
+        self.assertEqual(set(placed.values()), set(SHARDS))
+
+        for user_id, shard in placed.items():
+            self.assertEqual(self.count(shard, Message, user_id=user_id), 2)
+
+        other = next(s for s in SHARDS if s != placed[1])
+        self.router.assign(1, other)
+        db.session.commit()
+        self.assertEqual(self.router.shard_for(1), other)
+
+    def test_following_feed(self):
+        """ the feed merges every shard's newest messages """
+
+        messages, cursor = self.router.following_feed(1, per_page=6)
+        self.assertEqual([m.id for m in messages], [52, 51, 42, 41, 32, 31])
+        self.assertEqual(cursor, 31)
+
+        messages, cursor = self.router.following_feed(1, before=cursor,
+                                                      per_page=6)
+        self.assertEqual([m.id for m in messages], [22, 21, 12, 11])
+        self.assertIsNone(cursor)
+
+        # deactivated authors drop out
+        User.query.get(5).deactivated_at = datetime.utcnow()
+        db.session.commit()
+        messages, _ = self.router.following_feed(1, per_page=2)
+        self.assertEqual([m.id for m in messages], [42, 41])
+
+    def test_move_user(self):
+        """ a user's rows follow them to the new shard """
+
+        old = self.router.shard_for(1)
+        new = next(s for s in SHARDS if s != old)
+
+        moved = self.router.move_user(1, new, chunk_size=1)
+        self.assertEqual(moved, 2 + 4 + 1)
+
+        self.assertEqual(ShardAssignment.query.get(1).shard, new)
+        self.assertEqual(self.router.shard_for(1), new)
+        self.assertEqual(self.count(new, Follows, user_following_id=1), 4)
+        self.assertEqual(self.count(new, Likes, user_id=1), 1)
+        self.assertEqual(self.count(old, Message, user_id=1), 0)
+
+        messages, _ = self.router.following_feed(1)
+        self.assertEqual(len(messages), 10)
+
+        self.assertEqual(self.router.pin_users(chunk_size=2), 5)
+        self.assertEqual(ShardAssignment.query.count(), 6)
+
+    def test_move_user_resumes(self):
+        """ a move that failed after repointing finishes when re-run """
+
+        old = self.router.shard_for(1)
+        new = next(s for s in SHARDS if s != old)
+
+        def shard_down(fn, shards):
+            raise RuntimeError("shard down")
+
+        self.router.scatter = shard_down
+        with self.assertRaises(RuntimeError):
+            self.router.move_user(1, new)
+        del self.router.scatter
+
+        self.assertEqual(self.router.shard_for(1), new)
+        self.assertEqual(self.count(old, Message, user_id=1), 2)
+
+        self.assertEqual(self.router.move_user(1, new), 0)
+        self.assertEqual(self.count(old, Message, user_id=1), 0)
+        self.assertEqual(self.count(old, Follows, user_following_id=1), 0)
+        self.assertEqual(self.count(new, Message, user_id=1), 2)
+        self.assertEqual(self.count(new, Follows, user_following_id=1), 4)
+
+    def test_writes(self):
+        """ posts, likes and follows land on their owners' shards """
+
+        msg, mentioned = self.router.add_message(6, "sharded @user1 #warble")
+        self.assertEqual(mentioned, 1)
+        self.assertEqual(
+            self.count(self.router.shard_for(6), Message, id=msg.id), 1)
+        self.assertEqual(self.router.find_message(msg.id).text,
+                         "sharded @user1 #warble")
+        self.assertIsNone(self.router.find_message(1))
+
+        delta, _ = self.router.toggle_like(1, msg)
+        self.assertEqual(delta, +1)
+        self.assertEqual(self.count(self.router.shard_for(1), Likes,
+                                    user_id=1, message_id=msg.id), 1)
+        self.assertEqual(self.router.find_message(msg.id).like_count, 1)
+
+        delta, _ = self.router.toggle_like(1, msg)
+        self.assertEqual(delta, -1)
+        self.assertEqual(self.router.find_message(msg.id).like_count, 0)
+
+        self.router.follow(1, 6)
+        self.router.follow(1, 6)
+        self.assertEqual(self.count(self.router.shard_for(1), Follows,
+                                    user_following_id=1), 5)
+        messages, _ = self.router.following_feed(1, per_page=1)
+        self.assertEqual([m.id for m in messages], [msg.id])
+
+        self.router.unfollow(1, 6)
+        self.assertEqual(self.count(self.router.shard_for(1), Follows,
+                                    user_following_id=1), 4)
+
+        self.assertFalse(self.router.delete_message(1, msg.id))
+        self.assertTrue(self.router.delete_message(6, msg.id))
+        self.assertIsNone(self.router.find_message(msg.id))
+        self.assertEqual(self.count(self.router.shard_for(6), Mention), 0)
+        self.assertEqual(self.count(self.router.shard_for(6), MessageTag), 0)
+
+    def test_move_user_with_mentions(self):
+        """ a message's mention and tag rows move with it """
+
+        msg, _ = self.router.add_message(6, "hi @user1 #moving")
+        old = self.router.shard_for(6)
+        new = next(s for s in SHARDS if s != old)
+
+        self.assertEqual(self.router.move_user(6, new), 2 + 1 + 1 + 1)
+        self.assertEqual(self.count(new, Mention, message_id=msg.id), 1)
+        self.assertEqual(self.count(new, MessageTag, tag='moving'), 1)
+        self.assertEqual(self.count(old, Mention), 0)
+        self.assertEqual(self.count(old, MessageTag), 0)
+
+
+class ShardedReadsTestCase(TestCase):
+    """Test that pages, counts and background jobs read the shards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        populate(shard_router, self.tmp.name)
+        # user 3 follows 2 too, likely from another shard than user 1's
+        shard_router.follow(3, 2)
+        permalinks.clear()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def tearDown(self):
+        shard_router.configure({})
+        self.tmp.cleanup()
+        permalinks.clear()
+        db.session.rollback()
+        db.session.remove()
+
+    def get(self, url):
+        resp = self.client.get(url)
+        return resp.status_code, resp.get_data(as_text=True)
+
+    def test_user_pages(self):
+        """ profiles, follows, likes and permalinks come off the shards """
+
+        status, html = self.get('/users/2')
+        self.assertEqual(status, 200)
+        self.assertIn("user2 warble 2", html)
+
+        status, html = self.get('/users/1/following')
+        for n in range(2, 6):
+            self.assertIn(f"<p>@user{n}</p>", html)
+
+        status, html = self.get('/users/2/followers')
+        self.assertIn("<p>@user1</p>", html)
+        self.assertIn("<p>@user3</p>", html)
+
+        status, html = self.get('/users/1/likes')
+        self.assertIn("user2 warble 1", html)
+
+        status, html = self.get('/messages/21')
+        self.assertEqual(status, 200)
+        self.assertIn("user2 warble 1", html)
+        self.assertEqual(self.get('/messages/99')[0], 404)
+
+        User.query.get(5).deactivated_at = datetime.utcnow()
+        db.session.commit()
+        status, html = self.get('/users/1/following')
+        self.assertNotIn("<p>@user5</p>", html)
+        self.assertEqual(self.get('/messages/51')[0], 404)
+
+    def test_counts(self):
+        """ counts add up the user's rows wherever they live """
+
+        user1, user2 = User.query.get(1), User.query.get(2)
+        self.assertEqual(user1.message_count, 2)
+        self.assertEqual(user1.following_count, 4)
+        self.assertEqual(user1.likes_count, 1)
+        self.assertEqual(user2.followers_count, 2)
+        self.assertTrue(user1.is_following(user2))
+        self.assertTrue(user2.is_followed_by(user1))
+        self.assertFalse(user2.is_following(user1))
+
+    def test_export(self):
+        """ an export has the user's own rows and followers from any shard """
+
+        kinds = [(r['type'], r.get('id') or r.get('followed_id'))
+                 for r in iter_records(2)]
+        self.assertIn(('message', 21), kinds)
+        self.assertEqual(kinds.count(('follow', 2)), 2)
+
+        kinds = [(r['type'], r.get('message_id') or r.get('followed_id'))
+                 for r in iter_records(1)]
+        self.assertIn(('like', 21), kinds)
+        self.assertEqual(len([k for k in kinds if k[0] == 'follow']), 4)
+
+    def test_purge(self):
+        """ purging a user clears their rows off every shard """
+
+        deactivate_user(User.query.get(2))
+        db.session.commit()
+        job = purge_user(2, batch_size=1)
+        self.assertEqual(job.stage, 'done')
+
+        counts = shard_router.everywhere(lambda session: (
+            session.query(Message).filter_by(user_id=2).count(),
+            session.query(Likes).filter_by(message_id=21).count(),
+            session.query(Follows)
+            .filter_by(user_being_followed_id=2).count()))
+        self.assertEqual([sum(c) for c in zip(*counts)], [0, 0, 0])
+        self.assertEqual(job.rows_deleted, 2 + 1 + 2)
+
+    def test_background_reads(self):
+        """ firehose, follow graph and rollups see every shard """
+
+        feed = Firehose(size=100)
+        feed.refresh()
+        messages, _ = feed.page(None)
+        self.assertEqual(len(messages), 12)
+        self.assertEqual(messages[0].id, 62)
+
+        graph = FollowGraph()
+        graph.load(chunk_size=2)
+        self.assertEqual(sorted(graph.following(1)), [2, 3, 4, 5])
+        self.assertEqual(sorted(graph.following(3)), [2])
+
+        rollups.rollup_day(datetime(2024, 1, 1).date(), legacy=True)
+        stats = DailyStats.query.get(datetime(2024, 1, 1).date())
+        self.assertEqual((stats.messages, stats.active_users), (12, 6))
+
+    def test_mentions_and_notifications(self):
+        """ mentions and tags are indexed on the author's shard and notify """
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 6
+        self.client.post('/messages/new',
+                         data={'text': "hey @user1 #Sharded"})
+        self.client.post('/users/add_like/11')
+
+        mentions = shard_router.everywhere(
+            lambda session: session.query(Mention).count())
+        self.assertEqual(sum(mentions), 1)
+
+        self.assertIn("<p>hey <a", self.get('/users/1/mentions')[1])
+        self.assertIn("<p>hey <a", self.get('/tags/sharded')[1])
+
+        self.assertEqual(Notification.query.count(), 2)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        status, html = self.get('/notifications')
+        self.assertIn("mentioned you", html)
+        self.assertIn("liked your warble", html)
+        self.assertIn("user1 warble 1", html)
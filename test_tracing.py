@@ -0,0 +1,135 @@
+"""Request tracing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tracing.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import create_app, CURR_USER_KEY
+from config import TestConfig
+from tasks import tasks
+from tracing import OTLPFileExporter, parse_traceparent, to_otlp, tracer
+
+
+class TracedConfig(TestConfig):
+    TRACING_ENABLED = True
+    TRACING_EXPORTER = 'memory'
+
+
+app = create_app(TracedConfig)
+
+with app.app_context():
+    db.create_all()
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+
+
+class TracingTestCase(TestCase):
+    """Test request spans, propagation and export."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            User.signup("tracer", "tracer@test.com", "password", None)
+            db.session.flush()
+            user = User.query.filter_by(username="tracer").one()
+            db.session.add(Message(text="traced warble", user_id=user.id))
+            db.session.commit()
+            self.user_id = user.id
+
+        tracer.exporter.clear()
+
+    def test_request_spans(self):
+        """ a request's SQL, templates and cache lookups share its trace """
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            res = c.get(f"/users/{self.user_id}")
+            res.get_data()
+            self.assertEqual(res.status_code, 200)
+
+        spans = list(tracer.exporter.spans)
+        root = spans[-1]
+        self.assertEqual(root.name, "GET /users/<int:user_id>")
+        self.assertEqual(root.attributes['http.status_code'], 200)
+        self.assertIsNone(root.parent_id)
+
+        names = [span.name for span in spans]
+        self.assertIn("sql SELECT", names)
+        self.assertIn("render users/show.html", names)
+        self.assertIn("cache recent_messages", names)
+        self.assertEqual({span.trace_id for span in spans}, {root.trace_id})
+
+        ids = {span.span_id for span in spans}
+        self.assertTrue(all(span.parent_id in ids
+                            for span in spans if span is not root))
+
+        encoded = json.loads(json.dumps(to_otlp(spans)))
+        otlp_spans = encoded['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual(len(otlp_spans), len(spans))
+        self.assertEqual(otlp_spans[-1]['kind'], 2)
+
+    def test_propagation(self):
+        """ traceparent continues a trace, and tasks run inside it """
+
+        self.assertEqual(parse_traceparent(f"00-{TRACE_ID}-00f067aa0ba902b7-01"),
+                         (TRACE_ID, '00f067aa0ba902b7', True))
+        self.assertIsNone(parse_traceparent("garbage"))
+
+        with app.test_client() as c:
+            c.post("/login", data={'username': "tracer",
+                                   'password': "password"},
+                   headers={'traceparent':
+                            f"00-{TRACE_ID}-00f067aa0ba902b7-01"})
+
+        spans = list(tracer.exporter.spans)
+        root = spans[-1]
+        self.assertEqual(root.trace_id, TRACE_ID)
+        self.assertEqual(root.parent_id, '00f067aa0ba902b7')
+        self.assertIn("bcrypt.check", [span.name for span in spans])
+
+        tracer.exporter.clear()
+        with app.app_context():
+            with tracer.trace("outer") as outer:
+                tasks.enqueue(User.query.count)
+
+        task, = [s for s in tracer.exporter.spans
+                 if s.name == "task Query.count"]
+        self.assertEqual(task.parent_id, outer.span_id)
+        sql = [s for s in tracer.exporter.spans
+               if s.parent_id == task.span_id]
+        self.assertTrue(sql and sql[0].name.startswith("sql"))
+
+    def test_file_exporter(self):
+        """ the file exporter writes one OTLP/JSON request per line """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "traces.jsonl")
+            exporter = OTLPFileExporter(path)
+
+            with app.app_context():
+                with tracer.trace("one") as span:
+                    pass
+            exporter.export([span])
+            exporter.export([span])
+
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+
+        self.assertEqual(len(lines), 2)
+        resource = lines[0]['resourceSpans'][0]
+        self.assertEqual(resource['resource']['attributes'][0]['value'],
+                         {'stringValue': 'warbler'})
+        self.assertEqual(resource['scopeSpans'][0]['spans'][0]['name'], "one")
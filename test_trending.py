@@ -0,0 +1,83 @@
+"""Trending counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
+
+from app import app
+from trending import TrendingCounter
+
+db.create_all()
+
+
+class TrendingTestCase(TestCase):
+    """Test windowed like counts."""
+
+    def setUp(self):
+        """Create users, messages and likes of different ages."""
+
+        db.drop_all()
+        db.create_all()
+
+        for n in range(1, 4):
+            db.session.add(User(id=n, username=f"user{n}",
+                                email=f"user{n}@test.com", password="x"))
+            db.session.add(Message(id=n, text=f"msg{n}", user_id=1,
+                                   timestamp=datetime.utcnow()))
+        db.session.commit()
+
+        now = datetime.utcnow()
+        db.session.add_all([
+            Likes(user_id=2, message_id=1, timestamp=now - timedelta(minutes=5)),
+            Likes(user_id=2, message_id=2, timestamp=now - timedelta(hours=5)),
+            Likes(user_id=3, message_id=3, timestamp=now - timedelta(days=3)),
+        ])
+        db.session.commit()
+
+        self.counter = TrendingCounter(bucket_seconds=60)
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_windows(self):
+        """ test each window only ranks likes inside it """
+
+        self.counter.compact()
+
+        self.assertEqual(self.counter.top('1h'), [(1, 1)])
+        self.assertEqual(self.counter.top('24h'), [(2, 1), (1, 1)])
+        self.assertEqual(self.counter.top('7d'), [(3, 1), (2, 1), (1, 1)])
+
+    def test_record(self):
+        """ test likes and unlikes update counts after the next compaction """
+
+        self.counter.compact()
+        self.counter.record(2, +1)
+        self.counter.record(2, +1)
+        self.counter.record(1, -1)
+
+        # served from the precomputed list until compaction
+        self.assertEqual(self.counter.top('1h'), [(1, 1)])
+
+        self.counter.compact()
+        self.assertEqual(self.counter.top('1h'), [(2, 2)])
+        self.assertEqual(self.counter.top('24h'), [(2, 3)])
+
+    def test_expiry(self):
+        """ test buckets older than the longest window are dropped """
+
+        self.counter.compact(now=(datetime.utcnow() + timedelta(days=8)).timestamp())
+
+        self.assertEqual(self.counter.top('7d'), [])
+        self.assertEqual(self.counter._buckets, {})
@@ -5,10 +5,12 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import json
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, Message, User, Likes, Follows, AccountDeletion
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,6 +18,7 @@ from models import db, connect_db, Message, User, Likes, Follows
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+os.environ['WARBLER_CONFIG'] = "test"
 
 
 # Now we can import app
@@ -130,6 +133,45 @@ class UserViewTestCase(TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertIn("Edited", html)
 
+    def test_user_page_pagination(self):
+        """ test profile pages newest-first by message id with a cursor """
+
+        for n in range(105):
+            db.session.add(Message(text=f"warble number {n}.", user_id=self.user2.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+
+            html = c.get("/users/222").get_data(as_text=True)
+            self.assertIn("warble number 104.", html)
+            self.assertIn("warble number 5.", html)
+            self.assertNotIn("warble number 4.", html)
+            self.assertIn('id="older-messages"', html)
+
+            oldest_shown = Message.query.filter_by(text="warble number 5.").one()
+            html = c.get(f"/users/222?before={oldest_shown.id}").get_data(as_text=True)
+            self.assertIn("warble number 4.", html)
+            self.assertIn("warble number 0.", html)
+            self.assertNotIn("warble number 5.", html)
+            self.assertNotIn('id="older-messages"', html)
+
+    def test_user_page_streamed(self):
+        """ test long list pages are streamed and flashes shown only once """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+                sess['_flashes'] = [('info', 'Flashed once')]
+
+            res = c.get("/")
+            self.assertTrue(res.is_streamed)
+            self.assertIn("Flashed once", res.get_data(as_text=True))
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("Flashed once", html)
+
     def test_user_page(self):
         """ test user detail page """
 
@@ -190,6 +232,77 @@ class UserViewTestCase(TestCase):
             self.assertIn("@user2", html)
             self.assertIn("@user3", html)
             self.assertIn("@user4", html)
+            self.assertNotIn('action="/users/stop-following/', html)
+
+            db.session.add(Follows(user_being_followed_id=333,
+                                   user_following_id=111))
+            db.session.commit()
+
+            html = c.get(url).get_data(as_text=True)
+            self.assertIn('action="/users/stop-following/333"', html)
+            self.assertIn('action="/users/follow/222"', html)
+
+    def test_followers_pagination(self):
+        """ test followers newest-first, paged by cursor """
+
+        for n in range(1, 66):
+            db.session.add(User(id=1000 + n, username=f"fan{n}",
+                                email=f"fan{n}@test.com", password="x"))
+        db.session.flush()
+        for n in range(1, 66):
+            db.session.add(Follows(user_being_followed_id=111,
+                                   user_following_id=1000 + n,
+                                   timestamp=datetime(2024, 1, 1) + timedelta(minutes=n)))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+
+            html = c.get("/users/111/followers").get_data(as_text=True)
+            self.assertIn("@fan65<", html)
+            self.assertIn("@fan6<", html)
+            self.assertNotIn("@fan5<", html)
+            self.assertIn('id="older-users"', html)
+            self.assertIn("Followers</p>\n            <h4>\n              <a href=\"/users/111/followers\">65</a>", html)
+
+            cursor = "2024-01-01T00:06:00_1006"
+            html = c.get(f"/users/111/followers?before={cursor}").get_data(as_text=True)
+            self.assertIn("@fan5<", html)
+            self.assertNotIn("@fan6<", html)
+            self.assertNotIn('id="older-users"', html)
+
+            self.assertEqual(c.get("/users/111/followers?before=junk").status_code, 400)
+
+    def test_likes_pagination(self):
+        """ test likes newest-first, paged by cursor """
+
+        for n in range(1, 66):
+            db.session.add(Message(id=5000 + n, text=f"liked warble {n}!",
+                                   user_id=222))
+        db.session.flush()
+        for n in range(1, 66):
+            db.session.add(Likes(user_id=111, message_id=5000 + n,
+                                 timestamp=datetime(2024, 1, 1) + timedelta(minutes=n)))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+
+            res = c.get("/users/111/likes")
+            self.assertEqual(res.status_code, 200)
+            html = res.get_data(as_text=True)
+            self.assertIn("liked warble 65!", html)
+            self.assertIn("liked warble 6!", html)
+            self.assertNotIn("liked warble 5!", html)
+            self.assertIn("before=2024-01-01T00%3A06%3A00_5006", html)
+
+            cursor = "2024-01-01T00:06:00_5006"
+            html = c.get(f"/users/111/likes?before={cursor}").get_data(as_text=True)
+            self.assertIn("liked warble 5!", html)
+            self.assertNotIn("liked warble 6!", html)
+            self.assertNotIn('id="older-messages"', html)
 
     def test_user_likes(self):
         """ test user likes """
@@ -224,6 +337,37 @@ class UserViewTestCase(TestCase):
             self.assertIn("hi", html)
             self.assertIn("@user2", html)
 
+    def test_export(self):
+        """ test exporting your own data as NDJSON and CSV """
+
+        m1 = Message(text="exported warble", user_id=self.user1.id)
+        f1 = Follows(user_being_followed_id=222, user_following_id=111)
+        f2 = Follows(user_being_followed_id=111, user_following_id=333)
+        db.session.add_all([m1, f1, f2])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+
+            res = c.get("/users/111/export.ndjson")
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.is_streamed)
+            records = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+            self.assertEqual([r['type'] for r in records], ['user', 'message', 'follow', 'follow'])
+            self.assertEqual(records[0]['username'], 'user1')
+            self.assertNotIn('password', records[0])
+            self.assertEqual(records[1]['text'], 'exported warble')
+            self.assertEqual(records[3], {'type': 'follow', 'user_id': 333, 'followed_id': 111})
+
+            res = c.get("/users/111/export.csv")
+            lines = res.get_data(as_text=True).splitlines()
+            self.assertTrue(lines[0].startswith("type,id,user_id"))
+            self.assertEqual(len(lines), 5)
+
+            res = c.get("/users/222/export.csv", follow_redirects=True)
+            self.assertIn("Access unauthorized.", res.get_data(as_text=True))
+
     def test_signup_view(self):
         """ test user signup page """
 
@@ -268,3 +412,54 @@ class UserViewTestCase(TestCase):
             html = res.get_data(as_text=True)
 
             self.assertEqual(res.status_code, 302)
+
+    def test_delete_user_purges_rows(self):
+        """ test deleting a user removes their messages and follows in batches """
+
+        m1 = Message(text="bye", user_id=111)
+        m1.id = 111
+        m2 = Message(text="bye again", user_id=111)
+        m2.id = 222
+        f1 = Follows(user_being_followed_id=222, user_following_id=111)
+        f2 = Follows(user_being_followed_id=111, user_following_id=333)
+        db.session.add_all([m1, m2, f1, f2])
+        db.session.commit()
+
+        l1 = Likes(user_id=222, message_id=111)
+        db.session.add(l1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+
+            res = c.post('/users/delete')
+            self.assertEqual(res.status_code, 302)
+
+            self.assertIsNone(User.query.get(111))
+            self.assertEqual(Message.query.filter_by(user_id=111).count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+
+            job = AccountDeletion.query.get(111)
+            self.assertEqual(job.stage, 'done')
+            self.assertEqual(job.rows_deleted, 5)
+
+    def test_deactivated_user_hidden(self):
+        """ test a deactivated user is hidden before their rows are purged """
+
+        user2 = User.query.get(222)
+        user2.deactivated_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+
+            res = c.get('/users')
+            html = res.get_data(as_text=True)
+            self.assertNotIn('@user2', html)
+            self.assertIn('@user3', html)
+
+            res = c.get('/users/222')
+            self.assertEqual(res.status_code, 404)
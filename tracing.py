@@ -0,0 +1,420 @@
+"""Request tracing for Warbler, exported as OTLP JSON.
+
+With TRACING_ENABLED, each sampled request gets a trace: a server span
+for the request, with child spans for every SQL statement, template
+render, bcrypt hash or check (`User.signup` / `User.authenticate`) and
+cache lookup made while handling it. An incoming W3C `traceparent`
+header continues the caller's trace. Work handed to `tasks.enqueue()`
+carries the trace along and runs in its own span under the request's.
+
+Spans are buffered per trace and handed to the exporter when the
+request (or task) span ends:
+
+- 'file' appends one OTLP/JSON `ExportTraceServiceRequest` per line to
+  TRACING_FILE, the layout of the OpenTelemetry collector's file
+  exporter; trace viewers such as Jaeger can load it.
+- 'memory' keeps the most recent TRACING_MEMORY_SPANS spans in
+  `tracer.exporter.spans`, for tests and a debugging shell.
+
+Anything else with an `export(spans)` method works too. With tracing
+off, or outside a sampled trace, `tracer.span()` is a no-op.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from flask import g, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT, CONSUMER = 1, 2, 3, 5
+
+# longest SQL statement kept on a span
+MAX_STATEMENT = 2000
+
+_current = ContextVar('warbler_span', default=None)
+
+
+class Span:
+    """One timed operation in a trace."""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind',
+                 'start_ns', 'end_ns', 'attributes', 'error', '_buffer')
+
+    def __init__(self, name, trace_id, parent_id=None, kind=INTERNAL,
+                 buffer=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+        # spans of this trace finished in this process, exported together
+        self._buffer = [] if buffer is None else buffer
+
+    def child(self, name, kind=INTERNAL, **attributes):
+        return Span(name, self.trace_id, self.span_id, kind, self._buffer,
+                    attributes)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, exc):
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self._buffer.append(self)
+
+
+##############################################################################
+# OTLP/JSON
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{'key': key, 'value': _otlp_value(value)}
+            for key, value in attributes.items()]
+
+
+def _otlp_span(span):
+    encoded = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': span.kind,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': _otlp_attributes(span.attributes),
+        # 1: ok, 2: error
+        'status': ({'code': 2, 'message': span.error} if span.error
+                   else {'code': 1}),
+    }
+    if span.parent_id:
+        encoded['parentSpanId'] = span.parent_id
+    return encoded
+
+
+def to_otlp(spans, service_name='warbler'):
+    """An OTLP/JSON ExportTraceServiceRequest holding `spans`."""
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': _otlp_attributes(
+            {'service.name': service_name})},
+        'scopeSpans': [{
+            'scope': {'name': 'warbler.tracing'},
+            'spans': [_otlp_span(span) for span in spans],
+        }],
+    }]}
+
+
+class OTLPFileExporter:
+    """Appends each batch of spans to `path` as one line of OTLP/JSON."""
+
+    def __init__(self, path, service_name='warbler'):
+        self.path = path
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps(to_otlp(spans, self.service_name),
+                          separators=(',', ':'))
+        with self._lock:
+            with open(self.path, 'a') as out:
+                out.write(line + '\n')
+
+
+class InMemoryExporter:
+    """Keeps the most recent `maxlen` finished spans."""
+
+    def __init__(self, maxlen=10000):
+        self.spans = deque(maxlen=maxlen)
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+    def clear(self):
+        self.spans.clear()
+
+
+##############################################################################
+# Tracer
+
+
+def parse_traceparent(header):
+    """(trace id, parent span id, sampled) from a W3C traceparent, or None."""
+
+    parts = (header or '').strip().split('-')
+    if (len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16
+            or len(parts[3]) != 2):
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return parts[1], parts[2], sampled
+
+
+class Tracer:
+    """Starts, nests and exports spans."""
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.service_name = 'warbler'
+        self.exporter = None
+        self._sql_hooked = False
+
+    def init_app(self, app):
+        """Register defaults on the Flask app, and hooks if enabled."""
+
+        app.config.setdefault('TRACING_ENABLED', False)
+        # 'file', 'memory', or an object with export(spans)
+        app.config.setdefault('TRACING_EXPORTER', 'file')
+        app.config.setdefault('TRACING_FILE', 'traces.jsonl')
+        app.config.setdefault('TRACING_MEMORY_SPANS', 10000)
+        # share of requests traced (a traceparent header overrides it)
+        app.config.setdefault('TRACING_SAMPLE_RATE', 1.0)
+        app.config.setdefault('TRACING_SERVICE_NAME', 'warbler')
+
+        app.extensions['tracer'] = self
+
+        if not app.config['TRACING_ENABLED']:
+            return
+
+        self.enabled = True
+        self.sample_rate = app.config['TRACING_SAMPLE_RATE']
+        self.service_name = app.config['TRACING_SERVICE_NAME']
+
+        exporter = app.config['TRACING_EXPORTER']
+        if exporter == 'file':
+            exporter = OTLPFileExporter(app.config['TRACING_FILE'],
+                                        self.service_name)
+        elif exporter == 'memory':
+            exporter = InMemoryExporter(app.config['TRACING_MEMORY_SPANS'])
+        self.exporter = exporter
+
+        app.before_request(self._start_request)
+        app.after_request(self._tag_response)
+        app.teardown_request(self._end_request)
+        app.jinja_env.template_class = TracedTemplate
+        self._hook_sql()
+
+    def current(self):
+        """The active span, or None."""
+
+        return _current.get()
+
+    def context(self):
+        """(trace id, span id) of the active span, to hand to other work."""
+
+        span = _current.get()
+        return (span.trace_id, span.span_id) if span is not None else None
+
+    @contextmanager
+    def activate(self, span):
+        """Make `span` the active span for the block (without ending it)."""
+
+        token = _current.set(span)
+        try:
+            yield span
+        finally:
+            _current.reset(token)
+
+    def span(self, name, kind=INTERNAL, **attributes):
+        """Context manager timing a child of the active span.
+
+        Yields the Span, or None when nothing is being traced.
+        """
+
+        parent = _current.get()
+        if parent is None:
+            return nullcontext()
+        return self._run(parent.child(name, kind, **attributes))
+
+    def trace(self, name, parent=None, kind=INTERNAL, sampled=None,
+              **attributes):
+        """Context manager for a new local root span, exported on exit.
+
+        `parent` is a `context()` from elsewhere to continue; without
+        one a new trace starts, subject to TRACING_SAMPLE_RATE unless
+        `sampled` says otherwise.
+        """
+
+        span = self._root(name, parent, kind, sampled, attributes)
+        if span is None:
+            return nullcontext()
+        return self._run(span, export=True)
+
+    def _root(self, name, parent, kind, sampled, attributes):
+        if not self.enabled:
+            return None
+        if sampled is None:
+            sampled = (parent is not None
+                       or random.random() < self.sample_rate)
+        if not sampled:
+            return None
+
+        trace_id, parent_id = parent or (os.urandom(16).hex(), None)
+        return Span(name, trace_id, parent_id, kind, attributes=attributes)
+
+    @contextmanager
+    def _run(self, span, export=False):
+        token = _current.set(span)
+        try:
+            yield span
+        except Exception as exc:
+            span.record_error(exc)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+            if export:
+                self._export(span)
+
+    def _export(self, root):
+        spans, root._buffer[:] = list(root._buffer), []
+        if spans and self.exporter is not None:
+            self.exporter.export(spans)
+
+    ##########################################################################
+    # Requests
+
+    def _start_request(self):
+        incoming = parse_traceparent(request.headers.get('traceparent'))
+        parent = sampled = None
+        if incoming is not None:
+            parent, sampled = incoming[:2], incoming[2]
+
+        rule = request.url_rule.rule if request.url_rule else request.path
+        span = self._root(f"{request.method} {rule}", parent, SERVER,
+                          sampled, {'http.method': request.method,
+                                    'http.route': rule,
+                                    'http.target': request.full_path})
+        if span is None:
+            return
+
+        # set without a token: a streamed body may finish in another
+        # context, so teardown just clears it
+        _current.set(span)
+        g.trace_span = span
+
+    def _tag_response(self, response):
+        span = g.get('trace_span')
+        if span is not None:
+            span.set_attribute('http.status_code', response.status_code)
+        return response
+
+    def _end_request(self, exc):
+        span = g.pop('trace_span', None)
+        if span is None:
+            return
+
+        if exc is not None:
+            span.record_error(exc)
+        span.end()
+        _current.set(None)
+        self._export(span)
+
+    ##########################################################################
+    # SQL
+
+    def _hook_sql(self):
+        if self._sql_hooked:
+            return
+        self._sql_hooked = True
+
+        event.listen(Engine, 'before_cursor_execute', self._before_sql)
+        event.listen(Engine, 'after_cursor_execute', self._after_sql)
+        event.listen(Engine, 'handle_error', self._sql_error)
+
+    def _before_sql(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        parent = _current.get()
+        if parent is None:
+            return
+
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement else ''
+        context._trace_span = parent.child(
+            f"sql {verb}".rstrip(), CLIENT,
+            **{'db.system': conn.dialect.name,
+               'db.statement': statement[:MAX_STATEMENT]})
+
+    def _after_sql(self, conn, cursor, statement, parameters, context,
+                   executemany):
+        span = getattr(context, '_trace_span', None)
+        if span is not None:
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                span.set_attribute('db.rows', cursor.rowcount)
+            span.end()
+            context._trace_span = None
+
+    def _sql_error(self, exception_context):
+        context = exception_context.execution_context
+        span = getattr(context, '_trace_span', None)
+        if span is not None:
+            span.record_error(exception_context.original_exception)
+            span.end()
+            context._trace_span = None
+
+
+class TracedTemplate(Template):
+    """Jinja template whose renders are traced."""
+
+    def render(self, *args, **kwargs):
+        with tracer.span(f"render {self.name}",
+                         **{'template.name': self.name}):
+            return super().render(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        # streamed: the span is active only while each chunk renders,
+        # since the caller runs between chunks
+        parent = tracer.current()
+        if parent is None:
+            yield from super().generate(*args, **kwargs)
+            return
+
+        span = parent.child(f"render {self.name}",
+                            **{'template.name': self.name,
+                               'template.streamed': True})
+        chunks = super().generate(*args, **kwargs)
+        try:
+            while True:
+                with tracer.activate(span):
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        return
+                yield chunk
+        except Exception as exc:
+            span.record_error(exc)
+            raise
+        finally:
+            span.end()
+
+
+tracer = Tracer()
@@ -0,0 +1,173 @@
+"""Trending warbles from windowed like counts.
+
+Likes are counted into fixed-width time buckets (TRENDING_BUCKET_SECONDS
+wide) as they happen: `like_message()` calls `record()` with +1 for a like
+and -1 for an unlike. Nothing on the request path ever aggregates over
+the `likes` table.
+
+Every TRENDING_COMPACT_INTERVAL seconds `compact()` drops buckets older
+than the longest window and sums the remaining buckets into a top-N list
+per window. The trending page just reads those precomputed lists.
+
+On a cold start the counters are warmed from the last week of likes,
+streamed in chunks by timestamp. Counters live in this process only, so
+with several workers each one ranks the likes it has seen since it was
+warmed; they converge again on the next restart.
+"""
+
+import calendar
+import heapq
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from models import db, Likes
+from sharding import shard_router
+
+WINDOWS = {
+    '1h': timedelta(hours=1),
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+}
+
+
+class TrendingCounter:
+    """Bucketed like counters with precomputed top-N lists per window."""
+
+    def __init__(self, app=None, bucket_seconds=300, top_n=50):
+        self.bucket_seconds = bucket_seconds
+        self.top_n = top_n
+        self._lock = threading.Lock()
+        self.reset()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults on the Flask app."""
+
+        app.config.setdefault('TRENDING_BUCKET_SECONDS', self.bucket_seconds)
+        app.config.setdefault('TRENDING_TOP_N', self.top_n)
+        app.config.setdefault('TRENDING_COMPACT_INTERVAL', 60)
+        self.bucket_seconds = app.config['TRENDING_BUCKET_SECONDS']
+        self.top_n = app.config['TRENDING_TOP_N']
+        app.extensions['trending'] = self
+
+    def reset(self):
+        """Forget every count; the next compaction will re-warm."""
+
+        with self._lock:
+            self._buckets = {}
+            self._top = {window: [] for window in WINDOWS}
+            self._claimed_at = None
+            self._warmed = False
+
+    def _bucket_for(self, when):
+        # naive datetimes are UTC throughout Warbler
+        if when is None:
+            epoch = int(time.time())
+        else:
+            epoch = calendar.timegm(when.utctimetuple())
+
+        return epoch - epoch % self.bucket_seconds
+
+    def record(self, message_id, delta=1, when=None):
+        """Count a like (+1) or unlike (-1) of `message_id`.
+
+        Ignored until the counters have been warmed, since warming reads
+        those likes back from the database anyway.
+        """
+
+        if not self._warmed:
+            return
+
+        self._add(self._bucket_for(when), message_id, delta)
+
+    def _add(self, bucket, message_id, delta):
+        with self._lock:
+            counts = self._buckets.get(bucket)
+            if counts is None:
+                counts = self._buckets[bucket] = Counter()
+            counts[message_id] += delta
+
+    def warm(self, chunk_size=10000):
+        """Load the last week of likes into the buckets.
+
+        Under sharding, from each shard in turn.
+        """
+
+        since = datetime.utcnow() - max(WINDOWS.values())
+
+        if shard_router.enabled:
+            for shard in shard_router.names:
+                with shard_router.session(shard) as session:
+                    self._warm_from(session, since, chunk_size)
+        else:
+            self._warm_from(db.session, since, chunk_size)
+
+        self._warmed = True
+
+    def _warm_from(self, session, since, chunk_size):
+        rows = (session
+                .query(Likes.message_id, Likes.timestamp)
+                .filter(Likes.timestamp >= since)
+                .yield_per(chunk_size))
+
+        for message_id, when in rows:
+            self._add(self._bucket_for(when), message_id, 1)
+
+    def compact(self, now=None):
+        """Drop expired buckets and recompute the top-N list per window."""
+
+        if not self._warmed:
+            self.warm()
+
+        now = now or time.time()
+        oldest = now - max(WINDOWS.values()).total_seconds()
+
+        with self._lock:
+            for bucket in [b for b in self._buckets if b < oldest]:
+                del self._buckets[bucket]
+
+            # copied so likes recorded meanwhile don't disturb the sums
+            buckets = sorted(((bucket, dict(counts))
+                              for bucket, counts in self._buckets.items()),
+                             reverse=True)
+
+        top = {}
+        for window, span in WINDOWS.items():
+            start = now - span.total_seconds()
+            totals = Counter()
+            for bucket, counts in buckets:
+                if bucket + self.bucket_seconds <= start:
+                    break
+                totals.update(counts)
+
+            top[window] = heapq.nlargest(
+                self.top_n,
+                ((msg_id, n) for msg_id, n in totals.items() if n > 0),
+                key=lambda item: (item[1], item[0]))
+
+        with self._lock:
+            self._top = top
+
+    def claim_compaction(self, interval):
+        """True at most once per `interval` seconds: time to compact."""
+
+        with self._lock:
+            now = time.monotonic()
+            if (self._claimed_at is not None
+                    and now - self._claimed_at < interval):
+                return False
+
+            self._claimed_at = now
+            return True
+
+    def top(self, window):
+        """Precomputed [(message_id, likes), ...] for `window`."""
+
+        return self._top[window]
+
+
+trending = TrendingCounter()
@@ -0,0 +1,9 @@
+"""WSGI entry point for production, e.g. `gunicorn wsgi:app`.
+
+Each worker builds its own app with the prod profile, so it is warmed up
+(templates compiled, DB connection open) before it accepts a request.
+"""
+
+from app import create_app
+
+app = create_app('prod')